@@ -0,0 +1,147 @@
+"""
+フレーズのクラスタリング結果 (重心, 代表語, メンバー数) を保存し、差分更新できるようにする
+"""
+
+import json
+import os
+
+import numpy as np
+
+# クラスターモデルの保存先
+CLUSTER_MODEL_DIR = 'dataset_for_bda/cluster_model'
+
+
+def select_representatives(vectors: np.ndarray, codes: np.ndarray, n_clusters: int,
+                           frequencies: np.ndarray | None = None, method: str = 'frequency') -> np.ndarray:
+    """
+    各クラスターの代表にするフレーズの位置を返す (クラスター番号順)。
+      'frequency': データ中の出現回数が最も多いフレーズ
+      'centroid': クラスターの重心とのコサイン類似度が最も高いフレーズ
+    同点の場合は先に出現したフレーズを選ぶ。
+    """
+    if method == 'frequency':
+        score = np.ones(len(codes)) if frequencies is None else np.asarray(frequencies, dtype=np.float64)
+    elif method == 'centroid':
+        sums = np.zeros((n_clusters, vectors.shape[1]), dtype=np.float64)
+        np.add.at(sums, codes, vectors)
+        unit_centroids = _normalize_rows(sums)
+        score = np.einsum('ij,ij->i', _normalize_rows(vectors), unit_centroids[codes])
+    else:
+        raise ValueError(f"無効な代表語の選び方です: '{method}'。'frequency' または 'centroid' を指定してください。")
+
+    # クラスター番号 -> スコアの降順 -> 出現順 に並べ、各クラスターの先頭を代表にする
+    order = np.lexsort((np.arange(len(codes)), -score, codes))
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = codes[order][1:] != codes[order][:-1]
+    return order[is_first]
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class ClusterModel:
+    """
+    クラスターごとの重心ベクトル、代表語、メンバー数と、フレーズ -> クラスター番号の対応を持つ。
+    クラスター番号は 0 から連番で、新しいクラスターは末尾に追加される。
+    """
+
+    def __init__(self, centroids: np.ndarray, counts: np.ndarray, representatives: list[str],
+                 members: dict[str, int], meta: dict | None = None):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.representatives = list(representatives)
+        self.members = dict(members)
+        self.meta = dict(meta or {})
+
+    @classmethod
+    def from_labels(cls, phrases: list[str], vectors: np.ndarray, labels: np.ndarray, frequencies: np.ndarray | None = None,
+                    representative_method: str = 'frequency', meta: dict | None = None) -> 'ClusterModel':
+        """
+        クラスタリングの結果からモデルを作る。クラスター番号は出現順に振り直す。
+        frequencies は各フレーズのデータ中の出現回数で、代表語の選択に使う。
+        """
+        _, first, codes = np.unique(labels, return_index=True, return_inverse=True)
+        # np.unique はラベルの値でソートするので、最初に出現した順の番号に並べ替える
+        order = np.argsort(first, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        codes = rank[codes.ravel()]
+
+        n_clusters = len(order)
+        counts = np.bincount(codes, minlength=n_clusters)
+        sums = np.zeros((n_clusters, vectors.shape[1]), dtype=np.float64)
+        np.add.at(sums, codes, vectors)
+
+        phrases = np.asarray(phrases, dtype=object)
+        representatives = phrases[select_representatives(vectors, codes, n_clusters, frequencies, representative_method)]
+        members = dict(zip(phrases.tolist(), codes.tolist()))
+        return cls(sums / counts[:, None], counts, representatives.tolist(), members, meta)
+
+    def add(self, phrases: list[str], vectors: np.ndarray, labels: np.ndarray, frequencies: np.ndarray | None = None,
+            representative_method: str = 'frequency') -> None:
+        """
+        新しいフレーズを追加する。labels が既存のクラスター数以上のものは新しいクラスターとして
+        (番号順に) 追加し、そのメンバーから代表語を選ぶ。
+        既存クラスターの代表語は変えず、重心とメンバー数だけを更新する。
+        """
+        labels = np.asarray(labels)
+        n_existing = len(self.representatives)
+        n_clusters = max(len(self.counts), int(labels.max()) + 1 if len(labels) else 0)
+
+        counts = np.zeros(n_clusters, dtype=np.int64)
+        counts[:len(self.counts)] = self.counts
+        sums = np.zeros((n_clusters, self.centroids.shape[1] if len(self.centroids) else vectors.shape[1]))
+        sums[:len(self.counts)] = self.centroids * self.counts[:, None]
+
+        np.add.at(counts, labels, 1)
+        np.add.at(sums, labels, vectors)
+
+        is_new = labels >= n_existing
+        if is_new.any():
+            new_codes = labels[is_new] - n_existing
+            new_frequencies = None if frequencies is None else np.asarray(frequencies)[is_new]
+            chosen = select_representatives(np.asarray(vectors)[is_new], new_codes, n_clusters - n_existing,
+                                            new_frequencies, representative_method)
+            self.representatives += np.asarray(phrases, dtype=object)[is_new][chosen].tolist()
+        self.members.update(zip(phrases, labels.tolist()))
+
+        self.counts = counts
+        self.centroids = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+
+    def normalization_map(self) -> dict[str, str]:
+        """フレーズ -> 所属するクラスターの代表語"""
+        labels = np.fromiter(self.members.values(), dtype=np.int64, count=len(self.members))
+        representatives = np.asarray(self.representatives, dtype=object)[labels]
+        return dict(zip(self.members, representatives.tolist()))
+
+    def clusters(self) -> dict[int, list[str]]:
+        """クラスター番号 -> メンバーのフレーズのリスト"""
+        clusters = {}
+        for phrase, label in self.members.items():
+            clusters.setdefault(label, []).append(phrase)
+        return clusters
+
+    def save(self, model_dir: str = CLUSTER_MODEL_DIR) -> None:
+        os.makedirs(model_dir, exist_ok=True)
+        np.save(os.path.join(model_dir, 'centroids.npy'), self.centroids)
+        with open(os.path.join(model_dir, 'clusters.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'meta': self.meta,
+                'representatives': self.representatives,
+                'counts': self.counts.tolist(),
+                'members': self.members,
+            }, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, model_dir: str = CLUSTER_MODEL_DIR) -> 'ClusterModel | None':
+        """保存されたモデルを読み込む。存在しなければ None を返す"""
+        centroids_path = os.path.join(model_dir, 'centroids.npy')
+        clusters_path = os.path.join(model_dir, 'clusters.json')
+        if not (os.path.exists(centroids_path) and os.path.exists(clusters_path)):
+            return None
+
+        with open(clusters_path, encoding='utf-8') as f:
+            saved = json.load(f)
+        return cls(np.load(centroids_path), saved['counts'], saved['representatives'], saved['members'], saved['meta'])
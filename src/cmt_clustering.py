@@ -2,23 +2,50 @@
 problem, solution verb, solution object の CSV の正規化を行う
 """
 
+import argparse
 import re
+import time
 import pandas as pd
 import numpy as np
 import spacy
+from scipy.sparse.csgraph import connected_components
 from sklearn.cluster import AgglomerativeClustering
-from collections import Counter
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+from sklearn.neighbors import NearestNeighbors
 import warnings
 
+import run_report
+from cluster_model import CLUSTER_MODEL_DIR, ClusterModel
+from phrase_vectors import PhraseVectorizer
+from storage import read_table, write_table
+
 # --- 設定項目 ---
-# ユーザーのspacyコードで生成されたCSVファイルを指定
-INPUT_CSV = 'dataset_for_bda/comments_extracted.csv'
+# cmt_extract.py で抽出したフレーズ
+INPUT_PATH = 'dataset_for_bda/comments_extracted.parquet'
 # 正規化後の結果を保存するファイル名を指定
-OUTPUT_CSV = 'dataset_for_bda/comments_clustered.csv'
+OUTPUT_PATH = 'dataset_for_bda/comments_clustered.parquet'
+# ロングフォーマット (cmt_extract.py --long の出力) の入出力
+LONG_INPUT_PATH = 'dataset_for_bda/comments_extracted_long.parquet'
+LONG_OUTPUT_PATH = 'dataset_for_bda/comments_clustered_long.parquet'
 # spaCyのベクトル付きモデル
 SPACY_MODEL = 'en_core_web_md'
 # クラスタリングの閾値（0に近いほど厳しく、1に近いほど緩やかになる。0.2~0.4あたりで調整）
 DISTANCE_THRESHOLD = 0.3
+# クラスタリング方式
+#   'agglomerative': 全ペアの距離行列を使う平均連結の階層的クラスタリング (O(n^2) のメモリ)
+#   'graph': コサイン距離が閾値以下の近傍グラフの連結成分ごとに agglomerative を行う (結果は agglomerative と同じ)
+#            (距離の計算は O(n^2) のまま。距離行列が連結成分ごとになるので、メモリが少なくて済むだけ)
+#   'leader': 閾値以内に代表 (leader) がなければ新しいクラスターを作る 1パスの canopy 方式
+#             (計算量が フレーズ数 x クラスター数 で済む、O(n^2) にならない唯一の方式)
+CLUSTERING_METHOD = 'agglomerative'
+# クラスターの代表語の選び方
+#   'frequency': 入力データ中で最も出現回数が多いフレーズ
+#   'centroid': クラスターの重心に最も近いフレーズ
+REPRESENTATIVE_METHOD = 'frequency'
+# leader 方式で一度に代表と比較するフレーズ数
+LEADER_BLOCK_SIZE = 1024
+# --compare で出力する方式ごとの一致度レポート
+COMPARISON_CSV = 'dataset_for_bda/clustering_comparison.csv'
 
 # FutureWarningを非表示にする
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -37,113 +64,271 @@ def clean_text(text: str) -> str:
     text = re.sub(r'\s+', ' ', text).strip()
     return text
 
-def create_normalization_map(phrases: list[str], nlp: spacy.language.Language) -> dict[str, str]:
-    """
-    フレーズのリストを受け取り、クラスタリングして正規化マッピング辞書を返す
-    """
-    print(f"合計 {len(phrases)} 個のユニークなフレーズを処理します...")
-
-    # フレーズをベクトル化
-    vectors = []
-    valid_phrases = []
-    for phrase in phrases:
-        doc = nlp(phrase)
-        word_vectors = [token.vector for token in doc if token.has_vector and not token.is_stop]
-        if word_vectors:
-            vectors.append(np.mean(word_vectors, axis=0))
-            valid_phrases.append(phrase)
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
 
-    if not valid_phrases:
-        print("有効なベクトルを持つフレーズが見つかりませんでした。")
-        return {}
-
-    vectors = np.array(vectors)
-
-    # 階層的クラスタリング
-    print("フレーズをクラスタリングしています...")
+def agglomerative_labels(vectors: np.ndarray, threshold: float = DISTANCE_THRESHOLD) -> np.ndarray:
+    """コサイン距離の平均連結の階層的クラスタリングを threshold で切ったクラスターラベル"""
+    if len(vectors) == 1:
+        return np.zeros(1, dtype=int)
     clustering = AgglomerativeClustering(
         n_clusters=None,
-        distance_threshold=DISTANCE_THRESHOLD,
+        distance_threshold=threshold,
         metric='cosine', # scikit-learn 1.2以降はmetric, それ以前はaffinity
         linkage='average'
     ).fit(vectors)
+    return clustering.labels_
+
+def cluster_by_radius_graph(vectors: np.ndarray, threshold: float = DISTANCE_THRESHOLD) -> np.ndarray:
+    """
+    コサイン距離が threshold 以下のフレーズ同士を辺で結んだ疎な近傍グラフを作り、
+    その連結成分ごとに平均連結の階層的クラスタリングを行ったクラスターラベルを返す。
+    平均連結で併合される2つのクラスターの間には距離が threshold 以下のペアが必ずあるので、
+    別の連結成分のフレーズが同じクラスターになることはなく、結果は agglomerative と同じになる
+    (連結成分をそのままクラスターにすると単連結法になり、閾値を超えて鎖状につながってしまう)。
+    近傍探索はブロックごとに行うため、距離行列は連結成分ごとにしか作らない。
+    ただし全ペアの距離を計算するので、計算量は agglomerative と同じく O(n^2)。
+    (長さ1に正規化して ball tree で探す方法も試したが、spaCy の 300 次元のベクトルでは
+    木による枝刈りがほとんど効かず、brute より遅かった。)
+    フレーズ数が多くて時間が問題になる場合は leader 方式を使う。
+    """
+    graph = NearestNeighbors(radius=threshold, metric='cosine', algorithm='brute').fit(vectors) \
+        .radius_neighbors_graph(vectors, mode='connectivity')
+    _, components = connected_components(graph, directed=False)
+
+    labels = np.empty(len(vectors), dtype=int)
+    n_clusters = 0
+    order = np.argsort(components, kind='stable')
+    for rows in np.split(order, np.flatnonzero(np.diff(components[order])) + 1):
+        component_labels = agglomerative_labels(vectors[rows], threshold)
+        labels[rows] = n_clusters + component_labels
+        n_clusters += component_labels.max() + 1
+    return labels
+
+def cluster_by_leader(vectors: np.ndarray, threshold: float = DISTANCE_THRESHOLD,
+                      block_size: int = LEADER_BLOCK_SIZE, leaders: np.ndarray | None = None) -> np.ndarray:
+    """
+    leader (canopy) 方式のクラスタリング。フレーズを順に見て、コサイン距離が threshold 以内の
+    代表がいれば最も近い代表のクラスターに、いなければ自身を代表とする新しいクラスターにする。
+    代表との比較は block_size 件ずつ行列積でまとめて計算する。
+    leaders に既存クラスターの代表ベクトルを渡すと、その番号 (0 ~ len(leaders)-1) を
+    引き継ぎ、新しいクラスターには len(leaders) 以降の番号を振る。
+    """
+    unit = _normalize_rows(vectors).astype(np.float32)
+    min_similarity = 1.0 - threshold
+    labels = np.empty(len(unit), dtype=int)
+    if leaders is None:
+        leaders = np.empty((0, unit.shape[1]), dtype=np.float32)
+    else:
+        leaders = _normalize_rows(leaders).astype(np.float32)
+
+    for start in range(0, len(unit), block_size):
+        block = unit[start:start + block_size]
+        if len(leaders) > 0:
+            similarity = block @ leaders.T
+            best = similarity.argmax(axis=1)
+            matched = similarity[np.arange(len(block)), best] >= min_similarity
+        else:
+            best = np.zeros(len(block), dtype=int)
+            matched = np.zeros(len(block), dtype=bool)
+        labels[start:start + len(block)][matched] = best[matched]
+
+        # 既存の代表に近くないフレーズは、このブロックで新しく作った代表とだけ順に比較する
+        new_leaders = []
+        for i in np.flatnonzero(~matched):
+            if new_leaders:
+                similarity = np.array(new_leaders) @ block[i]
+                j = similarity.argmax()
+                if similarity[j] >= min_similarity:
+                    labels[start + i] = len(leaders) + j
+                    continue
+            labels[start + i] = len(leaders) + len(new_leaders)
+            new_leaders.append(block[i])
+        if new_leaders:
+            leaders = np.vstack([leaders, np.array(new_leaders)])
 
-    # 元のフレーズとクラスターラベルを対応付ける
-    original_phrase_to_label = {phrase: clustering.labels_[i] for i, phrase in enumerate(valid_phrases)}
+    return labels
 
-    # 各クラスターで最も頻繁に出現するフレーズを代表語とする
-    label_to_phrases = {}
-    for phrase, label in original_phrase_to_label.items():
-        if label not in label_to_phrases:
-            label_to_phrases[label] = []
-        label_to_phrases[label].append(phrase)
+def cluster_vectors(vectors: np.ndarray, method: str = CLUSTERING_METHOD) -> np.ndarray:
+    """フレーズベクトルを method の方式でクラスタリングし、クラスターラベルを返す"""
+    if method == 'agglomerative':
+        return agglomerative_labels(vectors)
+    elif method == 'graph':
+        return cluster_by_radius_graph(vectors)
+    elif method == 'leader':
+        return cluster_by_leader(vectors)
+    raise ValueError(f"無効なクラスタリング方式です: '{method}'。'agglomerative', 'graph', 'leader' のいずれかを指定してください。")
+
+def create_normalization_map(phrase_counts: pd.Series, vectorizer: PhraseVectorizer, method: str = CLUSTERING_METHOD,
+                             representative_method: str = REPRESENTATIVE_METHOD, incremental: bool = False,
+                             model_dir: str = CLUSTER_MODEL_DIR) -> dict[str, str]:
+    """
+    フレーズ -> 出現回数の Series を受け取り、クラスタリングして正規化マッピング辞書を返す。
+    各クラスターの代表語は representative_method (出現回数 / 重心への近さ) で選ぶ。
+    クラスタリングの結果は model_dir に保存する。incremental=True で保存済みのモデルがあれば、
+    まだ見ていないフレーズだけを DISTANCE_THRESHOLD 以内で最も近い既存クラスターに割り当てる
+    (近いクラスターがなければ新しいクラスターを作る)。既存のフレーズの代表語は変わらない。
+    保存済みのモデルの spaCy モデル・方式・閾値が現在の設定と異なる場合は、全てのフレーズをクラスタリングし直す。
+    """
+    print(f"合計 {len(phrase_counts)} 個のユニークなフレーズを処理します...")
+
+    # フレーズをベクトル化 (計算済みのフレーズはキャッシュから読み込む)
+    valid_phrases, vectors = vectorizer.embed(phrase_counts.index.tolist())
+
+    if not valid_phrases:
+        print("有効なベクトルを持つフレーズが見つかりませんでした。")
+        return {}
+    frequencies = phrase_counts.loc[valid_phrases].to_numpy()
+
+    meta = {'spacy_model': SPACY_MODEL, 'distance_threshold': DISTANCE_THRESHOLD, 'method': method}
+    model = ClusterModel.load(model_dir) if incremental else None
+    if model is not None:
+        # 別のモデルのベクトル (別のベクトル空間) や別の方式・閾値で作ったクラスターには割り当てず、作り直す
+        mismatched = {key: model.meta.get(key) for key, value in meta.items() if model.meta.get(key) != value}
+        if mismatched:
+            print(f"警告: 保存済みのクラスターモデルの設定 {mismatched} が現在の設定 "
+                  f"{ {key: meta[key] for key in mismatched} } と異なるため、全てのフレーズをクラスタリングし直します。")
+            model = None
+
+    if model is None:
+        # クラスタリング
+        print(f"フレーズをクラスタリングしています... (方式: {method})")
+        labels = cluster_vectors(vectors, method)
+        model = ClusterModel.from_labels(valid_phrases, vectors, labels, frequencies, representative_method, meta)
+    else:
+        new_rows = [i for i, phrase in enumerate(valid_phrases) if phrase not in model.members]
+        print(f"保存済みのクラスターモデル ({len(model.counts)} クラスター) に "
+              f"{len(new_rows)} 個の新しいフレーズを割り当てます...")
+        if new_rows:
+            n_clusters = len(model.counts)
+            labels = cluster_by_leader(vectors[new_rows], leaders=model.centroids)
+            model.add([valid_phrases[i] for i in new_rows], vectors[new_rows], labels,
+                      frequencies[new_rows], representative_method)
+            print(f"既存のクラスターに {int((labels < n_clusters).sum())} 個、"
+                  f"新しい {len(model.counts) - n_clusters} クラスターに {int((labels >= n_clusters).sum())} 個を割り当てました。")
+    model.save(model_dir)
+    print(f"クラスターモデルを '{model_dir}' に保存しました。")
 
     print("\n--- 作成されたクラスターの例 ---")
-    for i, (label, cluster_phrases) in enumerate(label_to_phrases.items()):
+    for i, (label, cluster_phrases) in enumerate(model.clusters().items()):
         if i >= 5: # 表示しすぎないように最初の5件のみ
             print("...")
             break
         print(f"クラスター {label}: {cluster_phrases}")
 
+    # 正規化マッピング辞書を作成 (各クラスターの代表語に置き換える)
+    return model.normalization_map()
+
+def compare_clustering_methods(phrases: list[str], vectorizer: PhraseVectorizer, output_file: str = COMPARISON_CSV) -> pd.DataFrame:
+    """
+    厳密な平均連結の階層的クラスタリングを基準に、他の方式のクラスターとの一致度
+    (Adjusted Rand Index, NMI) と所要時間を比較し、CSV に保存する。
+    """
+    print(f"{len(phrases)} 個のフレーズで各クラスタリング方式を比較します...")
+    _, vectors = vectorizer.embed(phrases)
 
-    # 正規化マッピング辞書を作成
-    mapping = {}
-    for label, cluster_phrases in label_to_phrases.items():
-        # クラスター内で最も頻繁に出現するものを代表語に
-        most_common_phrase = Counter(cluster_phrases).most_common(1)[0][0]
-        for phrase in cluster_phrases:
-            mapping[phrase] = most_common_phrase
+    results = {}
+    rows = []
+    for method in ['agglomerative', 'graph', 'leader']:
+        start = time.perf_counter()
+        results[method] = cluster_vectors(vectors, method)
+        elapsed = time.perf_counter() - start
+        rows.append({
+            'method': method,
+            'n_phrases': len(vectors),
+            'n_clusters': len(np.unique(results[method])),
+            'seconds': elapsed,
+            'ari_vs_agglomerative': adjusted_rand_score(results['agglomerative'], results[method]),
+            'nmi_vs_agglomerative': normalized_mutual_info_score(results['agglomerative'], results[method]),
+        })
 
-    return mapping
+    report = pd.DataFrame(rows)
+    print("\n--- クラスタリング方式の比較 (基準: agglomerative) ---")
+    print(report.to_string(index=False))
+    report.to_csv(output_file, index=False)
+    print(f"比較結果を '{output_file}' に保存しました。")
+    return report
 
 
 def main():
     """
     メイン処理
     """
+    parser = argparse.ArgumentParser(description="problem, verb, obj のフレーズをクラスタリングして正規化する")
+    parser.add_argument('--method', choices=['agglomerative', 'graph', 'leader'], default=CLUSTERING_METHOD,
+                        help=f"クラスタリング方式 (既定: {CLUSTERING_METHOD})。graph は agglomerative と同じ結果でメモリを抑えるが計算量は O(n^2)、"
+                             "フレーズ数に対して O(n^2) にならないのは leader だけ")
+    parser.add_argument('--compare', action='store_true',
+                        help="正規化は行わず、入力のフレーズで各方式と agglomerative の一致度を比較する")
+    parser.add_argument('--representative', choices=['frequency', 'centroid'], default=REPRESENTATIVE_METHOD,
+                        help=f"クラスターの代表語の選び方 (既定: {REPRESENTATIVE_METHOD})")
+    parser.add_argument('--long', action='store_true',
+                        help=f"ロングフォーマットの '{LONG_INPUT_PATH}' を正規化して '{LONG_OUTPUT_PATH}' に保存する")
+    parser.add_argument('--incremental', action='store_true',
+                        help="保存済みのクラスターモデルに新しいフレーズだけを割り当てる (モデルがなければ全件をクラスタリング)")
+    args = parser.parse_args()
+
     print(f"spaCyモデル '{SPACY_MODEL}' をロードしています...")
     try:
-        nlp = spacy.load(SPACY_MODEL)
+        # ベクトル化にはトークナイザーと単語ベクトルしか使わない
+        nlp = spacy.load(SPACY_MODEL, exclude=['tok2vec', 'tagger', 'parser', 'attribute_ruler', 'lemmatizer', 'ner'])
     except OSError:
         print(f"エラー: spaCyモデル '{SPACY_MODEL}' が見つかりません。")
         print(f"ターミナルで `python -m spacy download {SPACY_MODEL}` を実行してください。")
         return
+    vectorizer = PhraseVectorizer(nlp)
 
-    print(f"入力ファイル '{INPUT_CSV}' を読み込んでいます...")
+    input_path, output_path = (LONG_INPUT_PATH, LONG_OUTPUT_PATH) if args.long else (INPUT_PATH, OUTPUT_PATH)
+    print(f"入力ファイル '{input_path}' を読み込んでいます...")
     try:
-        df = pd.read_csv(INPUT_CSV)
+        df = read_table(input_path)
     except FileNotFoundError:
-        print(f"エラー: {INPUT_CSV} が見つかりません。")
+        print(f"エラー: {input_path} が見つかりません。")
         return
 
-    # 正規化対象のカラムを特定（_problem と _objで終わる列）
-    target_columns = [col for col in df.columns if col.endswith('_problem') or col.endswith('_verb') or col.endswith('_obj')]
+    # 正規化対象のカラムを特定（problem, _problem, _verb, _objで終わる列）
+    target_columns = [col for col in df.columns
+                      if col == 'problem' or col.endswith('_problem') or col.endswith('_verb') or col.endswith('_obj')]
     if not target_columns:
         print("エラー: 正規化対象のカラム（_problem, _obj）が見つかりませんでした。")
         return
 
-    # 全てのユニークなフレーズを収集・クリーニング
-    all_phrases = pd.unique(df[target_columns].values.ravel('K'))
-    cleaned_phrases = {clean_text(p) for p in all_phrases if isinstance(p, str) and p != 'unknown' and clean_text(p)}
+    # ユニークな値ごとに一度だけクリーニングし、全ての対象カラムに適用する
+    # (フレーズの列はカテゴリ型で読み込まれるので、文字列の列に戻してから扱う)
+    raw_values = df[target_columns].astype(object)
+    clean_map = {value: clean_text(value) for value in pd.unique(raw_values.values.ravel('K')) if isinstance(value, str)}
+    cleaned = raw_values.apply(lambda col: col.map(clean_map).fillna(''))
+
+    # 'unknown' 以外のフレーズの出現回数を数える (代表語の選択に使う)
+    # (文字列でない値はクリーニング後に空文字列になっている)
+    is_phrase = (raw_values != 'unknown') & (cleaned != '')
+    phrase_counts = cleaned.where(is_phrase).stack().value_counts()
+    # 実行ごとにフレーズの順序が変わらないようにソートしておく
+    phrase_counts = phrase_counts.sort_index()
+
+    if args.compare:
+        compare_clustering_methods(phrase_counts.index.tolist(), vectorizer)
+        run_report.print_report()
+        return
 
     # 正規化マッピングを作成
-    normalization_map = create_normalization_map(list(cleaned_phrases), nlp)
+    normalization_map = create_normalization_map(phrase_counts, vectorizer, args.method,
+                                                 args.representative, args.incremental)
 
     if not normalization_map:
         print("正規化マッピングが作成されなかったため、処理を終了します。")
         return
         
     print("\n正規化マッピングをデータに適用しています...")
-    # クリーニング関数と正規化マッピングを適用
-    for col in target_columns:
-        # 1. 各値をクリーニング
-        cleaned_series = df[col].apply(clean_text)
-        # 2. クリーニングされた値にマッピングを適用
-        df[col] = cleaned_series.map(normalization_map).fillna(cleaned_series)
+    # クリーニングされた値に正規化マッピングを適用 (マッピングにない値はそのまま)
+    mapping = pd.Series(normalization_map)
+    df[target_columns] = cleaned.apply(lambda col: col.map(mapping).fillna(col))
 
 
-    df.to_csv(OUTPUT_CSV, index=False)
-    print(f"\n処理が完了しました。正規化されたデータを '{OUTPUT_CSV}' に保存しました。")
+    write_table(df, output_path)
+    print(f"\n処理が完了しました。正規化されたデータを '{output_path}' に保存しました。")
+    run_report.print_report()
 
 
 if __name__ == '__main__':
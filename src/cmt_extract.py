@@ -2,15 +2,44 @@
 正規化したコメントから problem, solution verb, solution object を抽出する
 """
 
+import argparse
+import os
 import spacy
 import re
+import numpy as np
 import pandas as pd
 
+import run_report
+from parse_cache import ParseCache
+from sharding import map_shards
+from storage import read_table, write_table
+from token_norm import get_normalizer
 
-INPUT_CSV = 'dataset_for_bda/comments_normalized.csv'
-OUTPUT_CSV = 'dataset_for_bda/comments_extracted.csv'
-# INPUT_CSV = 'dataset_for_bda/comments_normalized_subset.csv'
-# OUTPUT_CSV = 'dataset_for_bda/comments_extracted_subset.csv'
+
+INPUT_PATH = 'dataset_for_bda/comments_normalized.parquet'
+OUTPUT_PATH = 'dataset_for_bda/comments_extracted.parquet'
+# INPUT_PATH = 'dataset_for_bda/comments_normalized_subset.csv'
+# OUTPUT_PATH = 'dataset_for_bda/comments_extracted_subset.parquet'
+# ロングフォーマット (cmt_normalize.py --long の出力) の入出力
+LONG_INPUT_PATH = 'dataset_for_bda/comments_normalized_long.parquet'
+LONG_OUTPUT_PATH = 'dataset_for_bda/comments_extracted_long.parquet'
+# 抽出モード ('batch': 全コメントの節をまとめて nlp.pipe で解析, 'apply': 1節ずつ nlp() で解析)
+EXTRACTION_MODE = 'batch'
+# nlp.pipe に渡すバッチサイズ
+BATCH_SIZE = 256
+# 抽出に使わないパイプライン (find_subject_verb_object は dep_, pos_, lemma_ しか参照しない)
+# 原形は使うトークンの分だけ token_lemma で (表層形, 品詞) ごとのメモから求めるので、lemmatizer も止める
+DISABLED_PIPES = ['ner', 'lemmatizer']
+# 抽出対象のコメント番号 (comment1_text ... comment7_text)
+COMMENT_INDICES = range(1, 8)
+
+UNKNOWN_TRIPLE = ("unknown", "unknown", "unknown")
+
+# 指定された形式に基づいて、テキストを「問題部」と「解決策部」に分割する正規表現
+CRITIQUE_PATTERN = re.compile(
+    r"In (the|this) current design,?(.*?)(?:(To fix this|To fix this issue|For example),)(.*)",
+    flags=re.IGNORECASE | re.DOTALL
+)
 
 # spaCyの英語モデルをロードします
 # 事前にターミナルでインストールが必要です:
@@ -23,6 +52,15 @@ except OSError:
     print("ターミナルで `python -m spacy download en_core_web_sm` を実行してください。")
     nlp = None
 
+# 解析済みの Doc をテキストの内容でキャッシュする (batch モードで使用)
+parse_cache = ParseCache(nlp, disable=DISABLED_PIPES) if nlp else None
+# token_lemma のメモのキーに使うモデル名
+MODEL_NAME = f"{nlp.meta['lang']}_{nlp.meta['name']}-{nlp.meta['version']}" if nlp else None
+
+def token_lemma(token) -> str:
+    """トークンの原形 (lemmatizer を止めて解析した Doc でも、メモまたは lemmatizer から求める)"""
+    return get_normalizer().lemma(token, nlp.get_pipe('lemmatizer'), MODEL_NAME)
+
 def find_subject_verb_object(doc: spacy.tokens.doc.Doc) -> tuple[str, str, str]:
     """
     spaCyで解析済みのDocから、主語、動詞、目的語を抽出するヘルパー関数。
@@ -36,7 +74,7 @@ def find_subject_verb_object(doc: spacy.tokens.doc.Doc) -> tuple[str, str, str]:
     for token in doc:
         # print("\t\ttoken", token.text, token.dep_, token.pos_)
         if token.dep_ == "ROOT" and ["VERB", "AUX"].count(token.pos_) > 0:
-            verb = token.lemma_  # 動詞の原形を取得
+            verb = token_lemma(token)  # 動詞の原形を取得
             
             # 動詞に関連する主語(nsubj)と目的語(dobj, attr)を探す
             for child in token.children:
@@ -50,7 +88,7 @@ def find_subject_verb_object(doc: spacy.tokens.doc.Doc) -> tuple[str, str, str]:
                         subtree.append(t)
                     
                     # DET, PRON, PUNCT 以外のトークンの lemma_を抽出
-                    subject = " ".join(t.lemma_ for t in subtree if ['DET', 'PRON'].count(t.pos_) == 0)
+                    subject = " ".join(token_lemma(t) for t in subtree if ['DET', 'PRON'].count(t.pos_) == 0)
                 # 目的語を抽出
                 elif child.dep_ in ("dobj", "attr"):
                     # ADP 以降のトークンをフィルター
@@ -60,7 +98,7 @@ def find_subject_verb_object(doc: spacy.tokens.doc.Doc) -> tuple[str, str, str]:
                             break
                         subtree.append(t)
 
-                    obj = " ".join(t.lemma_ for t in subtree if ['DET', 'PRON'].count(t.pos_) == 0)
+                    obj = " ".join(token_lemma(t) for t in subtree if ['DET', 'PRON'].count(t.pos_) == 0)
             break
             
     return subject, verb, obj
@@ -99,72 +137,160 @@ def clean_extracted_text(text: str) -> str:
     
     return text if text else "unknown"
 
-def extract_critique_by_format(text: str) -> tuple[str, str, str]:
+def split_critique(text: str) -> tuple[str, str] | None:
+    """
+    UI批評のテキストを前処理し、「問題部」と「解決策部」の節に分割する。
+    テキストが空、またはフォーマットに合致しない場合は None を返す。
     """
-    指定されたフォーマットに従い、UI批評から問題(S)、改善策の動詞(V)、目的語(O)を抽出する。
-    
-    フォーマット: "In the current design, S V O. To fix this, [S] V O ..."
-
-    Args:
-        text: UI批評のテキスト文字列。
-
-    Returns:
-        ('problem', 'solution_verb', 'solution_obj') の形式のタプル。
-    """    
-    problem = "unknown"
-    solution_verb = "unknown"
-    solution_obj = "unknown"
-
-    if not nlp:
-        print("spaCyのモデルがロードされていません。")
-        return ("unknown", "unknown", "unknown")
-    
     # if nan
     if not isinstance(text, str) or not text.strip():
-        return ("unknown", "unknown", "unknown")
+        return None
 
     # テキストを前処理
     text = pre_clean_text(text)
-    
-    # 指定された形式に基づいて、テキストを「問題部」と「解決策部」に分割する正規表現
-    pattern = re.compile(
-        r"In (the|this) current design,?(.*?)(?:(To fix this|To fix this issue|For example),)(.*)",
-        flags=re.IGNORECASE | re.DOTALL
-    )
-    match = pattern.search(text)
+
+    match = CRITIQUE_PATTERN.search(text)
     if not match:
         print(f"[Warning] Could not match the expected format.\n\t{text}")
-        # print(f"フォーマットに合致しないテキスト: {text}")
-        return ("unknown", "unknown", "unknown")
+        return None
 
-    problem_clause_text = match.group(2).strip()
-    solution_clause_text = match.group(4).strip()
+    return match.group(2).strip(), match.group(4).strip()
+
+def critique_from_docs(doc_problem, doc_solution) -> tuple[str, str, str]:
+    """
+    問題部と解決策部の解析済みDocから ('problem', 'solution_verb', 'solution_obj') を作る。
+    節が空だった場合は Doc の代わりに None を渡す。
+    """
+    problem = "unknown"
+    solution_verb = "unknown"
+    solution_obj = "unknown"
 
     # --- 1. "In the current design," に続く文の主語(S)を抽出 ---
-    if problem_clause_text:
-        doc_problem = nlp(problem_clause_text)
+    if doc_problem is not None:
         problem_subject, _, _ = find_subject_verb_object(doc_problem)
         problem = problem_subject
 
     # --- 2. "To fix this," に続く文の動詞(V)と目的語(O)を抽出 ---
-    if solution_clause_text:
-        doc_solution = nlp(solution_clause_text)
+    if doc_solution is not None:
         # 解決策の文では主語は不要なため、返り値のverbとobjのみ使用
         s_subject, s_verb, s_obj = find_subject_verb_object(doc_solution)
         solution_verb = s_verb
         # obj が存在しなければ subject を代わりに使用
-        # print('\t', s_subject, s_obj)
         solution_obj = s_obj if s_obj != 'unknown' else s_subject
 
     # strip all
     problem = clean_extracted_text(problem)
     solution_verb = clean_extracted_text(solution_verb)
     solution_obj = clean_extracted_text(solution_obj)
-    
+
     return ("unknown" if problem == "" else problem,
             "unknown" if solution_verb == "" else solution_verb,
             "unknown" if solution_obj == "" else solution_obj)
 
+def extract_critique_by_format(text: str) -> tuple[str, str, str]:
+    """
+    指定されたフォーマットに従い、UI批評から問題(S)、改善策の動詞(V)、目的語(O)を抽出する。
+    
+    フォーマット: "In the current design, S V O. To fix this, [S] V O ..."
+
+    Args:
+        text: UI批評のテキスト文字列。
+
+    Returns:
+        ('problem', 'solution_verb', 'solution_obj') の形式のタプル。
+    """
+    if not nlp:
+        print("spaCyのモデルがロードされていません。")
+        return UNKNOWN_TRIPLE
+
+    clauses = split_critique(text)
+    if clauses is None:
+        return UNKNOWN_TRIPLE
+
+    problem_clause_text, solution_clause_text = clauses
+    doc_problem = nlp(problem_clause_text) if problem_clause_text else None
+    doc_solution = nlp(solution_clause_text) if solution_clause_text else None
+    return critique_from_docs(doc_problem, doc_solution)
+
+def extract_critiques_batch(texts: list[str], batch_size: int = BATCH_SIZE) -> list[tuple[str, str, str]]:
+    """
+    extract_critique_by_format のバッチ版。
+    全テキストの問題部・解決策部の節を先に集め、nlp.pipe でまとめて解析してから
+    各テキストの ('problem', 'solution_verb', 'solution_obj') に戻す。
+    """
+    if not nlp:
+        print("spaCyのモデルがロードされていません。")
+        return [UNKNOWN_TRIPLE] * len(texts)
+
+    # 解析する節と、各テキストの節がそこに含まれているか (空の節は解析しない)
+    clauses = []
+    slots = []
+    for text in texts:
+        split = split_critique(text)
+        if split is None:
+            slots.append(None)
+            continue
+        slot = []
+        for clause in split:
+            slot.append(bool(clause))
+            if clause:
+                clauses.append(clause)
+        slots.append(slot)
+
+    # parse_cache.pipe は入力順に Doc を返すので、節を集めた順に取り出せばよい
+    docs = iter(parse_cache.pipe(clauses, batch_size=batch_size))
+    results = []
+    for slot in slots:
+        if slot is None:
+            results.append(UNKNOWN_TRIPLE)
+            continue
+        doc_problem, doc_solution = (next(docs) if has_clause else None for has_clause in slot)
+        results.append(critique_from_docs(doc_problem, doc_solution))
+
+    return results
+
+def extract_triples(texts: list[str], mode: str = EXTRACTION_MODE) -> list[tuple[str, str, str]]:
+    """mode に応じてテキストのリストから ('problem', 'solution_verb', 'solution_obj') を抽出する"""
+    if mode == 'batch':
+        return extract_critiques_batch(texts)
+    elif mode == 'apply':
+        return [extract_critique_by_format(text) for text in texts]
+    raise ValueError(f"無効な抽出モードです: '{mode}'。'batch' または 'apply' を指定してください。")
+
+def extract_long(df: pd.DataFrame, mode: str = EXTRACTION_MODE) -> pd.DataFrame:
+    """
+    ロングフォーマット (1コメント1行) の text 列から抽出した problem, solution_verb, solution_obj 列を持つ
+    DataFrame を返す (インデックスは df と同じ)。
+    """
+    triples = extract_triples(df['text'].tolist(), mode)
+    get_normalizer().flush()
+    return pd.DataFrame(triples, index=df.index, columns=['problem', 'solution_verb', 'solution_obj'], dtype=object)
+
+def extract_comment_columns(df: pd.DataFrame, mode: str = EXTRACTION_MODE) -> pd.DataFrame:
+    """
+    comment{i}_text 列から抽出した comment{i}_problem, comment{i}_solution_verb,
+    comment{i}_solution_obj 列を持つ DataFrame を返す (インデックスは df と同じ)。
+    """
+    text_cols = []
+    out_cols = []
+    for i in COMMENT_INDICES:
+        comment_col = f'comment{i}_text'
+        if comment_col in df.columns:
+            text_cols.append(comment_col)
+            out_cols += [f'comment{i}_problem', f'comment{i}_solution_verb', f'comment{i}_solution_obj']
+        else:
+            print(f"Warning: Could not find column '{comment_col}' in the DataFrame. Skipping extraction for this comment.")
+
+    # 列ごとに (comment1 の全行, comment2 の全行, ...) の順で並べる
+    texts = df[text_cols].to_numpy(dtype=object).ravel(order='F').tolist()
+    triples = extract_triples(texts, mode)
+    get_normalizer().flush()
+
+    # (列, 行, 3) -> (行, 列 * 3) に並べ替えて元の行に戻す
+    values = np.array(triples, dtype=object).reshape(len(text_cols), len(df), 3)
+    values = values.transpose(1, 0, 2).reshape(len(df), len(out_cols))
+    return pd.DataFrame(values, index=df.index, columns=out_cols)
+
 # --- テスト実行 ---
 # text1 = "In the current design, the texts are too small and difficult to read. To fix this, increase font size and weight to make it easier to read."
 # text2 = "In the current design, the login button appears twice with slightly different labels. To fix this, one button is labeled login and the other button has the Facebook logo and is labeled login"
@@ -180,30 +306,46 @@ def extract_critique_by_format(text: str) -> tuple[str, str, str]:
 # print(f"入力5: {text5}\n出力5: {extract_critique_by_format(text5)}")
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="id の範囲で入力を分割して並列に抽出するプロセス数 (既定: 1)")
+    parser.add_argument('--no-parse-cache', action='store_true',
+                        help="spaCy の解析結果のキャッシュを使わずに全て解析し直す")
+    parser.add_argument('--long', action='store_true',
+                        help=f"ロングフォーマットの '{LONG_INPUT_PATH}' から 1コメント1行で '{LONG_OUTPUT_PATH}' に抽出する")
+    args = parser.parse_args()
+    if args.no_parse_cache:
+        os.environ['BDA_PARSE_CACHE'] = '0'
+
+    input_path = LONG_INPUT_PATH if args.long else INPUT_PATH
     try:
-        df = pd.read_csv(INPUT_CSV)
+        df = read_table(input_path)
     except FileNotFoundError:
-        print(f"エラー: {INPUT_CSV} が見つかりません。")
+        print(f"エラー: {input_path} が見つかりません。")
+        return
+
+    if args.long:
+        # (id, comment_number) ごとに problem, solution_verb, solution_obj を抽出
+        extracted = map_shards(df, extract_long, workers=args.workers)
+        df = pd.concat([df[['id', 'comment_number']], extracted], axis=1)
+        write_table(df, LONG_OUTPUT_PATH)
+        print(f"抽出結果を {LONG_OUTPUT_PATH} に保存しました。")
+        run_report.print_report()
         return
 
     # 'comments' カラムから問題、動詞、目的語を抽出
-    # comment1_text, comment2_text, comment3_text, comment4_text, comment5_text, comment6_text, comment7_text についてそれぞれ extract_critique_by_format を実行し, comment1_problem, comment1_solution_verb, comment1_solution_obj などの新しいカラムを作成
-    for i in range(1, 8):
-        comment_col = f'comment{i}_text'
-        if comment_col in df.columns:
-            df[[f'comment{i}_problem', f'comment{i}_solution_verb', f'comment{i}_solution_obj']] = df[comment_col].apply(
-                lambda text: pd.Series(extract_critique_by_format(text))
-            )
-        else:
-            print(f"Warning: Could not find column '{comment_col}' in the DataFrame. Skipping extraction for this comment.")
+    # comment1_text, ..., comment7_text から comment1_problem, comment1_solution_verb, comment1_solution_obj などの新しいカラムをまとめて作成
+    extracted = map_shards(df, extract_comment_columns, workers=args.workers)
+    df[extracted.columns] = extracted
 
     # drop comment1_type, comment1_text, ..., comment7_type, comment7_text
-    for i in range(1, 8):
+    for i in COMMENT_INDICES:
         df.drop(columns=[f'comment{i}_type', f'comment{i}_text'], errors='ignore', inplace=True)
 
-    # 結果を新しいCSVファイルに保存
-    df.to_csv(OUTPUT_CSV, index=False)
-    print(f"抽出結果を {OUTPUT_CSV} に保存しました。")
+    # 結果を保存
+    write_table(df, OUTPUT_PATH)
+    print(f"抽出結果を {OUTPUT_PATH} に保存しました。")
+    run_report.print_report()
     
 if __name__ == '__main__':
     main()
\ No newline at end of file
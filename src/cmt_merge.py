@@ -4,39 +4,41 @@
 
 import pandas as pd
 
+from storage import read_table, write_table
+
 # --- 設定項目 ---
 # 入力ファイルのパス
 FILE_PATHS = {
-    'long_comments': 'dataset_for_bda/comments_long_clustered.csv',
+    'long_comments': 'dataset_for_bda/comments_long_clustered.parquet',
     'public_data': 'dataset_modified/uicrit_public_with_id.csv',
     'task_category': 'dataset_modified/uicrit_id_task_category.csv',
     'comments_category': 'dataset_modified/uicrit_id_comments_category.csv'
 }
 
 # マージ後のデータを保存するファイル名
-OUTPUT_CSV = 'dataset_for_bda/merged_comments_with_ratings.csv'
+OUTPUT_PATH = 'dataset_for_bda/merged_comments_with_ratings.parquet'
 
 
 def merge_all_csv_files(file_paths: dict, output_file: str):
     """
-    複数のCSVファイルをidをキーとしてマージし、一つのファイルに保存する。
+    複数のファイルをidをキーとしてマージし、一つのファイルに保存する。
     """
     dataframes = []
-    print("CSVファイルを読み込んでいます...")
+    print("ファイルを読み込んでいます...")
     try:
         # ベースとなるロングフォーマットのコメントデータ
-        df_long = pd.read_csv(file_paths['long_comments'])
+        df_long = read_table(file_paths['long_comments'])
         print(f"- '{file_paths['long_comments']}' を読み込みました。 Shape: {df_long.shape}")
         
         # public_dataから不要な 'comments' 列を削除して読み込み
-        df_public = pd.read_csv(file_paths['public_data']).drop(columns=['comments'], errors='ignore')
+        df_public = read_table(file_paths['public_data']).drop(columns=['comments'], errors='ignore')
         print(f"- '{file_paths['public_data']}' を読み込みました。 Shape: {df_public.shape}")
 
         # その他のカテゴリデータ
-        df_task_cat = pd.read_csv(file_paths['task_category'])
+        df_task_cat = read_table(file_paths['task_category'])
         print(f"- '{file_paths['task_category']}' を読み込みました。 Shape: {df_task_cat.shape}")
 
-        df_comments_cat = pd.read_csv(file_paths['comments_category'])
+        df_comments_cat = read_table(file_paths['comments_category'])
         print(f"- '{file_paths['comments_category']}' を読み込みました。 Shape: {df_comments_cat.shape}")
 
         # マージするデータフレームのリストを作成
@@ -77,7 +79,7 @@ def merge_all_csv_files(file_paths: dict, output_file: str):
         final_order = first_cols + comment_cols + rating_cols + other_cols
         merged_df = merged_df[final_order]
 
-        merged_df.to_csv(output_file, index=False)
+        write_table(merged_df, output_file)
         
         print(f"\n処理が完了しました。統合されたデータを '{output_file}' に保存しました。")
         print(f"最終的なデータのShape: {merged_df.shape}")
@@ -89,4 +91,4 @@ def merge_all_csv_files(file_paths: dict, output_file: str):
 
 
 if __name__ == '__main__':
-    merge_all_csv_files(FILE_PATHS, OUTPUT_CSV)
\ No newline at end of file
+    merge_all_csv_files(FILE_PATHS, OUTPUT_PATH)
\ No newline at end of file
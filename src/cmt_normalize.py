@@ -1,85 +1,128 @@
+import argparse
 import pandas as pd
+import numpy as np
 import re
-import os
+
+from storage import TableWriter
 
 # --- 設定値 ---
 INPUT_CSV = 'dataset_modified/uicrit_id_comments.csv'
-OUTPUT_CSV = 'dataset_for_bda/comments_normalized.csv'
-# 抽出するコメントの最大数
+OUTPUT_PATH = 'dataset_for_bda/comments_normalized.parquet'
+# ロングフォーマット (1コメント1行, コメント数の上限なし) の出力先
+LONG_OUTPUT_PATH = 'dataset_for_bda/comments_normalized_long.parquet'
+# ワイドフォーマットで抽出するコメントの最大数
 MAX_COMMENTS = 7
+# 一度に読み込んで処理する行数 (メモリ使用量はこの行数分で一定になる)
+CHUNK_SIZE = 1000
+
+# 'comments'カラムの文字列から各コメントを取り出す正規表現
+COMMENT_PATTERN = re.compile(r"((?:LLM\s)?Comment\s\d.*?(?:Bounding Box:.*?\]))", re.DOTALL)
+# コメント末尾のバウンディングボックス
+BOUNDING_BOX_PATTERN = re.compile(r"Bounding Box:\s*\[([^\]]*)\]")
 
-# --- メイン処理 ---
-try:
-    # 1. CSVファイルをDataFrameとして読み込む
-    df = pd.read_csv(INPUT_CSV)
-
-    # 2. コメント文字列をパースして分割する関数を定義
-    def parse_comments(comment_string):
-        """
-        'comments'カラムの文字列から各コメントを抽出し、
-        タイプとテキストに分割してSeriesオブジェクトとして返す。
-        """
-        pattern = r"((?:LLM\s)?Comment\s\d.*?(?:Bounding Box:.*?\]))"
-        comments = re.findall(pattern, str(comment_string), re.DOTALL)
-        
-        extracted_data = {}
-        for i, comment_text in enumerate(comments):
-            if i >= MAX_COMMENTS:
-                break
-            
+
+def parse_comments(ids, comment_strings) -> dict[str, list]:
+    """
+    'comments'カラムの文字列から各コメントを抽出し、
+    (id, 行番号, コメント番号, タイプ, テキスト, バウンディングボックス) のレコードを
+    カラムごとのリストにまとめて返す。
+    """
+    records = {'id': [], 'row': [], 'comment_number': [], 'type': [], 'text': [], 'bounding_box': []}
+    for row, (comment_id, comment_string) in enumerate(zip(ids, comment_strings)):
+        for i, comment_text in enumerate(COMMENT_PATTERN.findall(str(comment_string))):
             cleaned_comment = comment_text.strip().strip("'\"").strip()
             parts = cleaned_comment.split('\\n', 1)
-            
-            print("parts", parts)
-            
-            # --- ここからが修正箇所 ---
+
             raw_type_header = parts[0].strip()
             comment_body = parts[1].strip() if len(parts) > 1 else ""
-            
+            bounding_box = BOUNDING_BOX_PATTERN.search(comment_body)
+
+            records['id'].append(comment_id)
+            records['row'].append(row)
+            records['comment_number'].append(i + 1)
             # コメントのタイプを 'human' または 'llm' に分類
-            if raw_type_header.startswith("LLM"):
-                comment_type = "llm"
-            else:
-                comment_type = "human"
-            # --- ここまでが修正箇所 ---
-            
-            extracted_data[f'comment{i+1}_type'] = comment_type
-            extracted_data[f'comment{i+1}_text'] = comment_body
-            
-        return pd.Series(extracted_data)
-
-    # 3. 'comments'カラムの各行に関数を適用し、新しいDataFrameを作成
-    comments_df = df['comments'].apply(parse_comments)
-
-    # 4. 新しいカラム名を定義
-    new_columns = []
+            records['type'].append("llm" if raw_type_header.startswith("LLM") else "human")
+            records['text'].append(comment_body)
+            records['bounding_box'].append(bounding_box.group(1).strip() if bounding_box else None)
+
+    return records
+
+
+def wide_columns() -> list[str]:
+    """comment1_type, comment1_text, ..., commentN_type, commentN_text"""
+    columns = []
     for i in range(1, MAX_COMMENTS + 1):
-        new_columns.append(f'comment{i}_type')
-        new_columns.append(f'comment{i}_text')
+        columns.append(f'comment{i}_type')
+        columns.append(f'comment{i}_text')
+    return columns
+
+
+def records_to_wide(ids, records: dict[str, list]) -> pd.DataFrame:
+    """
+    レコードを id ごとに comment{i}_type / comment{i}_text の列へ並べ直す。
+    MAX_COMMENTS を超えるコメントは含めない。
+    """
+    values = np.full((len(ids), 2 * MAX_COMMENTS), np.nan, dtype=object)
+    rows = np.asarray(records['row'], dtype=np.int64)
+    numbers = np.asarray(records['comment_number'], dtype=np.int64)
+    keep = numbers <= MAX_COMMENTS
+    rows, slots = rows[keep], 2 * (numbers[keep] - 1)
+    values[rows, slots] = np.asarray(records['type'], dtype=object)[keep]
+    values[rows, slots + 1] = np.asarray(records['text'], dtype=object)[keep]
+
+    wide = pd.DataFrame(values, columns=wide_columns())
+    wide.insert(0, 'id', np.asarray(ids))
+    return wide
+
+
+def records_to_long(records: dict[str, list]) -> pd.DataFrame:
+    """レコードを (id, comment_number) をキーとする 1コメント1行の DataFrame にする"""
+    return pd.DataFrame({
+        'id': records['id'],
+        'comment_number': records['comment_number'],
+        'type': records['type'],
+        'text': records['text'],
+        'bounding_box': records['bounding_box'],
+    })
+
 
-    # 不足しているカラムをNaNで埋める
-    comments_df = comments_df.reindex(columns=new_columns)
+def normalize_comments(input_file: str, output_file: str, chunk_size: int = CHUNK_SIZE, long_format: bool = False) -> int:
+    """
+    input_file を chunk_size 行ずつ読み込んでコメントを分割し、結果を output_file (Parquet) に追記していく。
+    long_format=True の場合はコメント数の上限なしで 1コメント1行のロングフォーマットで出力する。
+    処理した行数を返す。
+    """
+    n_rows = 0
+    with TableWriter(output_file) as writer:
+        for chunk in pd.read_csv(input_file, chunksize=chunk_size):
+            ids = chunk['id'].to_numpy()
+            records = parse_comments(ids, chunk['comments'].to_numpy())
+            result_df = records_to_long(records) if long_format else records_to_wide(ids, records)
+            writer.write(result_df)
 
-    # 5. 元の'id'カラムと、新しく作成したコメントのDataFrameを結合
-    result_df = pd.concat([df['id'], comments_df], axis=1)
+            if n_rows == 0:
+                print("\n--- 出力データの先頭5行 ---")
+                print(result_df.head())
+                print("\n-------------------------------------------------------------")
+            n_rows += len(chunk)
 
-    # 6. 出力先のディレクトリが存在しない場合は作成
-    output_dir = os.path.dirname(OUTPUT_CSV)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    return n_rows
 
-    # 7. 結果を新しいCSVファイルに保存
-    result_df.to_csv(OUTPUT_CSV, index=False, encoding='utf-8')
 
-    print(f"✅ 処理が正常に完了しました。")
-    print(f"出力ファイル: {OUTPUT_CSV}")
-    print("\n--- 出力データの先頭5行 (id=3 のタイプが 'llm' になっています) ---")
-    print(result_df.head())
-    print("\n-------------------------------------------------------------")
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="コメント文字列を個々のコメントに分割する")
+    parser.add_argument('--long', action='store_true',
+                        help=f"1コメント1行のロングフォーマットで '{LONG_OUTPUT_PATH}' に出力する (コメント数の上限なし)")
+    args = parser.parse_args()
+    output_path = LONG_OUTPUT_PATH if args.long else OUTPUT_PATH
 
+    try:
+        n_rows = normalize_comments(INPUT_CSV, output_path, long_format=args.long)
+        print(f"✅ 処理が正常に完了しました。({n_rows} 行)")
+        print(f"出力ファイル: {output_path}")
 
-except FileNotFoundError:
-    print(f"❌ エラー: 入力ファイルが見つかりません。パスを確認してください: {INPUT_CSV}")
-except Exception as e:
-    print(f"❌ エラー: 処理中に問題が発生しました。")
-    print(e)
\ No newline at end of file
+    except FileNotFoundError:
+        print(f"❌ エラー: 入力ファイルが見つかりません。パスを確認してください: {INPUT_CSV}")
+    except Exception as e:
+        print(f"❌ エラー: 処理中に問題が発生しました。")
+        print(e)
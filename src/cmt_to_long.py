@@ -2,27 +2,70 @@
 コメントをロングフォーマットに変換する
 """
 
+import argparse
 import pandas as pd
 import sys
 import re
 
+from storage import read_table, write_table
+
 # --- 設定 ---
-# 変換したいCSVファイル名
-INPUT_CSV = 'dataset_for_bda/comments_clustered.csv'
-# 保存するCSVファイル名
-OUTPUT_CSV = 'dataset_for_bda/comments_long_clustered.csv'
-def transform_to_long_format(input_file: str, output_file: str):
+# 変換したいファイル名
+INPUT_PATH = 'dataset_for_bda/comments_clustered.parquet'
+# 保存するファイル名
+OUTPUT_PATH = 'dataset_for_bda/comments_long_clustered.parquet'
+# 既にロングフォーマットの入力 (cmt_clustering.py --long の出力)
+LONG_INPUT_PATH = 'dataset_for_bda/comments_clustered_long.parquet'
+
+def transform_to_long_format(input_file: str, output_file: str, long_input: bool = False):
     """
-    ワイドフォーマットのCSVを読み込み、ロングフォーマットに変換して保存する。
+    ワイドフォーマットのデータを読み込み、ロングフォーマットに変換して保存する。
+    long_input=True の場合は入力が既に 1コメント1行なので変換は行わない。
     problem, verb, obj のいずれかが 'unknown' のコメントは除外する。
     """
     try:
-        df = pd.read_csv(input_file)
+        df = read_table(input_file)
     except FileNotFoundError:
         print(f"エラー: 入力ファイル '{input_file}' が見つかりません。")
         return
 
-    # 1. カラム名を wide_to_long が解釈できる形式にリネーム
+    # 1. 1コメント1行のロングフォーマットにする
+    if long_input:
+        long_df = df.rename(columns={'solution_verb': 'verb', 'solution_obj': 'obj'})
+    else:
+        long_df = wide_to_long(df)
+        if long_df is None:
+            return
+    # どちらの入力でも同じ順 (id, コメント番号の順) で出力する
+    long_df = long_df.sort_values(['id', 'comment_number'], kind='stable', ignore_index=True)
+
+    # 2. problem, verb, obj のいずれかが 'unknown' の行を削除
+    condition = (
+        (long_df['problem'] != 'unknown') &
+        (long_df['verb'] != 'unknown') &
+        (long_df['obj'] != 'unknown')
+    )
+    filtered_df = long_df[condition].copy()
+
+    # 3. 最終的なカラムを選択・リネームして保存
+    final_df = filtered_df[['id', 'problem', 'verb', 'obj']]
+    final_df.rename(columns={
+        'problem': 'comment_problem',
+        'verb': 'comment_verb',
+        'obj': 'comment_obj'
+    }, inplace=True)
+
+    write_table(final_df, output_file)
+    print(f"処理が完了しました。ロングフォーマットのデータを '{output_file}' に保存しました。")
+    print(f"変換前の有効なコメント数: {len(long_df)}, 'unknown'を除外した後のコメント数: {len(final_df)}")
+
+
+def wide_to_long(df: pd.DataFrame) -> pd.DataFrame | None:
+    """
+    comment{i}_problem, comment{i}_solution_verb, comment{i}_solution_obj 列を
+    (id, comment_number, problem, verb, obj) の縦長の DataFrame に変換する。
+    """
+    # カラム名を wide_to_long が解釈できる形式にリネーム
     # 例: 'comment1_problem' -> 'problem_1'
     # 例: 'comment1_solution_verb' -> 'verb_1'
     # 例: 'comment1_solution_obj' -> 'obj_1'
@@ -37,7 +80,7 @@ def transform_to_long_format(input_file: str, output_file: str):
     
     df.rename(columns=rename_map, inplace=True)
 
-    # 2. pd.wide_to_long を使ってデータを縦長に変換
+    # pd.wide_to_long を使ってデータを縦長に変換
     try:
         long_df = pd.wide_to_long(
             df,
@@ -50,29 +93,19 @@ def transform_to_long_format(input_file: str, output_file: str):
     except ValueError as e:
         print(f"エラー: wide_to_longの変換に失敗しました。カラム名が期待通りでない可能性があります。")
         print(e)
-        return
-
-    # 3. problem, verb, obj のいずれかが 'unknown' の行を削除
-    condition = (
-        (long_df['problem'] != 'unknown') &
-        (long_df['verb'] != 'unknown') &
-        (long_df['obj'] != 'unknown')
-    )
-    filtered_df = long_df[condition].copy()
+        return None
 
-    # 4. 最終的なカラムを選択・リネームして保存
-    final_df = filtered_df[['id', 'problem', 'verb', 'obj']]
-    final_df.rename(columns={
-        'problem': 'comment_problem',
-        'verb': 'comment_verb',
-        'obj': 'comment_obj'
-    }, inplace=True)
-
-    final_df.to_csv(output_file, index=False)
-    print(f"処理が完了しました。ロングフォーマットのデータを '{output_file}' に保存しました。")
-    print(f"変換前の有効なコメント数: {len(long_df)}, 'unknown'を除外した後のコメント数: {len(final_df)}")
+    return long_df
 
 
 if __name__ == '__main__':
-    # 上記のINPUT_CSVとOUTPUT_CSVを実際のファイル名に書き換えて実行してください
-    transform_to_long_format(INPUT_CSV, OUTPUT_CSV)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="コメントをロングフォーマットに変換する")
+    parser.add_argument('--long', action='store_true',
+                        help=f"既にロングフォーマットの '{LONG_INPUT_PATH}' を入力にする (変換は行わず、フィルタのみ)")
+    args = parser.parse_args()
+
+    # 上記のINPUT_PATHとOUTPUT_PATHを実際のファイル名に書き換えて実行してください
+    if args.long:
+        transform_to_long_format(LONG_INPUT_PATH, OUTPUT_PATH, long_input=True)
+    else:
+        transform_to_long_format(INPUT_PATH, OUTPUT_PATH)
\ No newline at end of file
@@ -1,8 +1,10 @@
 import pandas as pd
 
+from storage import read_table, write_table
+
 # --- 設定項目 ---
 # 修正対象のファイル
-TARGET_CSV = 'dataset_for_bda/merged_comments_with_ratings.csv'
+TARGET_PATH = 'dataset_for_bda/merged_comments_with_ratings.parquet'
 # 正しい'learnability'の値が含まれるソースファイル
 SOURCE_CSV = 'uicrit_public.csv'
 
@@ -13,8 +15,8 @@ def fix_learnability_column(target_file: str, source_file: str):
     """
     print("データ修正プロセスを開始します...")
     try:
-        # 1. 修正対象とソースのCSVファイルを読み込む
-        df_target = pd.read_csv(target_file)
+        # 1. 修正対象とソースのファイルを読み込む
+        df_target = read_table(target_file)
         df_source = pd.read_csv(source_file)
         print(f"'{target_file}' と '{source_file}' を正常に読み込みました。")
 
@@ -46,7 +48,7 @@ def fix_learnability_column(target_file: str, source_file: str):
             print("\n更新対象のデータが見つかりませんでした。")
 
         # 6. 修正後のファイルを上書き保存
-        df_target.to_csv(target_file, index=False)
+        write_table(df_target, target_file)
         print(f"\n修正が完了しました。'{target_file}' は正常に更新されました。")
         print(f"\n修正後の '{target_file}' の 'learnability' の統計情報:\n{df_target['learnability'].describe()}")
 
@@ -57,4 +59,4 @@ def fix_learnability_column(target_file: str, source_file: str):
         print(f"\n予期せぬエラーが発生しました: {e}")
 
 if __name__ == '__main__':
-    fix_learnability_column(TARGET_CSV, SOURCE_CSV)
\ No newline at end of file
+    fix_learnability_column(TARGET_PATH, SOURCE_CSV)
\ No newline at end of file
@@ -1,28 +1,30 @@
 import pandas as pd
 import os
 
-# 統合するCSVファイルのパスをリストにまとめます
+from storage import read_table, write_table
+
+# 統合するファイルのパスをリストにまとめます
 file_paths = [
     'dataset_modified/uicrit_public_with_id.csv',
     'dataset_modified/uicrit_id_task_category.csv',
     'dataset_modified/uicrit_id_comments_category.csv',
-    'dataset_for_bda/comments_extracted.csv',
-    'dataset_for_bda/tasks_extracted.csv'
+    'dataset_for_bda/comments_extracted.parquet',
+    'dataset_for_bda/tasks_extracted_chunk_corrected.parquet'
 ]
 
 # 出力先のディレクトリが存在しない場合に作成します
 output_dir = 'dataset_for_bda'
 os.makedirs(output_dir, exist_ok=True)
-output_path = os.path.join(output_dir, 'merged2.csv')
+output_path = os.path.join(output_dir, 'merged2.parquet')
 
 try:
     # 最初のCSVファイルをベースとして読み込みます
-    merged_df = pd.read_csv(file_paths[0])
+    merged_df = read_table(file_paths[0])
 
     # 残りのCSVファイルを順番にマージします
     for file in file_paths[1:]:
         try:
-            df_to_merge = pd.read_csv(file)
+            df_to_merge = read_table(file)
             # 'id'カラムをキーとして、左結合（left merge）でマージします
             # これにより、ベースのDataFrameの全レコードが保持されます
             merged_df = pd.merge(merged_df, df_to_merge, on='id', how='left')
@@ -38,8 +40,8 @@ try:
     merged_df['verb'] = pd.factorize(merged_df['verb'])[0]
     merged_df['obj'] = pd.factorize(merged_df['obj'])[0]
 
-    # マージしたDataFrameを新しいCSVファイルとして保存します
-    merged_df.to_csv(output_path, index=False)
+    # マージしたDataFrameを保存します
+    write_table(merged_df, output_path)
 
     print(f"ファイルの統合が完了しました: {output_path}")
     print("\n統合後のファイルの先頭5行:")
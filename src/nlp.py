@@ -1,17 +1,34 @@
+import argparse
+import os
+from functools import partial
+
 import pandas as pd
 import spacy
 from sklearn.feature_extraction.text import TfidfVectorizer
-from spellchecker import SpellChecker
 import inflect
 
+import run_report
+from parse_cache import ParseCache
+from sharding import map_shards
+from spelling import SpellCorrector
+from storage import read_table, write_table
+from token_norm import get_normalizer
+
 # --- 設定 ---
 # INPUT_CSV = 'dataset_modified/uicrit_id_task.csv'
-# OUTPUT_CSV = 'dataset_for_bda/tasks_extracted_chunk.csv'
+# OUTPUT_PATH = 'dataset_for_bda/tasks_extracted_chunk.parquet'
 INPUT_CSV = 'dataset_modified/uicrit_id_task_corrected.csv'
-OUTPUT_CSV = 'dataset_for_bda/tasks_extracted_chunk_corrected.csv'
+OUTPUT_PATH = 'dataset_for_bda/tasks_extracted_chunk_corrected.parquet'
 STOP_VERBS = {'click', 'view', 'go'}
 SIMPLIFICATION_METHOD = 'IDF'
 
+# 各プロセスで一度だけロードする spaCy モデルと inflect エンジン (load_models で初期化)
+# nlp は解析結果をキャッシュする ParseCache でラップしたもの
+nlp = None
+p = None
+# スペル修正 (辞書と索引の読み込みに時間がかかるので、最初に使うときに一度だけ作る)
+spell_corrector = None
+
 def cleans(text):
     """
     テキストから引用符や不要な句読点を削除し、フォーマットを整える関数
@@ -25,13 +42,16 @@ def singularize_nouns(text, nlp_processor, p_engine):
     if not isinstance(text, str):
         return text
     
-    doc = nlp_processor(text)
+    return singularize_doc(nlp_processor(text), p_engine)
+
+def singularize_doc(doc, p_engine):
+    """解析済みの Doc の名詞を単数形にした文を返す (singularize_nouns の本体)"""
     new_sentence = []
     for token in doc:
         # 品詞が名詞(NOUN)または固有名詞(PROPN)の場合のみ処理
         if token.pos_ in ('NOUN', 'PROPN'):
-            # inflectを使って単数形に変換 (変換できなければ元の単語を返す)
-            singular = p_engine.singular_noun(token.text)
+            # inflectを使って単数形に変換 (変換できなければ元の単語を返す, 結果は token_norm でメモする)
+            singular = get_normalizer().singular(token.text, token.pos_, p_engine)
             new_sentence.append(singular or token.text)
         else:
             new_sentence.append(token.text)
@@ -39,19 +59,16 @@ def singularize_nouns(text, nlp_processor, p_engine):
     # 処理後のトークンを再度結合し、余分なスペースを削除
     return " ".join(new_sentence).replace(" 's", "'s")
 
+def get_spell_corrector():
+    """このプロセスで共有する SpellCorrector を返す"""
+    global spell_corrector
+    if spell_corrector is None:
+        spell_corrector = SpellCorrector()
+    return spell_corrector
+
 def correct_spelling(text):
-    spell = SpellChecker()
-    # テキストを単語に分割
-    words = text.split()
-    # 未知の単語（=タイポの可能性）を見つける
-    # misspelled = spell.unknown(words)
-    
-    corrected_text = []
-    for word in words:
-        # タイポがあれば修正し、なければ元の単語を使う
-        corrected_text.append(spell.correction(word) or word)
-        
-    return " ".join(corrected_text)
+    """単語ごとにタイポを修正する (辞書にある単語はそのまま)"""
+    return get_spell_corrector().correct(text)
 
 def extract_verb_obj(text, nlp_processor):
     """
@@ -61,8 +78,20 @@ def extract_verb_obj(text, nlp_processor):
     if not isinstance(text, str):
         return None, None
 
-    doc = nlp_processor(text)
-    
+    return verb_obj_phrase(nlp_processor(text))
+
+def verb_obj_phrase(doc):
+    """解析済みの Doc から (動詞の原形, 目的語フレーズ) を返す。見つからなければ (None, None)"""
+    verb, obj_head = find_verb_obj(doc)
+    if obj_head is None:
+        return None, None
+    return verb, " ".join(t.text for t in obj_head.subtree)
+
+def find_verb_obj(doc):
+    """
+    解析済みの Doc から (動詞の原形, 目的語の主辞トークン) を探す (extract_verb_obj の本体)。
+    目的語のフレーズは主辞トークンの subtree。見つからなければ (None, None)。
+    """
     all_verbs = [token for token in doc if token.pos_ == 'VERB']
     num_verbs = len(all_verbs)
     # print("all_verbs", [v.lemma_ for v in all_verbs])
@@ -95,7 +124,7 @@ def extract_verb_obj(text, nlp_processor):
         # 1. 直接目的語(dobj)を探す
         dobj = next((child for child in verb.children if child.dep_ == 'dobj'), None)
         if dobj:
-            return verb.lemma_, " ".join(t.text for t in dobj.subtree)
+            return verb.lemma_, dobj
         
         # 2. 動詞句の補語(xcomp)の中の目的語を探す 【新規追加】
         xcomp = next((child for child in verb.children if child.dep_ == 'xcomp' and child.pos_ == 'VERB'), None)
@@ -103,14 +132,14 @@ def extract_verb_obj(text, nlp_processor):
             dobj_in_xcomp = next((child for child in xcomp.children if child.dep_ == 'dobj'), None)
             if dobj_in_xcomp:
                 # 動詞はxcompの方(例: following)を採用する
-                return xcomp.lemma_, " ".join(t.text for t in dobj_in_xcomp.subtree)
+                return xcomp.lemma_, dobj_in_xcomp
 
         # 3. (フォールバック) 前置詞の目的語(pobj)を探す
         prep = next((child for child in verb.children if child.dep_ == 'prep'), None)
         if prep:
             pobj = next((child for child in prep.children if child.dep_ == 'pobj'), None)
             if pobj:
-                return verb.lemma_, " ".join(t.text for t in pobj.subtree)
+                return verb.lemma_, pobj
     
     return None, None
 
@@ -119,22 +148,27 @@ def get_rarest_noun_by_idf(text, nlp_processor, idf_scores):
     if not isinstance(text, str) or not idf_scores:
         return None
         
-    doc = nlp_processor(text)
+    return rarest_noun(phrase_nouns(nlp_processor(text)), idf_scores)
+
+def phrase_nouns(doc):
+    """Doc の名詞・固有名詞の原形 (小文字) のリスト"""
+    return [token.lemma_.lower() for token in doc if token.pos_ in ('NOUN', 'PROPN')]
+
+def rarest_noun(nouns, idf_scores):
+    """名詞の原形 (小文字) のリストから IDF スコアが最も高いものを返す (どれもスコアがなければ最後の名詞)"""
     rarest_word = None
     max_idf = -1.0
-    nouns = [token for token in doc if token.pos_ in ('NOUN', 'PROPN')]
     
     if not nouns:
         return None
 
-    for token in nouns:
-        word = token.lemma_.lower()
+    for word in nouns:
         if word in idf_scores and idf_scores[word] > max_idf:
             max_idf = idf_scores[word]
             rarest_word = word
     
     if rarest_word is None:
-        return nouns[-1].lemma_.lower()
+        return nouns[-1]
 
     return rarest_word
 
@@ -143,7 +177,10 @@ def get_noun_chunk_root(text, nlp_processor):
     if not isinstance(text, str):
         return None
         
-    doc = nlp_processor(text)
+    return noun_chunk_root(nlp_processor(text))
+
+def noun_chunk_root(doc):
+    """Doc (または Span) の最後の名詞句の中心単語、名詞句がなければ最後の名詞の原形を返す"""
     for chunk in reversed(list(doc.noun_chunks)):
         return chunk.root.lemma_
     
@@ -153,10 +190,109 @@ def get_noun_chunk_root(text, nlp_processor):
         
     return None
 
+def load_models():
+    """
+    spaCyモデルとinflectエンジンをこのプロセスで一度だけロードする。
+    --workers 指定時は各ワーカープロセスの初期化処理としても呼ばれる。
+    """
+    global nlp, p
+    if nlp is None:
+        nlp = ParseCache(spacy.load('en_core_web_sm'))
+    if p is None:
+        p = inflect.engine() # inflectエンジンを初期化
+
+def extract_tasks(df: pd.DataFrame, spell: bool = False) -> pd.DataFrame:
+    """タスク文をクリーニング・(spell=True ならスペル修正・)単数形化し、動詞と目的語フレーズの列を追加する"""
+    df = df.copy()
+    texts = df['task'].apply(cleans)
+    if spell:
+        texts = get_spell_corrector().correct_column(texts)
+    df['task'] = texts.apply(lambda text: singularize_nouns(text, nlp, p))
+    df[['verb', 'obj']] = df['task'].apply(lambda text: pd.Series(extract_verb_obj(text, nlp)))
+    get_normalizer().flush()
+    return df
+
+def simplify_objects(df: pd.DataFrame, idf_scores: dict | None = None) -> pd.DataFrame:
+    """目的語フレーズを SIMPLIFICATION_METHOD の方式で一単語に単純化する"""
+    df = df.copy()
+    if SIMPLIFICATION_METHOD == 'IDF':
+        df['obj'] = df['obj'].apply(lambda text: get_rarest_noun_by_idf(text, nlp, idf_scores))
+    else:
+        df['obj'] = df['obj'].apply(lambda text: get_noun_chunk_root(text, nlp))
+    return df
+
+def extract_tasks_piped(df: pd.DataFrame, spell: bool = False) -> pd.DataFrame:
+    """
+    extract_tasks と同じ列を、行ごとの apply ではなく nlp.pipe でまとめて解析して作る。
+    解析は1回ではない: タスク文を解析して単数形化し、単数形化で文が変わったタスクは単数形の文を解析し直す
+    (extract_tasks と同じく、動詞と目的語は単数形の文の解析から取る)。
+    目的語の単純化も simplify_objects と同じく目的語フレーズだけを解析した結果を使うので、
+    重複を除いた目的語フレーズをここでまとめて解析し、'_obj_nouns' と '_obj_root' の列に入れておく
+    (simplify_piped_objects で使う)。結果は extract_tasks + simplify_objects と同じになる。
+    """
+    df = df.copy()
+    texts = df['task'].apply(cleans)
+    if spell:
+        texts = get_spell_corrector().correct_column(texts)
+    is_text = texts.apply(lambda text: isinstance(text, str))
+    cleaned = texts[is_text].tolist()
+
+    docs = list(nlp.pipe(cleaned))
+    singular = [singularize_doc(doc, p) for doc in docs]
+    changed = [i for i, (before, after) in enumerate(zip(cleaned, singular)) if before != after]
+    for i, doc in zip(changed, nlp.pipe([singular[i] for i in changed])):
+        docs[i] = doc
+    verb_objs = [verb_obj_phrase(doc) for doc in docs]
+
+    phrases = list(dict.fromkeys(obj for _, obj in verb_objs if obj is not None))
+    keywords = {phrase: (phrase_nouns(doc), noun_chunk_root(doc)) for phrase, doc in zip(phrases, nlp.pipe(phrases))}
+    run_report.add('pipe.task_parses', len(cleaned) + len(changed))
+    run_report.add('pipe.reparsed', len(changed))
+    run_report.add('pipe.object_parses', len(phrases))
+
+    results = pd.DataFrame(
+        [(verb, obj) + keywords.get(obj, ([], None)) for verb, obj in verb_objs],
+        index=texts.index[is_text],
+        columns=['verb', 'obj', '_obj_nouns', '_obj_root'],
+        dtype=object,
+    )
+    results.insert(0, 'task', singular)
+    # 文字列でないタスク (欠損) はそのまま残し、動詞と目的語は None にする
+    results = results.reindex(df.index)
+    results['task'] = results['task'].where(is_text, texts)
+    results.loc[~is_text, ['verb', 'obj']] = None
+    df[list(results.columns)] = results
+    get_normalizer().flush()
+    return df
+
+def simplify_piped_objects(df: pd.DataFrame, idf_scores: dict | None = None) -> pd.DataFrame:
+    """extract_tasks_piped の結果の目的語を、解析し直さずに SIMPLIFICATION_METHOD の方式で単純化する"""
+    df = df.copy()
+    if SIMPLIFICATION_METHOD == 'IDF':
+        df['obj'] = [
+            rarest_noun(nouns, idf_scores) if isinstance(obj, str) and idf_scores else None
+            for obj, nouns in zip(df['obj'], df['_obj_nouns'])
+        ]
+    else:
+        df['obj'] = df['_obj_root'].where(df['obj'].notna(), None)
+    return df.drop(columns=['_obj_nouns', '_obj_root'])
+
 def main():
+    parser = argparse.ArgumentParser(description="タスク文から動詞と目的語を抽出する")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="id の範囲で入力を分割して並列に抽出するプロセス数 (既定: 1)")
+    parser.add_argument('--no-parse-cache', action='store_true',
+                        help="spaCy の解析結果のキャッシュを使わずに全て解析し直す")
+    parser.add_argument('--pipe', action='store_true',
+                        help="タスク文と目的語フレーズを行ごとではなく nlp.pipe でまとめて解析する (結果は既定の方法と同じ)")
+    parser.add_argument('--spell', action='store_true',
+                        help="解析の前にタスク文のスペルを修正する (辞書にない単語だけ)")
+    args = parser.parse_args()
+    if args.no_parse_cache:
+        os.environ['BDA_PARSE_CACHE'] = '0'
+
     try:
-        nlp = spacy.load('en_core_web_sm')
-        p = inflect.engine() # inflectエンジンを初期化
+        load_models()
     except OSError:
         print("spaCyの英語モデル 'en_core_web_sm' が見つかりません。")
         return
@@ -165,21 +301,23 @@ def main():
         return
 
     try:
-        df = pd.read_csv(INPUT_CSV)
+        df = read_table(INPUT_CSV)
     except FileNotFoundError:
         print(f"エラー: {INPUT_CSV} が見つかりません。")
         return
 
-    df['task'] = df['task'].apply(cleans).apply(lambda text: singularize_nouns(text, nlp, p))
-    
     print("--- ステップ1: 動詞と目的語フレーズの抽出開始 ---")
-    df[['verb', 'obj']] = df['task'].apply(lambda text: pd.Series(extract_verb_obj(text, nlp)))
+    extract = extract_tasks_piped if args.pipe else extract_tasks
+    if args.spell:
+        # 索引がなければここで作って保存しておき、ワーカーはそれを読み込むだけにする
+        get_spell_corrector()
+    df = map_shards(df, partial(extract, spell=args.spell), workers=args.workers, initializer=load_models)
     print("抽出完了。")
 
     print(f"\n--- ステップ2: 目的語を '{SIMPLIFICATION_METHOD}' 方式で単純化します ---")
+    idf_scores = {}
     if SIMPLIFICATION_METHOD == 'IDF':
         corpus = df['obj'].dropna().tolist()
-        idf_scores = {}
         if corpus:
             vectorizer = TfidfVectorizer(use_idf=True)
             vectorizer.fit_transform(corpus)
@@ -187,21 +325,26 @@ def main():
             print("IDFスコアの計算が完了しました。")
         else:
             print("目的語が見つからなかったため、IDFの計算はスキップします。")
-        df['obj'] = df['obj'].apply(lambda text: get_rarest_noun_by_idf(text, nlp, idf_scores))
 
-    elif SIMPLIFICATION_METHOD == 'CHUNK':
-        df['obj'] = df['obj'].apply(lambda text: get_noun_chunk_root(text, nlp))
-        print("Noun Chunkingによる単純化が完了しました。")
-        
-    else:
+    elif SIMPLIFICATION_METHOD != 'CHUNK':
         print(f"エラー: 無効な単純化方式です: '{SIMPLIFICATION_METHOD}'。'IDF' または 'CHUNK' を指定してください。")
         return
+
+    if args.pipe:
+        # 目的語フレーズはステップ1で解析済みなので、spaCy を呼ばずに済む
+        df = simplify_piped_objects(df, idf_scores=idf_scores)
+    else:
+        df = map_shards(df, partial(simplify_objects, idf_scores=idf_scores),
+                        workers=args.workers, initializer=load_models)
+    if SIMPLIFICATION_METHOD == 'CHUNK':
+        print("Noun Chunkingによる単純化が完了しました。")
     
     print("\n--- 最終結果 (先頭15件) ---")
     print(df[['id', 'task', 'verb', 'obj']].head(15).to_string())
 
-    df.to_csv(OUTPUT_CSV, index=False, encoding='utf-8-sig')
-    print(f"\n抽出結果を '{OUTPUT_CSV}' に保存しました。")
+    write_table(df, OUTPUT_PATH, encoding='utf-8-sig')
+    print(f"\n抽出結果を '{OUTPUT_PATH}' に保存しました。")
+    run_report.print_report()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""
+spaCy の解析結果 (Doc) をテキストの内容で引けるようにディスクへキャッシュする
+
+キーは (モデル名, モデルのバージョン, パイプライン設定, テキストのハッシュ) で、
+値は DocBin でシリアライズした Doc。キャッシュ全体のサイズが上限を超えたら
+最後に参照された時刻が古いものから削除する (LRU)。
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Iterable, Iterator
+
+import spacy
+from spacy.tokens import Doc, DocBin
+
+import run_report
+
+# キャッシュの保存先 (リポジトリのルートから実行することを想定)
+CACHE_PATH = '.cache/parse_cache.sqlite'
+# キャッシュの最大サイズ (バイト)。超えたら古いものから削除する
+MAX_CACHE_BYTES = 1024 ** 3
+# 一度に DB を参照・解析するテキスト数
+LOOKUP_CHUNK_SIZE = 2048
+
+
+def is_enabled() -> bool:
+    """環境変数 BDA_PARSE_CACHE=0 でキャッシュを無効にできる (ワーカープロセスにも引き継がれる)"""
+    return os.environ.get('BDA_PARSE_CACHE', '1') != '0'
+
+
+class ParseCache:
+    """
+    spaCy の Language をラップし、解析済みの Doc をキャッシュから返す。
+    nlp(text) / nlp.pipe(texts) と同じように呼び出せる。
+    """
+
+    def __init__(self, nlp: spacy.language.Language, disable: Iterable[str] = (),
+                 path: str = CACHE_PATH, max_bytes: int = MAX_CACHE_BYTES):
+        self.nlp = nlp
+        self.vocab = nlp.vocab
+        self.disable = [name for name in disable if name in nlp.pipe_names]
+        self.path = path
+        self.max_bytes = max_bytes
+        self._conn = None
+        self._pid = None
+
+        enabled_pipes = [name for name in nlp.pipe_names if name not in self.disable]
+        config = json.dumps([
+            f"{nlp.meta.get('lang')}_{nlp.meta.get('name')}",
+            nlp.meta.get('version'),
+            spacy.__version__,
+            enabled_pipes,
+            nlp.config.to_str(),
+        ])
+        self.config_key = hashlib.sha256(config.encode('utf-8')).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        # fork したワーカープロセスでは親の接続を使わず、自分の接続を開き直す
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS docs ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS docs_last_access ON docs (last_access)")
+            self._pid = os.getpid()
+        return self._conn
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.config_key}\0{text}".encode('utf-8')).hexdigest()
+
+    def __call__(self, text: str) -> Doc:
+        return next(self.pipe([text]))
+
+    def pipe(self, texts: Iterable[str], batch_size: int = 256) -> Iterator[Doc]:
+        """texts を入力順に解析した Doc を返す。キャッシュにないものだけ nlp.pipe で解析する"""
+        if not is_enabled():
+            yield from self.nlp.pipe(texts, batch_size=batch_size, disable=self.disable)
+            return
+
+        chunk = []
+        for text in texts:
+            chunk.append(text)
+            if len(chunk) >= LOOKUP_CHUNK_SIZE:
+                yield from self._pipe_chunk(chunk, batch_size)
+                chunk = []
+        if chunk:
+            yield from self._pipe_chunk(chunk, batch_size)
+
+    def _pipe_chunk(self, texts: list[str], batch_size: int) -> list[Doc]:
+        conn = self._connect()
+        keys = [self._key(text) for text in texts]
+        unique_keys = list(dict.fromkeys(keys))
+
+        cached = {}
+        for start in range(0, len(unique_keys), 500):
+            part = unique_keys[start:start + 500]
+            rows = conn.execute(
+                f"SELECT key, value FROM docs WHERE key IN ({','.join('?' * len(part))})", part
+            ).fetchall()
+            cached.update(rows)
+
+        now = time.time()
+        docs = {key: self._from_bytes(value) for key, value in cached.items()}
+        conn.executemany("UPDATE docs SET last_access = ? WHERE key = ?", [(now, key) for key in cached])
+
+        # キャッシュにないテキストだけ解析して保存する
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in docs and key not in missing:
+                missing[key] = text
+        if missing:
+            parsed = self.nlp.pipe(missing.values(), batch_size=batch_size, disable=self.disable)
+            rows = []
+            for key, doc in zip(missing, parsed):
+                docs[key] = doc
+                value = DocBin(docs=[doc], store_user_data=False).to_bytes()
+                rows.append((key, value, len(value), now))
+            conn.executemany("INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+
+        run_report.add('parse_cache.hit', len(texts) - len(missing))
+        run_report.add('parse_cache.miss', len(missing))
+        if missing:
+            self._evict()
+        return [docs[key] for key in keys]
+
+    def _from_bytes(self, value: bytes) -> Doc:
+        return next(DocBin().from_bytes(value).get_docs(self.vocab))
+
+    def _evict(self) -> None:
+        """合計サイズが max_bytes を超えていたら、最後に参照された時刻が古いものから削除する"""
+        conn = self._connect()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM docs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # 上限の 9 割まで減らす
+        excess = total - int(self.max_bytes * 0.9)
+        evicted = 0
+        removed = []
+        cursor = conn.execute("SELECT key, size FROM docs ORDER BY last_access")
+        for key, size in cursor:
+            removed.append((key,))
+            evicted += size
+            if evicted >= excess:
+                break
+        cursor.close()
+        conn.executemany("DELETE FROM docs WHERE key = ?", removed)
+        conn.commit()
+        run_report.add('parse_cache.evicted', len(removed))
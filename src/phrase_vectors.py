@@ -0,0 +1,133 @@
+"""
+フレーズを spaCy モデルの Vectors テーブルから直接ベクトル化し、結果をディスクにキャッシュする
+
+フレーズのベクトルは、ストップワード以外でベクトルを持つトークンのベクトルの平均。
+トークナイザーだけでまとめて分割し、単語ベクトルは Vectors テーブルから NumPy で一括取得する。
+計算済みの行列は float32 の .npy (メモリマップで読み込む) とフレーズの索引 (.json) として保存し、
+次回以降は新しいフレーズだけをベクトル化する。
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import spacy
+from scipy import sparse
+
+import run_report
+
+# キャッシュの保存先 (リポジトリのルートから実行することを想定)
+VECTOR_CACHE_DIR = '.cache/phrase_vectors'
+
+
+class PhraseVectorizer:
+    """フレーズのベクトル化とその結果のキャッシュを行う"""
+
+    def __init__(self, nlp: spacy.language.Language, cache_dir: str = VECTOR_CACHE_DIR):
+        if nlp.vocab.vectors.size == 0:
+            raise ValueError(f"spaCyモデル '{nlp.meta.get('name')}' は単語ベクトルを持っていません。")
+
+        self.nlp = nlp
+        self.table = np.asarray(nlp.vocab.vectors.data, dtype=np.float32)
+
+        # モデルとストップワードが変わったら別のキャッシュを使う
+        identity = json.dumps([
+            f"{nlp.meta.get('lang')}_{nlp.meta.get('name')}",
+            nlp.meta.get('version'),
+            spacy.__version__,
+            sorted(nlp.Defaults.stop_words),
+        ])
+        key = hashlib.sha256(identity.encode('utf-8')).hexdigest()[:16]
+        os.makedirs(cache_dir, exist_ok=True)
+        self.matrix_path = os.path.join(cache_dir, f'{key}.npy')
+        self.index_path = os.path.join(cache_dir, f'{key}.json')
+
+        # フレーズ -> 行番号、ベクトルを持たないフレーズ
+        self.index = {}
+        self.no_vector = set()
+        if os.path.exists(self.index_path) and os.path.exists(self.matrix_path):
+            with open(self.index_path, encoding='utf-8') as f:
+                saved = json.load(f)
+            self.index = {phrase: row for row, phrase in enumerate(saved['phrases'])}
+            self.no_vector = set(saved['no_vector'])
+
+    def embed(self, phrases: list[str]) -> tuple[list[str], np.ndarray]:
+        """
+        フレーズをベクトル化し、有効なベクトルを持つフレーズのリストと
+        それに対応する float32 の行列を返す。
+        """
+        new_phrases = [phrase for phrase in dict.fromkeys(phrases)
+                       if phrase not in self.index and phrase not in self.no_vector]
+        run_report.add('phrase_vectors.hit', len(phrases) - len(new_phrases))
+        run_report.add('phrase_vectors.miss', len(new_phrases))
+        if new_phrases:
+            self._add(new_phrases)
+
+        valid_phrases = [phrase for phrase in phrases if phrase in self.index]
+        if not valid_phrases:
+            return [], np.empty((0, self.table.shape[1]), dtype=np.float32)
+
+        matrix = np.load(self.matrix_path, mmap_mode='r')
+        rows = np.fromiter((self.index[phrase] for phrase in valid_phrases), dtype=np.int64, count=len(valid_phrases))
+        return valid_phrases, np.asarray(matrix[rows])
+
+    def vectorize(self, phrases: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        キャッシュを使わずにフレーズをベクトル化する。
+        (ベクトル行列, 各フレーズが有効なベクトルを持つかどうかのマスク) を返す。
+        """
+        # トークナイザーだけで分割し、トークンの orth と所属するフレーズを集める
+        orths = []
+        owners = []
+        is_stop = []
+        for i, doc in enumerate(self.nlp.tokenizer.pipe(phrases)):
+            for token in doc:
+                orths.append(token.orth)
+                owners.append(i)
+                is_stop.append(token.is_stop)
+
+        orths = np.array(orths, dtype=np.uint64)
+        owners = np.array(owners, dtype=np.int64)
+        rows = self.nlp.vocab.vectors.find(keys=orths) if len(orths) else np.empty(0, dtype=np.int64)
+        keep = (np.asarray(rows) >= 0) & ~np.array(is_stop, dtype=bool)
+
+        # フレーズ x トークンの疎行列で、ベクトルを持つ非ストップワードの和と数をまとめて計算する
+        kept_rows = np.asarray(rows)[keep]
+        kept_owners = owners[keep]
+        membership = sparse.csr_matrix(
+            (np.ones(len(kept_owners), dtype=np.float32), (kept_owners, np.arange(len(kept_owners)))),
+            shape=(len(phrases), len(kept_owners)),
+        )
+        sums = membership @ self.table[kept_rows]
+        counts = np.bincount(kept_owners, minlength=len(phrases))
+
+        valid = counts > 0
+        vectors = np.zeros((len(phrases), self.table.shape[1]), dtype=np.float32)
+        vectors[valid] = sums[valid] / counts[valid, None]
+        return vectors, valid
+
+    def _add(self, phrases: list[str]) -> None:
+        """新しいフレーズをベクトル化し、行列と索引に追記して保存する"""
+        vectors, valid = self.vectorize(phrases)
+        new_rows = vectors[valid]
+
+        if self.index:
+            matrix = np.concatenate([np.load(self.matrix_path, mmap_mode='r'), new_rows])
+        else:
+            matrix = new_rows
+        for phrase, ok in zip(phrases, valid):
+            if ok:
+                self.index[phrase] = len(self.index)
+            else:
+                self.no_vector.add(phrase)
+
+        # 途中で中断しても壊れたキャッシュが残らないよう、一時ファイルに書いてから置き換える
+        tmp_matrix = self.matrix_path + '.tmp.npy'
+        np.save(tmp_matrix, matrix.astype(np.float32, copy=False))
+        os.replace(tmp_matrix, self.matrix_path)
+
+        tmp_index = self.index_path + '.tmp'
+        with open(tmp_index, 'w', encoding='utf-8') as f:
+            json.dump({'phrases': list(self.index), 'no_vector': sorted(self.no_vector)}, f, ensure_ascii=False)
+        os.replace(tmp_index, self.index_path)
@@ -0,0 +1,384 @@
+"""
+前処理からモデル推定までの各スクリプトを、入出力の依存関係に従って実行する
+
+各ステージの入力ファイル・スクリプト (と import するこのリポジトリのモジュール)・引数からフィンガープリントを計算し、
+前回の実行時から変わっておらず出力も揃っているステージはスキップする。
+依存関係のないステージ (タスクの NLP とコメントの NLP など) は並列に実行する。
+
+使い方 (リポジトリのルートで実行):
+    python src/pipeline.py                 # 必要なステージだけ実行
+    python src/pipeline.py cmt_merge       # cmt_merge とその上流だけ
+    python src/pipeline.py --dry-run       # 実行されるステージを表示するだけ
+    python src/pipeline.py --force         # フィンガープリントに関係なく全て実行
+    python src/pipeline.py --long          # コメントの処理をロングフォーマットで行う (merge は対象外)
+"""
+
+import argparse
+import ast
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# フィンガープリントと実行ログの保存先
+STATE_JSON = '.cache/pipeline_state.json'
+LOG_DIR = '.cache/pipeline_logs'
+# スクリプトが import するモジュールを探すディレクトリ (スクリプト自身のディレクトリの次に探す。
+# src/stan/1/run.py は src と src/stan を sys.path に加えている)
+MODULE_DIRS = ['src', 'src/stan']
+
+
+def imported_modules(path: str, found: set[str] | None = None) -> list[str]:
+    """
+    path が import する (関数の中の import も含む) このリポジトリのモジュールのファイルを、
+    import をたどって再帰的に集める。外部のライブラリ (ファイルが見つからないもの) は含めない。
+    """
+    found = set() if found is None else found
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=path)
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.append(node.module)
+
+    for name in names:
+        for directory in [os.path.dirname(path)] + MODULE_DIRS:
+            module = os.path.normpath(os.path.join(directory, name.split('.')[0] + '.py'))
+            if os.path.exists(module):
+                if module not in found and module != os.path.normpath(path):
+                    found.add(module)
+                    imported_modules(module, found)
+                break
+    return sorted(found)
+
+
+def build_stages(long_format: bool = False, workers: int = 1) -> list[dict]:
+    """
+    ステージの定義を返す。
+      name: ステージ名
+      script: 実行するスクリプト
+      args: スクリプトに渡す引数 (パラメータとしてフィンガープリントに含める)
+      code: スクリプトが使うこのリポジトリのコード (コードのバージョンに含める)。
+            import するモジュールは imported_modules で集めて加えるので、import 以外で読むファイル (Stan モデル) だけを書いておく
+      inputs / outputs: 入力ファイル / 出力ファイル (ステージ間の依存関係はこれから決まる)
+      long_unsupported: --long に対応していないステージならその理由 (long_format=True のときは実行しない)
+    long_format=True のときは、コメントを処理するステージの引数と入出力をロングフォーマットのものにする。
+    """
+    long_args = ['--long'] if long_format else []
+    normalized = 'dataset_for_bda/comments_normalized_long.parquet' if long_format else 'dataset_for_bda/comments_normalized.parquet'
+    extracted = 'dataset_for_bda/comments_extracted_long.parquet' if long_format else 'dataset_for_bda/comments_extracted.parquet'
+    clustered = 'dataset_for_bda/comments_clustered_long.parquet' if long_format else 'dataset_for_bda/comments_clustered.parquet'
+
+    stages = [
+        {
+            'name': 'transform',
+            'script': 'transform.py',
+            'args': [],
+            'inputs': ['dataset/uicrit_public.csv'],
+            'outputs': [
+                'dataset_modified/uicrit_public_with_id.csv',
+                'dataset_modified/uicrit_id_comments.csv',
+                'dataset_modified/uicrit_id_task.csv',
+            ],
+        },
+        {
+            'name': 'cmt_normalize',
+            'script': 'src/cmt_normalize.py',
+            'args': long_args,
+            'inputs': ['dataset_modified/uicrit_id_comments.csv'],
+            'outputs': [normalized],
+        },
+        {
+            'name': 'cmt_extract',
+            'script': 'src/cmt_extract.py',
+            'args': long_args + ['--workers', str(workers)],
+            'inputs': [normalized],
+            'outputs': [extracted],
+        },
+        {
+            'name': 'cmt_clustering',
+            'script': 'src/cmt_clustering.py',
+            'args': long_args,
+            'inputs': [extracted],
+            'outputs': [clustered, 'dataset_for_bda/cluster_model/clusters.json'],
+        },
+        {
+            'name': 'cmt_to_long',
+            'script': 'src/cmt_to_long.py',
+            'args': long_args,
+            'inputs': [clustered],
+            'outputs': ['dataset_for_bda/comments_long_clustered.parquet'],
+        },
+        {
+            'name': 'cmt_merge',
+            'script': 'src/cmt_merge.py',
+            'args': [],
+            'inputs': [
+                'dataset_for_bda/comments_long_clustered.parquet',
+                'dataset_modified/uicrit_public_with_id.csv',
+                'dataset_modified/uicrit_id_task_category.csv',
+                'dataset_modified/uicrit_id_comments_category.csv',
+            ],
+            'outputs': ['dataset_for_bda/merged_comments_with_ratings.parquet'],
+        },
+        {
+            'name': 'stan',
+            'script': 'src/stan/1/run.py',
+            'args': [],
+            'code': [
+                'src/stan/1/hierarchical_ordered_logistic.stan',
+                'src/stan/1/hierarchical_ordered_logistic_sparse.stan',
+                'src/stan/1/hierarchical_ordered_logistic_parallel.stan',
+                'src/stan/1/hierarchical_ordered_logistic_sparse_parallel.stan',
+            ],
+            'inputs': ['dataset_for_bda/merged_comments_with_ratings.parquet'],
+            'outputs': ['beta_forest_plot.png', 'trace_plot.png'],
+        },
+        {
+            'name': 'nlp',
+            'script': 'src/nlp.py',
+            'args': ['--workers', str(workers)],
+            'inputs': ['dataset_modified/uicrit_id_task_corrected.csv'],
+            'outputs': ['dataset_for_bda/tasks_extracted_chunk_corrected.parquet'],
+        },
+        {
+            'name': 'merge',
+            'script': 'src/merge.py',
+            'args': [],
+            'inputs': [
+                'dataset_modified/uicrit_public_with_id.csv',
+                'dataset_modified/uicrit_id_task_category.csv',
+                'dataset_modified/uicrit_id_comments_category.csv',
+                'dataset_for_bda/comments_extracted.parquet',
+                'dataset_for_bda/tasks_extracted_chunk_corrected.parquet',
+            ],
+            'outputs': ['dataset_for_bda/merged2.parquet'],
+            'long_unsupported': "merge.py はワイドフォーマットの 'dataset_for_bda/comments_extracted.parquet' を読むが、"
+                                "--long では cmt_extract がそれを出力しない",
+        },
+    ]
+    for stage in stages:
+        stage['code'] = stage.get('code', []) + imported_modules(stage['script'])
+    return stages
+
+
+def exclude_long_unsupported(stages: list[dict], targets: list[str]) -> list[dict]:
+    """
+    --long に対応していないステージを除く (除いたことと理由を表示する)。
+    そのステージを targets で明示的に指定していれば ValueError にする。
+    """
+    rejected = [stage for stage in stages if stage.get('long_unsupported') and stage['name'] in targets]
+    if rejected:
+        raise ValueError("--long に対応していないステージです: "
+                         + "; ".join(f"{stage['name']} ({stage['long_unsupported']})" for stage in rejected))
+    for stage in stages:
+        if stage.get('long_unsupported'):
+            print(f"[skip] {stage['name']}: --long に対応していません ({stage['long_unsupported']})")
+    return [stage for stage in stages if not stage.get('long_unsupported')]
+
+
+def resolve_dependencies(stages: list[dict]) -> dict[str, set[str]]:
+    """ステージ名 -> そのステージの入力を出力する (上流の) ステージ名の集合"""
+    producer = {output: stage['name'] for stage in stages for output in stage['outputs']}
+    return {
+        stage['name']: {producer[path] for path in stage['inputs'] if path in producer and producer[path] != stage['name']}
+        for stage in stages
+    }
+
+
+def select_stages(stages: list[dict], dependencies: dict[str, set[str]], targets: list[str]) -> list[dict]:
+    """targets とその上流のステージだけを残す (targets が空なら全て)"""
+    if not targets:
+        return stages
+
+    unknown = set(targets) - {stage['name'] for stage in stages}
+    if unknown:
+        raise ValueError(f"不明なステージです: {', '.join(sorted(unknown))}")
+
+    selected = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(dependencies[name])
+    return [stage for stage in stages if stage['name'] in selected]
+
+
+def resolve_input(path: str) -> str:
+    """入力の .parquet がなく同じ名前の .csv がある場合は .csv を使う (storage.read_table と同じ扱い)"""
+    if not os.path.exists(path) and path.endswith('.parquet'):
+        csv = os.path.splitext(path)[0] + '.csv'
+        if os.path.exists(csv):
+            return csv
+    return path
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint(stage: dict) -> str:
+    """入力ファイル・コード・引数の内容から、ステージのフィンガープリントを計算する"""
+    parts = {
+        'args': stage['args'],
+        'code': {path: file_digest(path) for path in [stage['script']] + stage['code']},
+        'inputs': {path: file_digest(resolve_input(path)) for path in stage['inputs']},
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_state(path: str = STATE_JSON) -> dict[str, str]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(state: dict[str, str], path: str = STATE_JSON) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+def stale_outputs(stage: dict, started_at: float) -> list[str]:
+    """ステージの出力のうち、started_at (time.time()) 以降に書き直されていないもの"""
+    return [path for path in stage['outputs'] if not os.path.exists(path) or os.path.getmtime(path) < started_at]
+
+
+def run_stage(stage: dict) -> tuple[int, float, str, list[str]]:
+    """
+    ステージのスクリプトを実行し、(終了コード, 所要時間, ログファイル, 書き直されなかった出力) を返す。
+    スクリプトはエラーを表示して終了コード 0 で終わることがあるので、出力が書き直されたかも確かめる。
+    """
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_path = os.path.join(LOG_DIR, f"{stage['name']}.log")
+    # ファイルシステムによっては更新時刻の精度が粗いので、開始時刻を少し前にずらす
+    started_at = time.time() - 1
+    start = time.perf_counter()
+    with open(log_path, 'w', encoding='utf-8') as log:
+        result = subprocess.run([sys.executable, stage['script'], *stage['args']], stdout=log, stderr=subprocess.STDOUT)
+    return result.returncode, time.perf_counter() - start, log_path, stale_outputs(stage, started_at)
+
+
+def run_pipeline(stages: list[dict], jobs: int = 2, force: bool = False, dry_run: bool = False) -> bool:
+    """
+    依存関係の順にステージを実行する。上流が全て終わったステージから最大 jobs 個を並列に実行し、
+    フィンガープリントが前回と同じで出力が揃っているステージはスキップする。
+    終了コードが 0 で、全ての出力が書き直されたステージだけを成功とし、フィンガープリントを保存する。
+    全てのステージが成功 (またはスキップ) したら True を返す。
+    """
+    dependencies = resolve_dependencies(stages)
+    names = {stage['name'] for stage in stages}
+    by_name = {stage['name']: stage for stage in stages}
+    produced = {path for stage in stages for path in stage['outputs']}
+    state = load_state()
+
+    done = set()
+    failed = set()
+    running = {}
+    ok = True
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        while len(done) + len(failed) < len(stages):
+            # 上流が全て終わったステージを開始する (上流が失敗したものは実行しない)
+            for name in [stage['name'] for stage in stages]:
+                if name in done or name in failed or name in running:
+                    continue
+                upstream = dependencies[name] & names
+                if upstream & failed:
+                    print(f"[skip] {name}: 上流のステージが失敗しました。")
+                    failed.add(name)
+                    continue
+                if not upstream <= done:
+                    continue
+
+                stage = by_name[name]
+                missing_inputs = [path for path in stage['inputs'] if not os.path.exists(resolve_input(path))]
+                if missing_inputs and not dry_run:
+                    print(f"[error] {name}: 入力ファイルが見つかりません: {', '.join(missing_inputs)}")
+                    failed.add(name)
+                    ok = False
+                    continue
+
+                current = None if missing_inputs else fingerprint(stage)
+                outputs_exist = all(os.path.exists(path) for path in stage['outputs'])
+                if not force and outputs_exist and current is not None and state.get(name) == current:
+                    print(f"[up-to-date] {name}")
+                    done.add(name)
+                    continue
+                if dry_run:
+                    print(f"[would run] {name}: {stage['script']} {' '.join(stage['args'])}")
+                    print(f"    inputs: {', '.join(stage['inputs'])}")
+                    external = [path for path in missing_inputs if path not in produced]
+                    if external:
+                        print(f"    (どのステージも出力せず、まだない入力: {', '.join(external)})")
+                    print(f"    outputs: {', '.join(stage['outputs'])}")
+                    done.add(name)
+                    continue
+
+                print(f"[run] {name}: {stage['script']} {' '.join(stage['args'])}")
+                running[name] = (executor.submit(run_stage, stage), current)
+
+            if not running:
+                continue
+
+            finished, _ = wait([future for future, _ in running.values()], return_when=FIRST_COMPLETED)
+            for name, (future, current) in list(running.items()):
+                if future not in finished:
+                    continue
+                del running[name]
+                returncode, elapsed, log_path, stale = future.result()
+                if returncode == 0 and stale:
+                    # 出力が古いままならフィンガープリントを保存しない (次回も実行し直す)
+                    print(f"[failed] {name}: 出力が書き直されませんでした: {', '.join(stale)} (ログ: {log_path})")
+                    failed.add(name)
+                    ok = False
+                elif returncode == 0:
+                    print(f"[done] {name} ({elapsed:.1f}秒, ログ: {log_path})")
+                    state[name] = current
+                    save_state(state)
+                    done.add(name)
+                else:
+                    print(f"[failed] {name} (終了コード {returncode}, ログ: {log_path})")
+                    failed.add(name)
+                    ok = False
+
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="依存関係に従ってパイプラインの各ステージを実行する")
+    parser.add_argument('targets', nargs='*', help="実行するステージ (その上流も含む)。省略時は全て")
+    parser.add_argument('--jobs', type=int, default=2, help="同時に実行するステージ数 (既定: 2)")
+    parser.add_argument('--workers', type=int, default=1, help="cmt_extract / nlp に渡す --workers (既定: 1)")
+    parser.add_argument('--long', action='store_true',
+                        help="コメントの処理をロングフォーマットで行う (--long に対応していない merge は実行しない)")
+    parser.add_argument('--force', action='store_true', help="フィンガープリントに関係なく全て実行する")
+    parser.add_argument('--dry-run', action='store_true', help="実行されるステージを表示するだけで実行しない")
+    args = parser.parse_args()
+
+    stages = build_stages(long_format=args.long, workers=args.workers)
+    try:
+        if args.long:
+            stages = exclude_long_unsupported(stages, args.targets)
+        stages = select_stages(stages, resolve_dependencies(stages), args.targets)
+    except ValueError as e:
+        print(f"エラー: {e}")
+        sys.exit(2)
+
+    if not run_pipeline(stages, jobs=args.jobs, force=args.force, dry_run=args.dry_run):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+ステージ実行中のキャッシュのヒット数などを集計し、実行終了時にレポートとして表示する
+"""
+
+from collections import Counter
+
+# カウンタ名 -> 値 (例: 'parse_cache.hit')
+COUNTERS = Counter()
+
+
+def add(name: str, value: float = 1) -> None:
+    """カウンタ name に value を加算する"""
+    COUNTERS[name] += value
+
+
+def drain() -> dict[str, float]:
+    """現在のカウンタを返してリセットする (ワーカープロセスから親プロセスへ渡すため)"""
+    counts = dict(COUNTERS)
+    COUNTERS.clear()
+    return counts
+
+
+def merge(counts: dict[str, float]) -> None:
+    """drain() で取り出したカウンタを加算する"""
+    COUNTERS.update(counts)
+
+
+def print_report(title: str = "実行レポート") -> None:
+    """カウンタをグループ (名前の '.' より前) ごとにまとめて表示する"""
+    if not COUNTERS:
+        return
+
+    print(f"\n--- {title} ---")
+    groups = {}
+    for name, value in sorted(COUNTERS.items()):
+        group, _, key = name.partition('.')
+        groups.setdefault(group, {})[key] = value
+
+    for group, values in groups.items():
+        hits = values.get('hit', 0)
+        misses = values.get('miss', 0)
+        line = ", ".join(f"{key}={value:g}" for key, value in values.items())
+        if hits + misses > 0:
+            line += f", hit率={hits / (hits + misses):.1%}"
+        print(f"{group}: {line}")
@@ -0,0 +1,59 @@
+"""
+id の範囲で DataFrame を分割し、複数プロセスで処理してから元の行順に結合する
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+import run_report
+
+
+def shard_by_id(df: pd.DataFrame, n_shards: int, id_col: str = 'id') -> list[pd.DataFrame]:
+    """
+    df を id でソートし、連続する id の範囲ごとに最大 n_shards 個に分割する。
+    """
+    order = np.argsort(df[id_col].to_numpy(), kind='stable')
+    return [df.iloc[part] for part in np.array_split(order, n_shards) if len(part) > 0]
+
+
+def _run_shard(func: Callable[[pd.DataFrame], pd.DataFrame], shard: pd.DataFrame) -> tuple[pd.DataFrame, dict]:
+    """ワーカープロセスでシャードを処理し、結果と一緒にキャッシュのカウンタなどを返す"""
+    return func(shard), run_report.drain()
+
+
+def map_shards(
+    df: pd.DataFrame,
+    func: Callable[[pd.DataFrame], pd.DataFrame],
+    workers: int = 1,
+    initializer: Callable | None = None,
+    initargs: tuple = (),
+    id_col: str = 'id',
+) -> pd.DataFrame:
+    """
+    df を id の範囲で workers 個のシャードに分け、各シャードに func を並列に適用する。
+
+    func はモジュールのトップレベルで定義された (pickle 可能な) 関数で、
+    受け取ったシャードと同じインデックスを持つ DataFrame を返す必要がある。
+    initializer は各ワーカープロセスの起動時に一度だけ呼ばれる (spaCy モデルのロードなど)。
+    シャードの結果は id の範囲順に結合した後、入力 df と同じ行順に戻すので、
+    出力は workers=1 で実行した場合と同一になる。
+    ワーカーで加算された run_report のカウンタは親プロセスに集約される。
+    """
+    if workers <= 1 or len(df) == 0:
+        if initializer is not None:
+            initializer(*initargs)
+        return func(df)
+
+    shards = shard_by_id(df, workers, id_col)
+    print(f"{len(df)} 行を {len(shards)} 個のシャードに分割し、{len(shards)} プロセスで処理します...")
+    with ProcessPoolExecutor(max_workers=len(shards), initializer=initializer, initargs=initargs) as executor:
+        results = []
+        for result, counts in executor.map(partial(_run_shard, func), shards):
+            results.append(result)
+            run_report.merge(counts)
+
+    return pd.concat(results).loc[df.index]
@@ -0,0 +1,176 @@
+"""
+辞書を一度だけ読み込んで使い回すスペル修正
+
+辞書 (単語と頻度) は pyspellchecker のものを使い、候補の検索には SymSpell と同じ
+削除のみの索引 (辞書の各単語から最大 max_distance 文字を削除した文字列 -> 単語) を使う。
+入力の単語からも同じように削除した文字列を作って索引を引き、見つかった候補だけ編集距離を確かめる。
+候補の選び方は pyspellchecker の correction と同じ (編集距離が小さい順, 同じなら頻度が高い順)。
+
+索引は辞書の内容と設定をキーに .cache に保存するので、作るのは最初の一回だけ。
+単語ごとの修正結果は大きさに上限のある LRU にメモする。辞書にある単語は修正しない。
+"""
+
+import hashlib
+import os
+import string
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import run_report
+
+# 索引の保存先 (リポジトリのルートから実行することを想定)
+INDEX_CACHE_DIR = '.cache/spell_index'
+# 修正の候補にする最大の編集距離 (pyspellchecker の既定と同じ)
+MAX_DISTANCE = 2
+# 索引に使う単語の先頭の文字数 (長い単語の削除の組み合わせが増えすぎないようにする, SymSpell と同じ)
+PREFIX_LENGTH = 7
+# 単語ごとの修正結果をメモする数
+MEMO_SIZE = 100_000
+
+
+def deletes(word: str, max_distance: int) -> set[str]:
+    """word から最大 max_distance 文字を削除した文字列 (word 自身を含む)"""
+    results = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))} - results
+        results |= frontier
+    return results
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """隣接文字の入れ替えを1回の編集とする編集距離 (OSA)。max_distance を超えたら max_distance + 1"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+def _hash(text: str) -> int:
+    # 実行ごとに変わる hash() ではなく、索引を保存できるように決まった値になるハッシュを使う
+    return zlib.crc32(text.encode('utf-8'))
+
+
+class SpellCorrector:
+    """
+    単語・文・列 (pd.Series) 単位でスペルを修正する。
+
+        corrector = SpellCorrector()
+        corrector.correct("Folow the evnt")          # -> 'follow the event'
+        df['task'] = corrector.correct_column(df['task'])
+    """
+
+    def __init__(self, language: str = 'en', max_distance: int = MAX_DISTANCE, prefix_length: int = PREFIX_LENGTH,
+                 memo_size: int = MEMO_SIZE, cache_dir: str = INDEX_CACHE_DIR):
+        from spellchecker import SpellChecker
+
+        frequency = SpellChecker(language=language, distance=max_distance).word_frequency
+        self.words = sorted(frequency.dictionary)
+        self.frequencies = np.array([frequency.dictionary[word] for word in self.words], dtype=np.int64)
+        self.vocabulary = set(self.words)
+        self.longest_word_length = frequency.longest_word_length
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.memo_size = memo_size
+        self.memo = OrderedDict()
+        self.delete_hashes, self.word_ids = self._load_index(cache_dir)
+
+    def _load_index(self, cache_dir: str) -> tuple[np.ndarray, np.ndarray]:
+        """削除の索引 (ハッシュの昇順に並べた (ハッシュ, 単語の番号)) をキャッシュから読むか、作って保存する"""
+        digest = hashlib.sha256('\n'.join(self.words).encode('utf-8'))
+        digest.update(f'{self.max_distance}-{self.prefix_length}'.encode('utf-8'))
+        path = os.path.join(cache_dir, f'{digest.hexdigest()[:16]}.npz')
+        if os.path.exists(path):
+            with np.load(path) as index:
+                return index['delete_hashes'], index['word_ids']
+
+        hashes, word_ids = [], []
+        for word_id, word in enumerate(self.words):
+            for deleted in deletes(word[:self.prefix_length], self.max_distance):
+                hashes.append(_hash(deleted))
+                word_ids.append(word_id)
+        hashes = np.array(hashes, dtype=np.uint32)
+        word_ids = np.array(word_ids, dtype=np.int32)
+        order = np.argsort(hashes, kind='stable')
+        hashes, word_ids = hashes[order], word_ids[order]
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, delete_hashes=hashes, word_ids=word_ids)
+        os.replace(tmp_path, path)
+        return hashes, word_ids
+
+    def should_check(self, word: str) -> bool:
+        """数字や記号だけの語, 長すぎる語は修正しない (pyspellchecker と同じ)"""
+        if len(word) == 1 and word in string.punctuation:
+            return False
+        if len(word) > self.longest_word_length + 3 or word.lower() == 'nan':
+            return False
+        try:
+            float(word)
+            return False
+        except ValueError:
+            return True
+
+    def candidates(self, word: str) -> list[str]:
+        """word (小文字) から編集距離 max_distance 以内の辞書の単語を、選ばれる順に並べて返す"""
+        keys = np.array([_hash(deleted) for deleted in deletes(word[:self.prefix_length], self.max_distance)],
+                        dtype=np.uint32)
+        starts = np.searchsorted(self.delete_hashes, keys, side='left')
+        ends = np.searchsorted(self.delete_hashes, keys, side='right')
+        ids = np.unique(np.concatenate([self.word_ids[s:e] for s, e in zip(starts, ends)]))
+
+        scored = []
+        for word_id in ids:
+            distance = edit_distance(word, self.words[word_id], self.max_distance)
+            if distance <= self.max_distance:
+                scored.append((distance, -self.frequencies[word_id], self.words[word_id]))
+        return [candidate for _, _, candidate in sorted(scored)]
+
+    def correct_word(self, word: str) -> str:
+        """辞書にある単語はそのまま、ない単語は最も良い候補 (なければそのまま) を返す"""
+        if word in self.memo:
+            self.memo.move_to_end(word)
+            run_report.add('spell.hit')
+            return self.memo[word]
+        run_report.add('spell.miss')
+
+        lowered = word.lower()
+        if not self.should_check(word) or lowered in self.vocabulary:
+            corrected = word
+        else:
+            candidates = self.candidates(lowered)
+            corrected = candidates[0] if candidates else word
+            if corrected != word:
+                run_report.add('spell.corrected')
+
+        self.memo[word] = corrected
+        if len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+        return corrected
+
+    def correct(self, text):
+        """空白で区切った単語ごとに修正して結合する (文字列でなければそのまま返す)"""
+        if not isinstance(text, str):
+            return text
+        return " ".join(self.correct_word(word) for word in text.split())
+
+    def correct_column(self, values: pd.Series) -> pd.Series:
+        """列の重複する値は一度だけ修正する"""
+        uniques = pd.unique(values.dropna())
+        corrected = {value: self.correct(value) for value in uniques}
+        return values.map(corrected).where(values.notna(), values)
@@ -1,23 +1,140 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import pandas as pd
 from sklearn.preprocessing import StandardScaler
-from cmdstanpy import CmdStanModel
 import numpy as np
+from scipy import sparse
 import arviz as az
 import matplotlib.pyplot as plt
 
+# src/ と src/stan/ のモジュール (storage, model_cache など) を import できるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from storage import existing_path, read_table, write_table
+from numpy_ologit import fit_laplace
+from data_cache import FactorCodes, cache_key, cache_path, factor_codes_digest, load_arrays, save_arrays
+from posterior import extract_draws, summarize_draws, to_inference_data, stream_cmdstan_run, load_draws
+
 # --- 設定項目 ---
-# マージ済みのCSVファイル
-INPUT_CSV = 'dataset_for_bda/merged_comments_with_ratings.csv'
-# Stanモデルファイル
-STAN_FILE = 'src/stan/1/hierarchical_ordered_logistic.stan'
+# マージ済みのデータ
+INPUT_PATH = 'dataset_for_bda/merged_comments_with_ratings.parquet'
+# Stanモデルファイル (説明変数行列の渡し方ごと)
+STAN_FILES = {
+    'sparse': 'src/stan/1/hierarchical_ordered_logistic_sparse.stan',
+    'dense': 'src/stan/1/hierarchical_ordered_logistic.stan',
+}
+# 尤度を reduce_sum で分割し、1チェーンを複数スレッドで計算するモデル (--threads-per-chain > 1 のとき)
+PARALLEL_STAN_FILES = {
+    'sparse': 'src/stan/1/hierarchical_ordered_logistic_sparse_parallel.stan',
+    'dense': 'src/stan/1/hierarchical_ordered_logistic_parallel.stan',
+}
+# 評価の列 (どれか一つを目的変数にし、残りを標準化して説明変数にする)
+RATING_VARS = ['aesthetics_rating', 'learnability', 'efficency', 'design_quality_rating', 'usability_rating']
+# 既定の目的変数
+OUTCOME = 'usability_rating'
+# 説明変数の組: 名前 -> (他の評価を含めるか, problem の出現回数を含めるか)
+PREDICTOR_SETS = {
+    'full': (True, True),
+    'controls': (True, False),
+    'problems': (False, True),
+}
+# NUTS のチェーン数
+CHAINS = 4
+# バッチ実行 (--batch) の結果をまとめた表とフォレストプロット
+BATCH_SUMMARY_PATH = 'dataset_for_bda/batch_summary.parquet'
+BATCH_FOREST_PLOT_PATH = 'batch_forest_plot.png'
+# reduce_sum の grainsize (1 なら分割はスケジューラに任せる)
+GRAINSIZE = 1
+# 推定方法 ('nuts' 以外は近似で、数秒から数十秒で終わる。'numpy' は CmdStan を使わない MAP + ラプラス近似)
+METHODS = ['nuts', 'pathfinder', 'variational', 'laplace', 'numpy']
+# NUTS のウォームアップ回数 (--pathfinder-init のときは Pathfinder の結果から始めるので短くする)
+ITER_WARMUP = 1000
+PATHFINDER_INIT_WARMUP = 200
+# 近似推定で生成するドローの数
+APPROXIMATE_DRAWS = 1000
+# 要約と InferenceData に含めるパラメータ
+VAR_NAMES = ['beta', 'mu_alpha', 'sigma_alpha', 'alpha_task_raw', 'c', 'alpha_task']
+# プロットに使うので --keep-vars の指定によらず残すパラメータ
+PLOT_VAR_NAMES = ['beta', 'mu_alpha', 'sigma_alpha']
+# --stream-posterior のときに NUTS のドローを NetCDF のチャンクとして保存するディレクトリ
+POSTERIOR_DIR = 'dataset_for_bda/posterior'
+# --stream-posterior のときに CmdStan の出力 CSV を書き出すサブディレクトリ (POSTERIOR_DIR の下)
+CMDSTAN_CSV_DIR = 'cmdstan'
+# --stream-posterior のときに保存したチャンクから読み戻すパラメータ (beta のフォレストプロットは要約表から描く)
+STREAM_PLOT_VAR_NAMES = ['mu_alpha', 'sigma_alpha']
+# 前処理のキャッシュのバージョン (前処理の内容を変えたら上げて、古いキャッシュを使わないようにする)
+PREPROCESS_VERSION = 2
+# デバッグ用に保存する説明変数行列 (dense: Parquet, sparse: scipy の .npz)
+DEBUG_X_PATH = 'dataset_for_bda/df_model_input.tmp.parquet'
+DEBUG_X_SPARSE_PATH = 'dataset_for_bda/df_model_input.tmp.npz'
+
+
+def problem_count_matrix(rows: np.ndarray, problem_codes: np.ndarray, n_rows: int,
+                         min_count: int = 1, top_k: int | None = None) -> tuple[sparse.csr_matrix, np.ndarray]:
+    """
+    (タスクの行番号, problem のコード) の組から、タスクごとの problem の出現回数を CSR 行列にする。
+    出現回数 (コメント数) が min_count 未満の problem は除き、top_k を指定した場合は
+    出現回数の多い順 (同数ならコード順) に top_k 個だけ残す。
+    (出現回数の行列, 各列に対応する problem のコード) を返す。列はコードの昇順。
+    """
+    codes, cols = np.unique(problem_codes, return_inverse=True)
+    frequencies = np.bincount(cols, minlength=len(codes))
 
+    keep = frequencies >= min_count
+    if top_k is not None and keep.sum() > top_k:
+        candidates = np.flatnonzero(keep)
+        ranked = candidates[np.lexsort((candidates, -frequencies[candidates]))]
+        keep = np.zeros(len(codes), dtype=bool)
+        keep[ranked[:top_k]] = True
 
-def prepare_data(input_file: str) -> dict:
+    # 残す列に 0 から振り直した列番号を付け、同じ (行, 列) の組は CSR への変換時に合算される
+    new_cols = np.cumsum(keep) - 1
+    is_kept = keep[cols]
+    counts = sparse.csr_matrix(
+        (np.ones(is_kept.sum()), (rows[is_kept], new_cols[cols[is_kept]])),
+        shape=(n_rows, int(keep.sum())),
+    )
+    return counts, codes[keep]
+
+
+def load_features(input_file: str, min_count: int = 1, top_k: int | None = None, use_cache: bool = True) -> dict:
     """
-    CSVファイルを読み込み、集計と前処理を行い、Stanに渡すデータ辞書を作成する。
+    マージ済みのデータを読み込み、タスクごとの表と problem の出現回数の行列を作る。
+    目的変数や説明変数の組み合わせによらない前処理で、バッチ実行では一度だけ行う。
+    カテゴリ変数のコードはコード表 (FACTOR_CODES_PATH) に従い、実行をまたいで同じ値には同じコードを振る。
+    結果は入力ファイルの内容と設定をキーにキャッシュし (use_cache=True)、次回からはそれを読み込む。
+    {'tasks': タスクごとの DataFrame, 'problem_counts': CSR 行列, 'problem_count_vars': 各列の名前,
+     'n_task_categories': task_category のコード表の大きさ, 'key': キャッシュのキー (use_cache=False なら None)} を返す。
     """
+    def features_key():
+        # コード表が変われば (編集・削除・作り直し) 同じ入力でもコードが変わるので、キーに含める
+        return cache_key(existing_path(input_file), {'min_count': min_count, 'top_k': top_k, 'version': PREPROCESS_VERSION,
+                                                     'factor_codes': factor_codes_digest()})
+
+    key = features_key() if use_cache else None
+    cached = load_arrays('features', key) if use_cache else None
+    if cached is not None:
+        print(f"'{input_file}' の前処理結果をキャッシュから読み込みました。({cache_path('features', key)})")
+        tasks = pd.DataFrame({'id': cached['id'], 'task_category': cached['task_category']})
+        for name, values in zip(cached['rating_names'], cached['ratings'].T):
+            tasks[str(name)] = values
+        problem_counts = sparse.csr_matrix(
+            (cached['problem_data'], cached['problem_indices'], cached['problem_indptr']),
+            shape=tuple(cached['problem_shape']))
+        return {
+            'tasks': tasks,
+            'problem_counts': problem_counts,
+            'problem_count_vars': cached['problem_count_vars'].tolist(),
+            'n_task_categories': int(cached['n_task_categories']),
+            'key': key,
+        }
+
     print(f"'{input_file}' を読み込んでいます...")
-    df_merged = pd.read_csv(input_file)
+    df_merged = read_table(input_file)
     
     print("カテゴリ変数を数値コードに変換しています...")
     cols_to_factorize = [
@@ -27,138 +144,532 @@ def prepare_data(input_file: str) -> dict:
         'comment_verb',
         'comment_obj'
     ]
+    factor_codes = FactorCodes.load()
     for col in cols_to_factorize:
         if col in df_merged.columns:
-            df_merged[col] = pd.factorize(df_merged[col])[0]
+            df_merged[col] = factor_codes.encode(col, df_merged[col])
         else:
             print(f"警告: カラム '{col}' が見つかりませんでした。スキップします。")
+    factor_codes.save()
+    # コードは実行をまたいで振るので、入力にないカテゴリの分だけ番号が飛ぶことがある。
+    # Stan の J (task_id の上限) は入力にあるカテゴリの数ではなく、コード表の大きさにする
+    n_task_categories = len(factor_codes.tables.get('task_category', []))
 
     # --- 1. データ準備：集約と特徴量エンジニアリング ---
     print("コメントデータをタスクIDごとに集約しています...")
 
-    df_problems_onehot = pd.get_dummies(df_merged[['id', 'comment_problem']],
-                                        columns=['comment_problem'],
-                                        prefix='count_problem')
-
-    df_aggregated = df_problems_onehot.groupby('id').sum()
+    # タスクは id の出現順に1行ずつ
+    df_model_input = df_merged.drop_duplicates(subset='id').reset_index(drop=True)
+    task_rows = pd.Index(df_model_input['id']).get_indexer(df_merged['id'])
+    problem_counts, problem_codes = problem_count_matrix(
+        task_rows, df_merged['comment_problem'].to_numpy(), len(df_model_input), min_count, top_k)
+    problem_count_vars = [f'count_problem_{code}' for code in problem_codes]
 
-    df_tasks = df_merged.drop_duplicates(subset='id').set_index('id')
-    df_model_input = df_tasks.join(df_aggregated)
-    df_model_input.reset_index(inplace=True)
-
-    # nan を 0 で埋める
-    problem_count_vars = [col for col in df_model_input.columns if 'count_problem_' in col]
-    df_model_input[problem_count_vars] = df_model_input[problem_count_vars].fillna(0)
+    print(f"データ集約が完了しました。(problem {len(problem_codes)} 種類, 非ゼロ要素 {problem_counts.nnz} 個)")
+    tasks = df_model_input[['id', 'task_category'] + RATING_VARS]
+    if use_cache:
+        # 新しい値がコード表に追記された場合は、追記後のコード表で次回の実行が引くキーで保存する
+        key = features_key()
+        save_arrays('features', key, {
+            'id': tasks['id'].to_numpy(),
+            'task_category': tasks['task_category'].to_numpy(),
+            'rating_names': np.array(RATING_VARS),
+            'ratings': tasks[RATING_VARS].to_numpy(dtype=np.float64),
+            'problem_data': problem_counts.data,
+            'problem_indices': problem_counts.indices,
+            'problem_indptr': problem_counts.indptr,
+            'problem_shape': np.array(problem_counts.shape),
+            'problem_count_vars': np.array(problem_count_vars, dtype=str),
+            'n_task_categories': np.array(n_task_categories),
+        })
+    return {
+        'tasks': tasks,
+        'problem_counts': problem_counts,
+        'problem_count_vars': problem_count_vars,
+        'n_task_categories': n_task_categories,
+        'key': key,
+    }
 
-    print("データ集約が完了しました。")
 
-    # --- 2. 変数選択とStan用データ作成 ---
-    print("Stanモデル用のデータを準備しています...")
+def design_arrays(features: dict, outcome: str, predictor_set: str) -> dict[str, np.ndarray]:
+    """
+    目的変数・説明変数行列 (CSR の各配列)・説明変数名・標準化のパラメータを配列の辞書で返す。
+    (build_stan_data がキャッシュに保存する内容)
+    """
+    df_model_input = features['tasks']
 
-    y = df_model_input['usability_rating'].astype(int)
+    y = df_model_input[outcome].astype(int)
 
-    control_vars = ['aesthetics_rating', 'learnability', 'efficency', 'design_quality_rating']
-    problem_count_vars = [col for col in df_model_input.columns if 'count_problem_' in col]
+    use_controls, use_problems = PREDICTOR_SETS[predictor_set]
+    control_vars = [col for col in RATING_VARS if col != outcome] if use_controls else []
+    problem_count_vars = features['problem_count_vars'] if use_problems else []
     predictor_vars = control_vars + problem_count_vars
     
-    # 1. スケーラーを準備
-    scaler = StandardScaler()
-    
-    # 2. 元のdf_model_inputのcontrol_vars列を直接標準化して上書きする
-    df_model_input[control_vars] = scaler.fit_transform(df_model_input[control_vars])
+    # 1. control_vars を標準化する (problem の出現回数はそのまま)
+    blocks = []
+    scaler_mean = scaler_scale = np.zeros(0)
+    if control_vars:
+        scaler = StandardScaler()
+        blocks.append(sparse.csr_matrix(scaler.fit_transform(df_model_input[control_vars])))
+        scaler_mean, scaler_scale = scaler.mean_, scaler.scale_
+    if problem_count_vars:
+        blocks.append(features['problem_counts'])
     
-    # 3. 修正されたdf_model_inputからXを作成する
-    X = df_model_input[predictor_vars]
-    
-    # 3.5 Save X to tmp CSV file for debugging
-    X.to_csv('tmp_X.csv', index=False)
-    
-    # 4. NaNチェック
-    # if X.isnull().sum().sum() > 0:
-    #     print("\n致命的なエラー: 説明変数XにNaNが含まれています。処理を中断します。")
-    #     print(X.isnull().sum()[X.isnull().sum() > 0])
-    #     print("NaNが含まれるカラム:", X.columns[X.isnull().any()].tolist())
-    #     print("NaNが含まれる行数:", X[X.isnull().any(axis=1)].shape[0])
-    #     exit() # プログラムを終了
-    # else:
-    #     print("説明変数XのNaNチェック... 問題ありません。")
+    # 2. 標準化した control_vars と problem の出現回数を横に並べて X を作成する
+    X = sparse.hstack(blocks, format='csr')
 
     task_id = df_model_input['task_category'] + 1 # task_categoryは数値である必要がある
 
+    return {
+        'y': y.to_numpy(),
+        'task_id': task_id.to_numpy(),
+        'X_data': X.data,
+        'X_indices': X.indices,
+        'X_indptr': X.indptr,
+        'X_shape': np.array(X.shape),
+        'predictor_names': np.array(predictor_vars, dtype=str),
+        'control_vars': np.array(control_vars, dtype=str),
+        'scaler_mean': scaler_mean,
+        'scaler_scale': scaler_scale,
+    }
+
+
+def build_stan_data(features: dict, outcome: str = OUTCOME, predictor_set: str = 'full',
+                    design: str = 'sparse', save_debug: bool = False) -> dict:
+    """
+    load_features の結果から、outcome を目的変数、predictor_set (PREDICTOR_SETS) の説明変数で
+    Stanに渡すデータ辞書を作成する。評価の説明変数は outcome 以外の評価 (標準化したもの)。
+    design='sparse' の場合、説明変数行列は CSR 形式 (w, v, u) で渡す (csr_matrix_times_vector 用)。
+    design='dense' の場合は N x K の行列 X として渡す。
+    load_features がキャッシュを使った場合は、説明変数行列・目的変数・標準化のパラメータもキャッシュする。
+    """
+    if design not in STAN_FILES:
+        raise ValueError(f"無効な design です: '{design}'。{' または '.join(STAN_FILES)} を指定してください。")
+    if outcome not in RATING_VARS:
+        raise ValueError(f"無効な目的変数です: '{outcome}'。{', '.join(RATING_VARS)} のいずれかを指定してください。")
+    if predictor_set not in PREDICTOR_SETS:
+        raise ValueError(f"無効な説明変数の組です: '{predictor_set}'。{', '.join(PREDICTOR_SETS)} のいずれかを指定してください。")
+
+    # --- 2. 変数選択とStan用データ作成 ---
+    print(f"Stanモデル用のデータを準備しています... (目的変数: {outcome}, 説明変数: {predictor_set})")
+    cache_name = f'stan_data-{outcome}-{predictor_set}'
+    arrays = load_arrays(cache_name, features['key']) if features.get('key') else None
+    if arrays is None:
+        arrays = design_arrays(features, outcome, predictor_set)
+        if features.get('key'):
+            save_arrays(cache_name, features['key'], arrays)
+
+    X = sparse.csr_matrix((arrays['X_data'], arrays['X_indices'], arrays['X_indptr']), shape=tuple(arrays['X_shape']))
+    predictor_vars = arrays['predictor_names'].tolist()
+    
+    # 2.5 Save X for debugging
+    if save_debug:
+        if design == 'sparse':
+            sparse.save_npz(DEBUG_X_SPARSE_PATH, X)
+        else:
+            write_table(pd.DataFrame(X.toarray(), columns=predictor_vars), DEBUG_X_PATH)
+
+    y = arrays['y']
+    task_id = arrays['task_id']
+
     stan_data = {
-        'N': len(df_model_input),
+        'N': X.shape[0],
         'K': X.shape[1],
-        'J': task_id.nunique(),
-        'y': y.values,
-        'X': X.values,
-        'task_id': task_id.values,
+        'J': features['n_task_categories'], # 入力にないカテゴリのコードも含む (task_id <= J)
+        'L': max(int(y.max()), 2), # 評価の段階数 (learnability などは 1-5)
+        'y': y,
+        'task_id': task_id,
     }
+    if design == 'sparse':
+        # Stan の CSR 形式は列番号・行の開始位置とも 1 始まり
+        stan_data.update({
+            'NZ': X.nnz,
+            'w': X.data,
+            'v': X.indices + 1,
+            'u': X.indptr + 1,
+        })
+    else:
+        stan_data['X'] = X.toarray()
     
     stan_data['predictor_names'] = predictor_vars
 
     return stan_data
 
+
+def prepare_data(input_file: str, design: str = 'sparse', min_count: int = 1, top_k: int | None = None,
+                 outcome: str = OUTCOME, predictor_set: str = 'full', use_cache: bool = True) -> dict:
+    """
+    マージ済みのデータを読み込み、集計と前処理を行い、Stanに渡すデータ辞書を作成する。
+    (load_features と build_stan_data をまとめて行い、説明変数行列をデバッグ用に保存する)
+    """
+    if design not in STAN_FILES:
+        raise ValueError(f"無効な design です: '{design}'。{' または '.join(STAN_FILES)} を指定してください。")
+    features = load_features(input_file, min_count=min_count, top_k=top_k, use_cache=use_cache)
+    return build_stan_data(features, outcome=outcome, predictor_set=predictor_set, design=design, save_debug=True)
+
+def cmdstan_available() -> bool:
+    """cmdstanpy がインストールされていて、CmdStan の場所が分かるかどうか"""
+    try:
+        import cmdstanpy
+        cmdstanpy.cmdstan_path()
+    except (ImportError, ValueError):
+        return False
+    return True
+
+
+def run_approximation(model, stan_data: dict, method: str, seed: int = 1234):
+    """
+    NUTS の代わりに近似推定を行い、cmdstanpy の結果を返す。
+      'pathfinder': Pathfinder 変分推論
+      'variational': ADVI (meanfield)
+      'laplace': 事後分布のモードを最適化で求め、その周りのラプラス近似からドローを生成
+    """
+    if method == 'pathfinder':
+        return model.pathfinder(data=stan_data, seed=seed, draws=APPROXIMATE_DRAWS)
+    if method == 'variational':
+        return model.variational(data=stan_data, seed=seed, algorithm='meanfield', output_samples=APPROXIMATE_DRAWS)
+    if method == 'laplace':
+        mode = model.optimize(data=stan_data, seed=seed, jacobian=True)
+        return model.laplace_sample(data=stan_data, mode=mode, draws=APPROXIMATE_DRAWS, seed=seed)
+    raise ValueError(f"無効な推定方法です: '{method}'。{', '.join(METHODS)} のいずれかを指定してください。")
+
+
+def model_stan_file(design: str, threads_per_chain: int = 1) -> str:
+    """design とスレッド数に対応する Stan ファイル (2 スレッド以上なら reduce_sum 版)"""
+    return PARALLEL_STAN_FILES[design] if threads_per_chain > 1 else STAN_FILES[design]
+
+
+def load_stan_model(design: str, threads_per_chain: int = 1, stanc_o1: bool = False):
+    """コンパイル済みの Stan モデルをキャッシュから読み込む (なければコンパイルする)"""
+    from model_cache import load_model
+
+    return load_model(
+        model_stan_file(design, threads_per_chain),
+        cpp_options={'STAN_THREADS': True} if threads_per_chain > 1 else None,
+        stanc_options={'O1': True} if stanc_o1 else None,
+    )
+
+
+def fit_model(stan_data: dict, predictor_names: list[str], method: str = 'nuts', design: str = 'sparse',
+              chains: int = CHAINS, threads_per_chain: int = 1, grainsize: int = GRAINSIZE, stanc_o1: bool = False,
+              pathfinder_init: bool = False, iter_warmup: int | None = None, stream_posterior: bool = False,
+              posterior_dir: str = POSTERIOR_DIR, var_names: list[str] = VAR_NAMES,
+              show_progress: bool = True) -> tuple[pd.DataFrame, dict[str, np.ndarray]]:
+    """
+    stan_data を method で推定し、(要約表, プロット用のドロー) を返す。
+    要約表の beta の行には説明変数名 (Variable 列) を付ける。
+    プロット用のドローは PLOT_VAR_NAMES のパラメータ -> (チェーン, ドロー, ...) の配列。
+    stream_posterior のときは CmdStan の実行中に出力 CSV を読み進めて要約し、
+    プロット用のドローは STREAM_PLOT_VAR_NAMES だけになる (beta は要約表の分位点から描く)。
+    """
+    parallel = threads_per_chain > 1
+    if parallel:
+        stan_data = {**stan_data, 'grainsize': grainsize}
+
+    if method == 'numpy':
+        print("NumPy 実装で MAP 推定とラプラス近似を行っています...")
+        start = time.perf_counter()
+        draws, mode_info = fit_laplace(stan_data, draws=APPROXIMATE_DRAWS)
+        print(f"\n所要時間: 推定 (numpy) {time.perf_counter() - start:.1f}秒 "
+              f"(L-BFGS {mode_info['iterations']} 回, 収束: {'はい' if mode_info['converged'] else 'いいえ'}, "
+              f"正定値でなかった固有値: {mode_info['n_clamped_eigenvalues']} 個)")
+    else:
+        # Stanモデルのコンパイル
+        print(f"'{model_stan_file(design, threads_per_chain)}' を読み込んでいます (キャッシュになければコンパイルします)...")
+        model, compiled, load_seconds = load_stan_model(design, threads_per_chain, stanc_o1)
+        print(f"{'コンパイル' if compiled else 'キャッシュからの読み込み'}: {load_seconds:.1f}秒 ({model.exe_file})")
+
+        start = time.perf_counter()
+        if method == 'nuts':
+            inits = None
+            warmup = iter_warmup or ITER_WARMUP
+            if pathfinder_init:
+                print("Pathfinder で NUTS の初期値を求めています...")
+                inits = run_approximation(model, stan_data, 'pathfinder').create_inits(seed=1234, chains=chains)
+                warmup = iter_warmup or PATHFINDER_INIT_WARMUP
+
+            # MCMCサンプリングの実行
+            print("MCMCサンプリングを実行しています...（数分かかる場合があります）")
+            sample_options = dict(
+                data=stan_data,
+                seed=1234,
+                chains=chains,
+                parallel_chains=chains,
+                iter_warmup=warmup,
+                iter_sampling=1000,
+                inits=inits,
+                threads_per_chain=threads_per_chain if parallel else None,
+                show_progress=show_progress
+            )
+            if stream_posterior:
+                # fit 全体をメモリに載せず、CmdStan が書き込んでいる CSV をサンプリング中から少しずつ読んで要約・保存する
+                csv_dir = os.path.join(posterior_dir, CMDSTAN_CSV_DIR)
+                fit, summary_df, sampler_info = stream_cmdstan_run(
+                    lambda: model.sample(output_dir=csv_dir, **sample_options), csv_dir, posterior_dir,
+                    var_names=var_names)
+            else:
+                fit = model.sample(**sample_options)
+        else:
+            print(f"'{method}' で近似推定を行っています...")
+            fit = run_approximation(model, stan_data, method)
+        sampling_seconds = time.perf_counter() - start
+        print(f"\n所要時間: {'コンパイル' if compiled else 'モデルの読み込み'} {load_seconds:.1f}秒, 推定 ({method}) {sampling_seconds:.1f}秒")
+
+        if method == 'nuts':
+            # 収束診断
+            print("\n収束診断 (Rhat < 1.05 が望ましい):")
+            print(fit.diagnose())
+
+    # 結果の要約
+    if method == 'nuts' and stream_posterior:
+        print(f"ダイバージェンス: {sampler_info['divergences']} 回 (ドローは '{posterior_dir}' に保存しました)")
+        plot_draws = load_draws(posterior_dir, STREAM_PLOT_VAR_NAMES)
+    elif method == 'nuts':
+        summary_df = fit.summary()
+        plot_draws = extract_draws(fit, PLOT_VAR_NAMES, chains=chains)
+    else:
+        # 近似推定のドローは1チェーンとして扱う
+        if method != 'numpy':
+            draws = extract_draws(fit, var_names, chains=1, method=method)
+        draws = {name: draws[name] for name in var_names}
+        summary_df = summarize_draws(draws)
+        plot_draws = {name: draws[name] for name in PLOT_VAR_NAMES}
+
+    # βの係数名を設定
+    beta_rows = [f'beta[{i+1}]' for i in range(len(predictor_names))]
+    summary_df['Variable'] = pd.Series(predictor_names, index=beta_rows)
+    return summary_df, plot_draws
+
+
+def display_rows(summary_df: pd.DataFrame) -> pd.DataFrame:
+    """関心のあるパラメータ (PLOT_VAR_NAMES) の行だけを返す"""
+    return summary_df[summary_df.index.str.match(rf"(?:{'|'.join(PLOT_VAR_NAMES)})(?:\[|$)")]
+
+
+def plot_summary_forest(summaries: list[pd.DataFrame], model_names: list[str]) -> None:
+    """
+    要約表の beta の行 (Variable 列が説明変数名) から、中央値と 5%~95% 区間のフォレストプロットを描く。
+    --stream-posterior で beta のドローを読み戻さないときに az.plot_forest の代わりに使う。
+    """
+    _, ax = plt.subplots(figsize=(10, 8))
+    names = list(dict.fromkeys(name for summary_df in summaries for name in summary_df['Variable'].dropna()))
+    offsets = np.linspace(-0.3, 0.3, len(summaries)) if len(summaries) > 1 else [0.0]
+    for summary_df, model_name, offset in zip(summaries, model_names, offsets):
+        rows = summary_df.dropna(subset=['Variable']).set_index('Variable')
+        y = np.array([len(names) - 1 - names.index(name) for name in rows.index]) + offset
+        ax.hlines(y, rows['5%'], rows['95%'])
+        ax.plot(rows['50%'], y, 'o', label=model_name)
+    ax.set_yticks(range(len(names)), names[::-1])
+    ax.axvline(0, color='gray', linestyle='--', linewidth=0.8)
+    ax.set_xlabel('beta (median and 5%-95% interval)')
+    if len(summaries) > 1:
+        ax.legend()
+
+
+def run_batch_job(job: dict) -> tuple[str, str, pd.DataFrame, dict[str, np.ndarray], list[str]]:
+    """バッチ実行の1件分 (プロセスプールのワーカーで実行する)"""
+    stan_data = dict(job['stan_data'])
+    predictor_names = stan_data.pop('predictor_names')
+    summary_df, plot_draws = fit_model(stan_data, predictor_names, **job['fit_options'])
+    return job['outcome'], job['predictor_set'], display_rows(summary_df), plot_draws, predictor_names
+
+
+def run_batch(args, method: str, var_names: list[str]) -> None:
+    """
+    目的変数 (--batch-outcomes) と説明変数の組 (--batch-predictor-sets) の全ての組み合わせを推定する。
+    前処理は一度だけ行い、推定はプロセスプールで並列に実行する。
+    同時に実行する推定の数は、コア数 (--cores) を1件あたりのコア数 (チェーン数 x スレッド数) で割ったもの。
+    結果は一つの比較表 (BATCH_SUMMARY_PATH) と一つのフォレストプロット (BATCH_FOREST_PLOT_PATH) にまとめる。
+    """
+    features = load_features(INPUT_PATH, min_count=args.min_count, top_k=args.top_k, use_cache=not args.no_data_cache)
+    combinations = [(outcome, predictor_set)
+                    for outcome in args.batch_outcomes for predictor_set in args.batch_predictor_sets]
+
+    # ワーカーが同時にコンパイルしないように、先にキャッシュに入れておく
+    if method != 'numpy':
+        try:
+            load_stan_model(args.design, args.threads_per_chain, args.stanc_o1)
+        except Exception as e:
+            print(f"モデルのコンパイル中にエラーが発生しました: {e}")
+            return
+
+    cores_per_fit = 1 if method == 'numpy' else (CHAINS if method == 'nuts' else 1) * args.threads_per_chain
+    workers = max(1, min(len(combinations), args.cores // cores_per_fit))
+    print(f"\n{len(combinations)} 件のモデルを {workers} 件ずつ並列に推定します "
+          f"(コア数 {args.cores}, 1件あたり {cores_per_fit} コア)...")
+
+    jobs = [{
+        'outcome': outcome,
+        'predictor_set': predictor_set,
+        'stan_data': build_stan_data(features, outcome=outcome, predictor_set=predictor_set, design=args.design),
+        'fit_options': {
+            'method': method,
+            'design': args.design,
+            'threads_per_chain': args.threads_per_chain,
+            'grainsize': args.grainsize,
+            'stanc_o1': args.stanc_o1,
+            'pathfinder_init': args.pathfinder_init,
+            'iter_warmup': args.iter_warmup,
+            'stream_posterior': args.stream_posterior,
+            'posterior_dir': os.path.join(POSTERIOR_DIR, f'{outcome}-{predictor_set}'),
+            'var_names': var_names,
+            'show_progress': False,
+        },
+    } for outcome, predictor_set in combinations]
+
+    start = time.perf_counter()
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_batch_job, job): (job['outcome'], job['predictor_set']) for job in jobs}
+        for future in as_completed(futures):
+            outcome, predictor_set = futures[future]
+            try:
+                results[(outcome, predictor_set)] = future.result()[2:]
+            except Exception as e:
+                print(f"エラー: {outcome} / {predictor_set} の推定に失敗しました: {e}")
+                continue
+            print(f"完了: {outcome} / {predictor_set}")
+    print(f"\nバッチ実行の所要時間: {time.perf_counter() - start:.1f}秒 ({len(results)}/{len(jobs)} 件成功)")
+    if not results:
+        return
+
+    # 比較表: 組み合わせごとの関心のあるパラメータの要約を縦に並べる
+    ordered = [key for key in combinations if key in results]
+    frames = []
+    for outcome, predictor_set in ordered:
+        summary_df = results[(outcome, predictor_set)][0]
+        frame = summary_df.rename_axis('parameter').reset_index()
+        frame.insert(0, 'predictor_set', predictor_set)
+        frame.insert(0, 'outcome', outcome)
+        frames.append(frame)
+    comparison = pd.concat(frames, ignore_index=True)
+    write_table(comparison, BATCH_SUMMARY_PATH)
+    print(f"比較表を '{BATCH_SUMMARY_PATH}' として保存しました。")
+
+    # 評価の係数と階層のパラメータの平均を、組み合わせごとに横に並べて表示する
+    shown = comparison[comparison['Variable'].isin(RATING_VARS) | comparison['parameter'].isin(['mu_alpha', 'sigma_alpha'])]
+    print(shown.assign(name=shown['Variable'].fillna(shown['parameter']))
+          .pivot_table(index='name', columns=['outcome', 'predictor_set'], values='Mean', sort=False))
+
+    # 全ての組み合わせの beta を一つのフォレストプロットに描く (--stream-posterior なら要約表から)
+    model_names = [f'{outcome}/{predictor_set}' for outcome, predictor_set in ordered]
+    if all('beta' in results[key][1] for key in ordered):
+        az.plot_forest(
+            [to_inference_data(results[key][1], results[key][2]) for key in ordered],
+            model_names=model_names,
+            var_names=['beta'],
+            combined=True,
+            hdi_prob=0.94,
+            figsize=(10, 8),
+            r_hat=False
+        )
+    else:
+        plot_summary_forest([results[key][0] for key in ordered], model_names)
+    plt.title('Effect of predictors on each rating (beta coefficients)')
+    plt.savefig(BATCH_FOREST_PLOT_PATH, dpi=300, bbox_inches='tight')
+    plt.close()
+    print(f"フォレストプロットを '{BATCH_FOREST_PLOT_PATH}' として保存しました。")
+
+
 def main():
     """
     メイン処理
     """
+    parser = argparse.ArgumentParser(description="階層順序ロジスティック回帰モデルを推定する")
+    parser.add_argument('--design', choices=list(STAN_FILES), default='sparse',
+                        help="説明変数行列を疎行列 (CSR) と密行列のどちらで Stan に渡すか (既定: sparse)")
+    parser.add_argument('--min-count', type=int, default=1,
+                        help="説明変数に含める problem の最小出現回数 (既定: 1)")
+    parser.add_argument('--top-k', type=int, default=None,
+                        help="出現回数の多い problem を最大この数だけ説明変数に含める (既定: 全て)")
+    parser.add_argument('--threads-per-chain', type=int, default=1,
+                        help="1チェーンあたりのスレッド数。2 以上なら reduce_sum 版のモデルをスレッド対応でコンパイルする (既定: 1)")
+    parser.add_argument('--grainsize', type=int, default=GRAINSIZE,
+                        help=f"reduce_sum の grainsize (既定: {GRAINSIZE})")
+    parser.add_argument('--stanc-o1', action='store_true',
+                        help="stanc の O1 最適化を有効にしてコンパイルする")
+    parser.add_argument('--method', choices=METHODS, default='nuts',
+                        help="推定方法 (既定: nuts)。pathfinder, variational, laplace は探索用の高速な近似, numpy は CmdStan を使わない MAP + ラプラス近似")
+    parser.add_argument('--pathfinder-init', action='store_true',
+                        help=f"Pathfinder の結果を NUTS の初期値にし、ウォームアップを {PATHFINDER_INIT_WARMUP} 回に短縮する")
+    parser.add_argument('--iter-warmup', type=int, default=None,
+                        help=f"NUTS のウォームアップ回数 (既定: {ITER_WARMUP}, --pathfinder-init のときは {PATHFINDER_INIT_WARMUP})")
+    parser.add_argument('--stream-posterior', action='store_true',
+                        help=f"NUTS の実行中から出力 CSV を少しずつ読んで要約し、ドローを '{POSTERIOR_DIR}' に NetCDF のチャンクとして保存する "
+                             "(メモリ使用量がドロー数によらない。分位点はヒストグラムによる近似、N_Eff はバッチ平均法、R_hat は split R_hat。"
+                             "beta のフォレストプロットは要約表の 5%%~95%% 区間で描く)")
+    parser.add_argument('--keep-vars', nargs='+', choices=VAR_NAMES, default=None,
+                        help=f"要約と保存に含めるパラメータ (既定: 全て。{', '.join(PLOT_VAR_NAMES)} は常に含める)")
+    parser.add_argument('--outcome', choices=RATING_VARS, default=OUTCOME,
+                        help=f"目的変数にする評価 (既定: {OUTCOME})。残りの評価は説明変数になる")
+    parser.add_argument('--predictor-set', choices=list(PREDICTOR_SETS), default='full',
+                        help="説明変数の組: full (他の評価 + problem), controls (他の評価のみ), problems (problem のみ) (既定: full)")
+    parser.add_argument('--batch', action='store_true',
+                        help="--batch-outcomes と --batch-predictor-sets の全ての組み合わせを並列に推定し、結果を比較表とフォレストプロットにまとめる")
+    parser.add_argument('--batch-outcomes', nargs='+', choices=RATING_VARS, default=RATING_VARS,
+                        help="バッチ実行で目的変数にする評価 (既定: 全て)")
+    parser.add_argument('--batch-predictor-sets', nargs='+', choices=list(PREDICTOR_SETS), default=list(PREDICTOR_SETS),
+                        help="バッチ実行で使う説明変数の組 (既定: 全て)")
+    parser.add_argument('--cores', type=int, default=os.cpu_count() or 1,
+                        help="バッチ実行で使うコア数の合計。全ての推定のチェーン (x スレッド) でこの数を分け合う (既定: CPU のコア数)")
+    parser.add_argument('--no-data-cache', action='store_true',
+                        help="前処理のキャッシュ (.cache/stan_data) を使わずに、入力ファイルから前処理をやり直す")
+    args = parser.parse_args()
+    var_names = VAR_NAMES if args.keep_vars is None else [
+        name for name in VAR_NAMES if name in args.keep_vars or name in PLOT_VAR_NAMES]
+
+    # CmdStan がなければ NumPy 実装のラプラス近似で推定する
+    method = args.method
+    if method != 'numpy' and not cmdstan_available():
+        print("CmdStan (または cmdstanpy) が見つからないため、NumPy 実装のラプラス近似 (--method numpy) で推定します。")
+        method = 'numpy'
+
+    if args.batch:
+        run_batch(args, method, var_names)
+        return
+
     # データの準備
-    stan_data = prepare_data(INPUT_CSV)
+    stan_data = prepare_data(INPUT_PATH, design=args.design, min_count=args.min_count, top_k=args.top_k,
+                             outcome=args.outcome, predictor_set=args.predictor_set,
+                             use_cache=not args.no_data_cache)
     predictor_names = stan_data.pop('predictor_names') # Stanに渡さないので取り出しておく
 
-    # Stanモデルのコンパイル
-    print(f"'{STAN_FILE}' をコンパイルしています...")
-    try:
-        model = CmdStanModel(stan_file=STAN_FILE)
-    except Exception as e:
-        print(f"モデルのコンパイル中にエラーが発生しました: {e}")
-        return
+    # Stanモデルのコンパイル (キャッシュにあれば読み込むだけ)
+    if method != 'numpy':
+        try:
+            load_stan_model(args.design, args.threads_per_chain, args.stanc_o1)
+        except Exception as e:
+            print(f"モデルのコンパイル中にエラーが発生しました: {e}")
+            return
 
-    # MCMCサンプリングの実行
-    print("MCMCサンプリングを実行しています...（数分かかる場合があります）")
-    fit = model.sample(
-        data=stan_data,
-        seed=1234,
-        chains=4,
-        parallel_chains=4,
-        iter_warmup=1000,
-        iter_sampling=1000,
-        show_progress=True
+    summary_df, plot_draws = fit_model(
+        stan_data, predictor_names, method=method, design=args.design,
+        threads_per_chain=args.threads_per_chain, grainsize=args.grainsize, stanc_o1=args.stanc_o1,
+        pathfinder_init=args.pathfinder_init, iter_warmup=args.iter_warmup,
+        stream_posterior=args.stream_posterior, var_names=var_names,
     )
-    
-    # 収束診断
-    print("\n収束診断 (Rhat < 1.05 が望ましい):")
-    print(fit.diagnose())
 
     # 結果の要約
     print("\n推定結果の要約:")
-    summary_df = fit.summary()
-    # βの係数名を設定
-    beta_rows = [f'beta[{i+1}]' for i in range(len(predictor_names))]
-    summary_df.loc[beta_rows, 'Variable'] = predictor_names
-    
     # 関心のあるパラメータのみ表示
-    display_vars = ['beta', 'mu_alpha', 'sigma_alpha']
-    print(summary_df[summary_df.index.str.contains('|'.join(display_vars))])
+    print(display_rows(summary_df))
     
     # プロットの生成
-    # (ArviZの変換コードは同じ)
-    idata = az.from_cmdstanpy(
-        posterior=fit,
-        coords={'predictor': predictor_names},
-        dims={'beta': ['predictor']}
-    )
+    idata = to_inference_data(plot_draws, predictor_names)
 
-    # フォレストプロットを描画
-    az.plot_forest(
-        idata,
-        var_names=['beta'],
-        filter_vars="regex",
-        combined=True,
-        hdi_prob=0.94,
-        figsize=(10, 8),
-        r_hat=False
-    )
+    # フォレストプロットを描画 (--stream-posterior なら beta のドローは読み戻さず、要約表の分位点から描く)
+    if 'beta' in plot_draws:
+        az.plot_forest(
+            idata,
+            var_names=['beta'],
+            filter_vars="regex",
+            combined=True,
+            hdi_prob=0.94,
+            figsize=(10, 8),
+            r_hat=False
+        )
+    else:
+        plot_summary_forest([summary_df], [args.outcome])
     plt.title('Effect of UI Problems on Usability Rating (beta coefficients)')
 
     # -------------------------------------------------
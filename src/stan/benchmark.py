@@ -0,0 +1,310 @@
+"""
+階層順序ロジスティック回帰モデル (src/stan/1/*.stan) のベンチマーク
+
+モデルの生成過程 (事前分布からパラメータを引き、順序ロジスティック分布から y を生成) に従って
+N (タスク数), K (説明変数の数), J (task_category の数) の格子の各点でデータを作り、
+モデルの種類 (dense, sparse, reduce_sum 版) ごとに NUTS で推定して次を記録する。
+  - コンパイル (またはキャッシュからの読み込み) の秒数
+  - ウォームアップとサンプリングの秒数 (CmdStan の出力 CSV の Elapsed Time, 最も遅いチェーン)
+  - 最小の ESS (bulk / tail) と 1秒あたりの ESS, ダイバージェンスの数, 最大の R_hat
+  - beta の真の値が 90% 区間に入った割合 (推定が正しく較正されているかの簡単な確認)
+結果は1件1行の JSON (REPORT_PATH) に追記するので、モデルの変更前後を --compare で比べられる。
+
+使い方 (リポジトリのルートで実行):
+    python src/stan/benchmark.py                                 # 既定の格子で dense と sparse を測る
+    python src/stan/benchmark.py --n 1000 --k 50 400 --j 6 --variants sparse sparse_parallel --threads-per-chain 2
+    python src/stan/benchmark.py --compare                       # 同じ条件の前回の結果と比べる
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import re
+import subprocess
+import time
+
+import numpy as np
+import arviz as az
+from scipy import sparse
+from scipy.special import expit
+
+# 測定するモデル: 名前 -> (Stan ファイル, 説明変数行列の渡し方, reduce_sum 版かどうか)
+VARIANTS = {
+    'dense': ('src/stan/1/hierarchical_ordered_logistic.stan', 'dense', False),
+    'sparse': ('src/stan/1/hierarchical_ordered_logistic_sparse.stan', 'sparse', False),
+    'dense_parallel': ('src/stan/1/hierarchical_ordered_logistic_parallel.stan', 'dense', True),
+    'sparse_parallel': ('src/stan/1/hierarchical_ordered_logistic_sparse_parallel.stan', 'sparse', True),
+}
+# 既定の格子
+N_VALUES = [200, 1000, 5000]
+K_VALUES = [4, 50, 400]
+J_VALUES = [6, 30]
+# 評価の段階数 (usability_rating と同じ 1-10)
+LEVELS = 10
+# 標準化した評価の列の数 (残りの K - CONTROLS 列は problem の出現回数)
+CONTROLS = 4
+# 1タスクあたりのコメント数の平均 (problem の出現回数の行列の疎らさを決める)
+COMMENTS_PER_TASK = 5
+CHAINS = 4
+ITER_WARMUP = 500
+ITER_SAMPLING = 500
+GRAINSIZE = 1
+# 結果の保存先 (1件1行の JSON)
+REPORT_PATH = '.cache/benchmarks/stan_benchmark.jsonl'
+# --compare で 1秒あたりの ESS がこの割合を下回ったら悪化とみなす
+REGRESSION_RATIO = 0.8
+# 診断に使うパラメータ
+DIAGNOSTIC_VARS = ['beta', 'mu_alpha', 'sigma_alpha', 'c']
+
+
+def simulate(n: int, k: int, j: int, levels: int = LEVELS, seed: int = 1234) -> dict:
+    """
+    モデルの生成過程に従ってデータを作る。
+    説明変数は実データと同じく、標準化した評価 (CONTROLS 列) と problem の出現回数 (残りの列, 疎) を並べたもの。
+    problem は出現しやすさに偏りがある (Zipf 分布に近い) ようにする。
+    {'X': CSR 行列, 'y', 'task_id' (1 始まり), 'params': 真のパラメータ} を返す。
+    """
+    rng = np.random.default_rng(seed)
+    n_controls = min(CONTROLS, k)
+    n_problems = k - n_controls
+
+    blocks = [sparse.csr_matrix(rng.standard_normal((n, n_controls)))]
+    if n_problems:
+        comments = rng.poisson(COMMENTS_PER_TASK, size=n)
+        weights = 1 / np.arange(1, n_problems + 1)
+        rows = np.repeat(np.arange(n), comments)
+        cols = rng.choice(n_problems, size=len(rows), p=weights / weights.sum())
+        blocks.append(sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n_problems)))
+    X = sparse.hstack(blocks, format='csr')
+
+    # 事前分布からパラメータを引く (カットポイントには事前分布がないので、評価が散らばるように置く)
+    beta = rng.normal(0, 1, size=k)
+    # problem の係数は出現回数を掛けて足し合わされるので、線形予測子が大きくなりすぎないよう小さめにする
+    beta[n_controls:] *= 0.3
+    mu_alpha = rng.normal(0, 1)
+    sigma_alpha = abs(rng.standard_t(3))
+    alpha_task_raw = rng.normal(0, 1, size=j)
+    alpha_task = mu_alpha + sigma_alpha * alpha_task_raw
+    task_id = rng.integers(1, j + 1, size=n)
+    eta = alpha_task[task_id - 1] + X @ beta
+    c = np.sort(rng.normal(np.median(eta), max(eta.std(), 1.0), size=levels - 1))
+
+    # P(y <= l) = logistic(c_l - eta) なので、一様乱数が何個の累積確率を超えるかで y が決まる
+    u = rng.uniform(size=n)
+    y = 1 + (u[:, None] > expit(c[None, :] - eta[:, None])).sum(axis=1)
+
+    return {
+        'X': X,
+        'y': y,
+        'task_id': task_id,
+        'params': {'beta': beta, 'mu_alpha': mu_alpha, 'sigma_alpha': sigma_alpha, 'c': c},
+    }
+
+
+def to_stan_data(data: dict, design: str, levels: int = LEVELS, grainsize: int | None = None) -> dict:
+    """simulate の結果を Stan に渡すデータ辞書にする (run.py の build_stan_data と同じ形)"""
+    X = data['X']
+    stan_data = {
+        'N': X.shape[0],
+        'K': X.shape[1],
+        'J': int(data['task_id'].max()),
+        'L': levels,
+        'y': data['y'],
+        'task_id': data['task_id'],
+    }
+    if design == 'sparse':
+        stan_data.update({'NZ': X.nnz, 'w': X.data, 'v': X.indices + 1, 'u': X.indptr + 1})
+    else:
+        stan_data['X'] = X.toarray()
+    if grainsize is not None:
+        stan_data['grainsize'] = grainsize
+    return stan_data
+
+
+def elapsed_seconds(csv_file: str) -> tuple[float, float]:
+    """CmdStan の出力 CSV の末尾のコメントから (ウォームアップ, サンプリング) の秒数を読む"""
+    warmup = sampling = float('nan')
+    with open(csv_file, encoding='utf-8') as f:
+        for line in f:
+            if not line.startswith('#'):
+                continue
+            match = re.search(r'([\d.eE+-]+) seconds \((Warm-up|Sampling)\)', line)
+            if match:
+                if match.group(2) == 'Warm-up':
+                    warmup = float(match.group(1))
+                else:
+                    sampling = float(match.group(1))
+    return warmup, sampling
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_case(variant: str, n: int, k: int, j: int, chains: int = CHAINS, iter_warmup: int = ITER_WARMUP,
+             iter_sampling: int = ITER_SAMPLING, threads_per_chain: int = 1, seed: int = 1234) -> dict:
+    """格子の1点を1つのモデルで推定し、測定結果の辞書 (レポートの1行) を返す"""
+    import cmdstanpy
+    from model_cache import load_model
+
+    stan_file, design, parallel = VARIANTS[variant]
+    data = simulate(n, k, j, seed=seed)
+    stan_data = to_stan_data(data, design, grainsize=GRAINSIZE if parallel else None)
+
+    model, compiled, compile_seconds = load_model(stan_file, cpp_options={'STAN_THREADS': True} if parallel else None)
+
+    start = time.perf_counter()
+    fit = model.sample(
+        data=stan_data,
+        seed=seed,
+        chains=chains,
+        parallel_chains=chains,
+        iter_warmup=iter_warmup,
+        iter_sampling=iter_sampling,
+        threads_per_chain=threads_per_chain if parallel else None,
+        show_progress=False,
+    )
+    wall_seconds = time.perf_counter() - start
+
+    # チェーンは並列に動くので、最も遅いチェーンの時間を使う
+    elapsed = np.array([elapsed_seconds(csv_file) for csv_file in fit.runset.csv_files])
+    warmup_seconds, sampling_seconds = elapsed.max(axis=0)
+
+    idata = az.from_cmdstanpy(posterior=fit)
+    diagnostics = az.summary(idata, var_names=DIAGNOSTIC_VARS, kind='diagnostics')
+    ess_bulk = float(diagnostics['ess_bulk'].min())
+
+    # beta の真の値が 90% 区間に入った割合 (較正されていれば 0.9 前後)
+    beta_draws = fit.stan_variable('beta')
+    lower, upper = np.quantile(beta_draws, [0.05, 0.95], axis=0)
+    coverage = float(np.mean((lower <= data['params']['beta']) & (data['params']['beta'] <= upper)))
+
+    return {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'cmdstan': '.'.join(map(str, cmdstanpy.cmdstan_version() or ())),
+        'variant': variant,
+        'N': n,
+        'K': k,
+        'J': j,
+        'NZ': int(data['X'].nnz),
+        'chains': chains,
+        'iter_warmup': iter_warmup,
+        'iter_sampling': iter_sampling,
+        'threads_per_chain': threads_per_chain if parallel else 1,
+        'seed': seed,
+        'compiled': compiled,
+        'compile_seconds': round(compile_seconds, 3),
+        'warmup_seconds': float(warmup_seconds),
+        'sampling_seconds': float(sampling_seconds),
+        'wall_seconds': round(wall_seconds, 3),
+        'ess_bulk_min': ess_bulk,
+        'ess_tail_min': float(diagnostics['ess_tail'].min()),
+        'ess_bulk_per_second': ess_bulk / (warmup_seconds + sampling_seconds),
+        'divergences': int(fit.method_variables()['divergent__'].sum()),
+        'rhat_max': float(diagnostics['r_hat'].max()),
+        'beta_coverage_90': coverage,
+    }
+
+
+def append_report(record: dict, path: str = REPORT_PATH) -> None:
+    output_dir = os.path.dirname(path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def load_report(path: str = REPORT_PATH) -> list[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def case_key(record: dict) -> tuple:
+    """同じ条件の測定かどうかを判定するキー"""
+    return tuple(record[name] for name in
+                 ['variant', 'N', 'K', 'J', 'chains', 'iter_warmup', 'iter_sampling', 'threads_per_chain', 'seed'])
+
+
+def compare_report(records: list[dict], ratio: float = REGRESSION_RATIO) -> list[str]:
+    """
+    条件ごとに最新の測定を一つ前の測定と比べて表示し、1秒あたりの ESS が ratio 倍を下回った
+    (または ダイバージェンスが増えた) 条件を悪化として返す。
+    """
+    by_case = {}
+    for record in records:
+        by_case.setdefault(case_key(record), []).append(record)
+
+    regressions = []
+    for key, history in by_case.items():
+        if len(history) < 2:
+            continue
+        previous, latest = history[-2], history[-1]
+        change = latest['ess_bulk_per_second'] / previous['ess_bulk_per_second'] if previous['ess_bulk_per_second'] else float('nan')
+        label = f"{latest['variant']} N={latest['N']} K={latest['K']} J={latest['J']}"
+        print(f"{label}: ESS/秒 {previous['ess_bulk_per_second']:.1f} -> {latest['ess_bulk_per_second']:.1f} ({change:.2f} 倍), "
+              f"ダイバージェンス {previous['divergences']} -> {latest['divergences']} "
+              f"({previous.get('git_commit')} -> {latest.get('git_commit')})")
+        if change < ratio or latest['divergences'] > previous['divergences']:
+            regressions.append(label)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="階層順序ロジスティック回帰モデルのベンチマーク (シミュレーションデータ)")
+    parser.add_argument('--n', type=int, nargs='+', default=N_VALUES, help=f"タスク数 (既定: {N_VALUES})")
+    parser.add_argument('--k', type=int, nargs='+', default=K_VALUES, help=f"説明変数の数 (既定: {K_VALUES})")
+    parser.add_argument('--j', type=int, nargs='+', default=J_VALUES, help=f"task_category の数 (既定: {J_VALUES})")
+    parser.add_argument('--variants', nargs='+', choices=list(VARIANTS), default=['dense', 'sparse'],
+                        help="測定するモデル (既定: dense sparse)")
+    parser.add_argument('--chains', type=int, default=CHAINS, help=f"チェーン数 (既定: {CHAINS})")
+    parser.add_argument('--iter-warmup', type=int, default=ITER_WARMUP, help=f"ウォームアップ回数 (既定: {ITER_WARMUP})")
+    parser.add_argument('--iter-sampling', type=int, default=ITER_SAMPLING, help=f"サンプリング回数 (既定: {ITER_SAMPLING})")
+    parser.add_argument('--threads-per-chain', type=int, default=2,
+                        help="reduce_sum 版のモデルの1チェーンあたりのスレッド数 (既定: 2)")
+    parser.add_argument('--seed', type=int, default=1234, help="データ生成とサンプリングの乱数シード")
+    parser.add_argument('--report', default=REPORT_PATH, help=f"結果を追記するファイル (既定: {REPORT_PATH})")
+    parser.add_argument('--compare', action='store_true', help="測定はせず、条件ごとに最新の結果を前回と比べる")
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare_report(load_report(args.report))
+        if regressions:
+            print(f"\n悪化した条件: {', '.join(regressions)}")
+        return
+
+    try:
+        import cmdstanpy
+        cmdstanpy.cmdstan_path()
+    except (ImportError, ValueError):
+        print("エラー: CmdStan (または cmdstanpy) が見つかりません。src/stan/setup.py でインストールしてください。")
+        return
+
+    cases = list(itertools.product(args.variants, args.n, args.k, args.j))
+    for i, (variant, n, k, j) in enumerate(cases, 1):
+        print(f"[{i}/{len(cases)}] {variant} N={n} K={k} J={j} ...")
+        try:
+            record = run_case(variant, n, k, j, chains=args.chains, iter_warmup=args.iter_warmup,
+                              iter_sampling=args.iter_sampling, threads_per_chain=args.threads_per_chain,
+                              seed=args.seed)
+        except Exception as e:
+            print(f"エラー: {variant} N={n} K={k} J={j} の推定に失敗しました: {e}")
+            continue
+        append_report(record, args.report)
+        print(f"  コンパイル {record['compile_seconds']:.1f}秒{'' if record['compiled'] else ' (キャッシュ)'}, "
+              f"ウォームアップ {record['warmup_seconds']:.1f}秒, サンプリング {record['sampling_seconds']:.1f}秒, "
+              f"ESS/秒 {record['ess_bulk_per_second']:.1f}, ダイバージェンス {record['divergences']}, "
+              f"最大 R_hat {record['rhat_max']:.3f}, beta の 90% 区間の被覆率 {record['beta_coverage_90']:.2f}")
+    print(f"\n結果を '{args.report}' に追記しました。")
+
+
+if __name__ == '__main__':
+    main()
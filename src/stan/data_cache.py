@@ -0,0 +1,113 @@
+"""
+prepare_data の前処理結果のキャッシュと、カテゴリ変数の安定したコード表
+
+前処理の結果 (集約した行列, 標準化のパラメータ, Stan に渡す配列など) は、
+入力ファイルの内容と前処理の設定から作るキーごとに .npz として保存する
+(.cache/stan_data/<名前>-<キー>.npz)。同じキーのファイルがあれば読み込むだけで済む。
+
+カテゴリ変数のコードは列ごとのコード表 (FACTOR_CODES_PATH) に追記していくので、
+一度コードを振った値は以後の実行でも (入力ファイルが変わっても) 同じコードになり、
+count_problem_<コード> などの係数を推定結果の間で比べられる。
+前処理結果はこのコードを含むので、キャッシュのキーにはコード表の内容も含める (factor_codes_digest)。
+コード表は実行ごとに作られる生成物なので git では管理しない (消すと pd.factorize と同じコードから振り直す)。
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# 前処理結果の保存先 (リポジトリのルートから実行することを想定)
+DATA_CACHE_DIR = '.cache/stan_data'
+# カテゴリ変数のコード表 (列名 -> コードの順に並べた値)。推定結果の解釈に必要なのでデータと一緒に置く
+FACTOR_CODES_PATH = 'dataset_for_bda/factor_codes.json'
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def factor_codes_digest(path: str = FACTOR_CODES_PATH) -> str | None:
+    """コード表の内容のハッシュ (コード表がなければ None)"""
+    return file_digest(path) if os.path.exists(path) else None
+
+
+def cache_key(input_file: str, settings: dict) -> str:
+    """入力ファイルの内容と前処理の設定から作るキャッシュのキー"""
+    identity = json.dumps({'input': file_digest(input_file), 'settings': settings}, sort_keys=True, default=str)
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:16]
+
+
+def cache_path(name: str, key: str, cache_dir: str = DATA_CACHE_DIR) -> str:
+    return os.path.join(cache_dir, f'{name}-{key}.npz')
+
+
+def load_arrays(name: str, key: str, cache_dir: str = DATA_CACHE_DIR) -> dict[str, np.ndarray] | None:
+    """キャッシュがあれば 配列名 -> 配列 の辞書を返し、なければ None"""
+    path = cache_path(name, key, cache_dir)
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+
+def save_arrays(name: str, key: str, arrays: dict[str, np.ndarray], cache_dir: str = DATA_CACHE_DIR) -> str:
+    """配列の辞書を .npz に保存する (書きかけのファイルが残らないように一時ファイルから置き換える)"""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(name, key, cache_dir)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **{name: np.asarray(values) for name, values in arrays.items()})
+    os.replace(tmp_path, path)
+    return path
+
+
+class FactorCodes:
+    """
+    列ごとのコード表。encode は表にある値には同じコードを、新しい値には出現順に続きのコードを振る。
+    表が空の状態から始めた場合のコードは pd.factorize と同じ (欠損値は -1)。
+
+        codes = FactorCodes.load()
+        df['task_category'] = codes.encode('task_category', df['task_category'])
+        codes.save()
+    """
+
+    def __init__(self, tables: dict[str, list[str]] | None = None, path: str = FACTOR_CODES_PATH):
+        self.tables = tables or {}
+        self.path = path
+        self.changed = False
+
+    @classmethod
+    def load(cls, path: str = FACTOR_CODES_PATH) -> 'FactorCodes':
+        if not os.path.exists(path):
+            return cls(path=path)
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f), path=path)
+
+    def encode(self, column: str, values: pd.Series) -> np.ndarray:
+        table = self.tables.setdefault(column, [])
+        uniques = pd.unique(values.dropna().astype(str))
+        known = set(table)
+        new_values = [value for value in uniques if value not in known]
+        if new_values:
+            table.extend(new_values)
+            self.changed = True
+
+        codes = pd.Index(table).get_indexer(values.astype(str))
+        return np.where(values.isna(), -1, codes)
+
+    def save(self) -> None:
+        """新しい値が追加されたときだけ書き出す"""
+        if not self.changed:
+            return
+        output_dir = os.path.dirname(self.path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(self.tables, f, ensure_ascii=False, indent=2)
+        self.changed = False
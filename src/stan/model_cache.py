@@ -0,0 +1,59 @@
+"""
+コンパイル済みの Stan モデルのキャッシュ
+
+Stan ファイルの内容・CmdStan のバージョン・コンパイルオプション (STAN_THREADS, stanc の O1 など) から
+キーを作り、キーごとのディレクトリ (.cache/stan_models/<モデル名>-<キー>) に実行ファイルを保存する。
+同じキーの実行ファイルがあればコンパイルせずに読み込むので、オプション違いのモデルが
+互いを再コンパイルさせることはない。
+"""
+
+import hashlib
+import json
+import os
+import platform
+import shutil
+import time
+
+import cmdstanpy
+from cmdstanpy import CmdStanModel
+
+# コンパイル済みモデルの保存先 (リポジトリのルートから実行することを想定)
+MODEL_CACHE_DIR = '.cache/stan_models'
+
+
+def model_key(stan_file: str, cpp_options: dict | None = None, stanc_options: dict | None = None) -> str:
+    """Stan ファイルの内容, CmdStan のバージョン, コンパイルオプションから作るキャッシュのキー"""
+    with open(stan_file, 'rb') as f:
+        source = hashlib.sha256(f.read()).hexdigest()
+    identity = json.dumps({
+        'source': source,
+        'cmdstan': '.'.join(map(str, cmdstanpy.cmdstan_version() or ())),
+        'cpp_options': cpp_options or {},
+        'stanc_options': stanc_options or {},
+        'platform': [platform.system(), platform.machine()],
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:16]
+
+
+def load_model(stan_file: str, cpp_options: dict | None = None, stanc_options: dict | None = None,
+               cache_dir: str = MODEL_CACHE_DIR) -> tuple[CmdStanModel, bool, float]:
+    """
+    キャッシュにある実行ファイルを読み込み、なければコンパイルしてキャッシュに保存する。
+    (モデル, コンパイルしたかどうか, 読み込み/コンパイルにかかった秒数) を返す。
+    """
+    name = os.path.splitext(os.path.basename(stan_file))[0]
+    model_dir = os.path.join(cache_dir, f'{name}-{model_key(stan_file, cpp_options, stanc_options)}')
+    cached_stan_file = os.path.join(model_dir, f'{name}.stan')
+    exe_file = os.path.join(model_dir, f'{name}.exe' if os.name == 'nt' else name)
+
+    start = time.perf_counter()
+    if os.path.exists(exe_file):
+        model = CmdStanModel(stan_file=cached_stan_file, exe_file=exe_file, compile=False)
+        return model, False, time.perf_counter() - start
+
+    # 実行ファイルは Stan ファイルと同じディレクトリに作られるので、キャッシュのディレクトリにコピーしてからコンパイルする
+    os.makedirs(model_dir, exist_ok=True)
+    shutil.copyfile(stan_file, cached_stan_file)
+    model = CmdStanModel(stan_file=cached_stan_file, cpp_options=cpp_options, stanc_options=stanc_options,
+                         compile='force')
+    return model, True, time.perf_counter() - start
@@ -0,0 +1,186 @@
+"""
+hierarchical_ordered_logistic.stan と同じモデルの NumPy/SciPy 実装 (CmdStan がない環境用)
+
+Stan と同じ制約なしのパラメータ空間 (sigma_alpha は対数, カットポイント c は先頭と差の対数) で、
+ヤコビアン込みの対数事後密度を解析的な勾配とともに計算し、L-BFGS で最大化する。
+事後分布はモードの周りのラプラス近似 (ヘッセ行列は勾配の有限差分) で表し、
+CmdStan の laplace_sample と同じようにドローを生成する。
+ドローは posterior.py と同じ形 (パラメータ名 -> (チェーン, ドロー, ...)) で返す。
+"""
+
+import numpy as np
+from scipy import optimize, sparse
+from scipy.special import expit
+
+# stan_data に段階数 L がない場合のカットポイントの数 (1-10 の評価なので9個の境界)
+N_CUTPOINTS = 9
+# ヘッセ行列の有限差分の刻み幅
+HESSIAN_STEP = 1e-5
+# -H の固有値がこれ x 最大固有値 より小さい方向は正定値でないとみなし、この値まで引き上げる
+MIN_EIGENVALUE_RATIO = 1e-8
+
+
+class OrderedLogitModel:
+    """
+    prepare_data が作る stan_data (密行列の X, または CSR 形式の w, v, u) を受け取り、
+    制約なしのパラメータベクトル theta に対する対数事後密度とその勾配を計算する。
+    theta の並び: beta (K), mu_alpha, log(sigma_alpha), alpha_task_raw (J), c の制約なし表現 (L - 1)
+    """
+
+    def __init__(self, stan_data: dict):
+        self.N, self.K, self.J = int(stan_data['N']), int(stan_data['K']), int(stan_data['J'])
+        if 'X' in stan_data:
+            self.X = sparse.csr_matrix(np.asarray(stan_data['X'], dtype=np.float64))
+        else:
+            self.X = sparse.csr_matrix(
+                (np.asarray(stan_data['w'], dtype=np.float64), np.asarray(stan_data['v']) - 1, np.asarray(stan_data['u']) - 1),
+                shape=(self.N, self.K),
+            )
+        self.XT = self.X.T.tocsr()
+        self.y = np.asarray(stan_data['y'], dtype=np.int64)
+        self.task = np.asarray(stan_data['task_id'], dtype=np.int64) - 1
+        self.n_cutpoints = int(stan_data.get('L', N_CUTPOINTS + 1)) - 1
+        if self.y.min() < 1 or self.y.max() > self.n_cutpoints + 1:
+            raise ValueError(f"y は 1 から {self.n_cutpoints + 1} の範囲である必要があります (Stan の ordered_logistic と同じ)。")
+
+        # 各データの下側と上側のカットポイントの番号 (0 始まり, 範囲外は -inf / +inf)
+        self.lower = self.y - 2
+        self.upper = self.y - 1
+        self.has_lower = self.lower >= 0
+        self.has_upper = self.upper < self.n_cutpoints
+
+        self.slices = {}
+        offset = 0
+        for name, size in [('beta', self.K), ('mu_alpha', 1), ('log_sigma_alpha', 1),
+                           ('alpha_task_raw', self.J), ('c_raw', self.n_cutpoints)]:
+            self.slices[name] = slice(offset, offset + size)
+            offset += size
+        self.n_params = offset
+
+    def initial_point(self) -> np.ndarray:
+        """beta, alpha は 0、カットポイントは y の累積割合のロジット"""
+        theta = np.zeros(self.n_params)
+        counts = np.bincount(self.y - 1, minlength=self.n_cutpoints + 1)
+        cumulative = np.clip(np.cumsum(counts)[:-1] / len(self.y), 1e-3, 1 - 1e-3)
+        c = np.maximum.accumulate(np.log(cumulative / (1 - cumulative)) + np.arange(self.n_cutpoints) * 1e-3)
+        theta[self.slices['c_raw']] = np.concatenate([[c[0]], np.log(np.maximum(np.diff(c), 1e-3))])
+        return theta
+
+    def constrain(self, theta: np.ndarray) -> dict[str, np.ndarray]:
+        """制約なしのパラメータを Stan のパラメータ (と transformed parameters) に変換する"""
+        mu_alpha = theta[self.slices['mu_alpha']][0]
+        sigma_alpha = np.exp(theta[self.slices['log_sigma_alpha']][0])
+        alpha_task_raw = theta[self.slices['alpha_task_raw']]
+        c_raw = theta[self.slices['c_raw']]
+        return {
+            'beta': theta[self.slices['beta']],
+            'mu_alpha': mu_alpha,
+            'sigma_alpha': sigma_alpha,
+            'alpha_task_raw': alpha_task_raw,
+            'c': np.cumsum(np.concatenate([c_raw[:1], np.exp(c_raw[1:])])),
+            'alpha_task': mu_alpha + sigma_alpha * alpha_task_raw,
+        }
+
+    def log_density(self, theta: np.ndarray) -> tuple[float, np.ndarray]:
+        """ヤコビアン込みの対数事後密度 (定数項を除く) と theta に対する勾配"""
+        params = self.constrain(theta)
+        beta, sigma_alpha, c = params['beta'], params['sigma_alpha'], params['c']
+        eta = params['alpha_task'][self.task] + self.X @ beta
+
+        # P(y = k) = F(c_k - eta) - F(c_{k-1} - eta) (F はロジスティック関数) を対数で安定に計算する
+        #   log P = log F(b) + log(1 - F(a)) + log(1 - exp(a - b))   (a = c_{k-1} - eta, b = c_k - eta)
+        a = np.where(self.has_lower, c[np.clip(self.lower, 0, None)] - eta, -np.inf)
+        b = np.where(self.has_upper, c[np.clip(self.upper, 0, self.n_cutpoints - 1)] - eta, np.inf)
+        with np.errstate(over='ignore', divide='ignore'):
+            inv_expm1 = 1 / np.expm1(b - a)
+            log_lik = -np.logaddexp(0, -b) - np.logaddexp(0, a) + np.log1p(-np.exp(a - b))
+        F_a, F_b = expit(a), expit(b)
+
+        # d log P / da, d log P / db, d log P / d eta
+        d_a = -F_a - inv_expm1
+        d_b = (1 - F_b) + inv_expm1
+        d_eta = F_a + F_b - 1
+
+        grad_c = (np.bincount(self.lower[self.has_lower], weights=d_a[self.has_lower], minlength=self.n_cutpoints)
+                  + np.bincount(self.upper[self.has_upper], weights=d_b[self.has_upper], minlength=self.n_cutpoints))
+        grad_alpha_task = np.bincount(self.task, weights=d_eta, minlength=self.J)
+
+        mu_alpha, alpha_task_raw = params['mu_alpha'], params['alpha_task_raw']
+        log_sigma = theta[self.slices['log_sigma_alpha']][0]
+        c_raw = theta[self.slices['c_raw']]
+        value = (log_lik.sum()
+                 - 0.5 * beta @ beta
+                 - 0.5 * mu_alpha ** 2
+                 - 2 * np.log1p(sigma_alpha ** 2 / 3)     # student_t(3, 0, 1)
+                 - 0.5 * alpha_task_raw @ alpha_task_raw
+                 + log_sigma + c_raw[1:].sum())           # 制約なしの空間へのヤコビアン
+
+        grad = np.empty(self.n_params)
+        grad[self.slices['beta']] = self.XT @ d_eta - beta
+        grad[self.slices['mu_alpha']] = grad_alpha_task.sum() - mu_alpha
+        grad[self.slices['log_sigma_alpha']] = (
+            sigma_alpha * (grad_alpha_task @ alpha_task_raw - 4 * sigma_alpha / (3 + sigma_alpha ** 2)) + 1)
+        grad[self.slices['alpha_task_raw']] = sigma_alpha * grad_alpha_task - alpha_task_raw
+        # c_k = c_raw_1 + sum_{j<=k, j>=2} exp(c_raw_j) なので、c_raw_j の勾配は j 以降の c の勾配の和
+        tail_sums = np.cumsum(grad_c[::-1])[::-1]
+        grad[self.slices['c_raw']] = np.concatenate([tail_sums[:1], np.exp(c_raw[1:]) * tail_sums[1:] + 1])
+        return value, grad
+
+    def find_mode(self, max_iter: int = 10000) -> optimize.OptimizeResult:
+        """L-BFGS で対数事後密度を最大化する"""
+        def negative(theta):
+            value, grad = self.log_density(theta)
+            return -value, -grad
+        return optimize.minimize(negative, self.initial_point(), jac=True, method='L-BFGS-B',
+                                 options={'maxiter': max_iter, 'maxfun': max_iter * 2})
+
+    def hessian(self, theta: np.ndarray, step: float = HESSIAN_STEP) -> np.ndarray:
+        """解析的な勾配の中心差分によるヘッセ行列 (対称化したもの)"""
+        H = np.empty((self.n_params, self.n_params))
+        for i in range(self.n_params):
+            shift = np.zeros(self.n_params)
+            shift[i] = step
+            H[i] = (self.log_density(theta + shift)[1] - self.log_density(theta - shift)[1]) / (2 * step)
+        return (H + H.T) / 2
+
+    def laplace_draws(self, theta: np.ndarray, draws: int = 1000, seed: int = 1234) -> tuple[dict[str, np.ndarray], int]:
+        """
+        モードの周りの正規近似 (共分散は -H の逆行列) から制約なしの空間でドローを生成し、
+        (Stan のパラメータに変換した (1, draws, ...) の配列, 引き上げた固有値の数) を返す。
+        -H が正定値でない (theta がモードでない, または平坦な方向がある) 場合は、
+        小さすぎる固有値を MIN_EIGENVALUE_RATIO x 最大固有値 まで引き上げて警告を表示する。
+        その方向の分散は非常に大きくなるので、そのドローは信用できない。
+        """
+        precision = -self.hessian(theta)
+        eigenvalues, eigenvectors = np.linalg.eigh(precision)
+        floor = MIN_EIGENVALUE_RATIO * max(eigenvalues.max(), 1.0)
+        n_clamped = int((eigenvalues < floor).sum())
+        if n_clamped:
+            print(f"警告: ヘッセ行列が正定値ではありません。{len(eigenvalues)} 個中 {n_clamped} 個の固有値 "
+                  f"(最小 {eigenvalues.min():.3g}) を {floor:.3g} に引き上げました。"
+                  f"ラプラス近似のドローはその方向に非常に広がります。")
+        eigenvalues = np.maximum(eigenvalues, floor)
+        rng = np.random.default_rng(seed)
+        z = rng.standard_normal((draws, self.n_params))
+        samples = theta + (z / np.sqrt(eigenvalues)) @ eigenvectors.T
+
+        constrained = [self.constrain(sample) for sample in samples]
+        return {name: np.stack([np.asarray(c[name]) for c in constrained])[None] for name in constrained[0]}, n_clamped
+
+
+def fit_laplace(stan_data: dict, draws: int = 1000, seed: int = 1234) -> tuple[dict[str, np.ndarray], dict]:
+    """
+    MAP 推定とラプラス近似を行い、(ドロー, モードの情報) を返す。
+    モードの情報は 'mode' (Stan のパラメータの値), 'converged', 'iterations', 'log_density',
+    'n_clamped_eigenvalues' (ヘッセ行列が正定値でなく引き上げた固有値の数, 0 でなければドローは信用できない)。
+    """
+    model = OrderedLogitModel(stan_data)
+    result = model.find_mode()
+    info = {
+        'mode': model.constrain(result.x),
+        'converged': bool(result.success),
+        'iterations': int(result.nit),
+        'log_density': float(-result.fun),
+    }
+    draws, info['n_clamped_eigenvalues'] = model.laplace_draws(result.x, draws=draws, seed=seed)
+    return draws, info
@@ -0,0 +1,490 @@
+"""
+推定方法 (NUTS, Pathfinder, ADVI, Laplace 近似) によらず、事後分布のドローを同じ形で扱う
+
+ドローは パラメータ名 -> (チェーン, ドロー, *パラメータの形) の配列 の辞書で表し、
+そこから CmdStan の summary と同じ行名 (beta[1] など) の要約表と、ArviZ の InferenceData を作る。
+大きな推定結果は stream_cmdstan_run で CmdStan の実行中に出力 CSV を少しずつ読み、
+ドロー数によらないメモリで要約 (分位点はヒストグラムによる近似、ESS はバッチ平均法) しながら
+ドローを NetCDF のチャンクとして保存できる。
+"""
+
+import os
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+import arviz as az
+import xarray as xr
+
+# 要約表に出す分位点 (CmdStan の summary と同じ列名になる)
+SUMMARY_QUANTILES = (0.05, 0.5, 0.95)
+
+
+def extract_draws(fit, var_names: list[str], chains: int = 1, method: str = 'nuts') -> dict[str, np.ndarray]:
+    """
+    cmdstanpy の推定結果からドローを取り出す。
+    fit.stan_variable() はチェーンを連結した (チェーン数 x ドロー数, ...) の配列を返すので、チェーンごとに分ける。
+    """
+    draws = {}
+    for name in var_names:
+        # ADVI の結果は mean=False を指定しないとドローではなく平均を返す
+        values = fit.stan_variable(name, mean=False) if method == 'variational' else fit.stan_variable(name)
+        values = np.asarray(values)
+        draws[name] = values.reshape((chains, -1) + values.shape[1:])
+    return draws
+
+
+def element_names(name: str, shape: tuple[int, ...]) -> list[str]:
+    """'beta', (3,) -> ['beta[1]', 'beta[2]', 'beta[3]'] (CmdStan と同じ 1 始まり, 行優先)"""
+    if not shape:
+        return [name]
+    return [f"{name}[{','.join(str(i + 1) for i in index)}]" for index in np.ndindex(*shape)]
+
+
+def summarize_draws(draws: dict[str, np.ndarray]) -> pd.DataFrame:
+    """
+    パラメータの要素ごとに平均, 標準偏差, 分位点をまとめた表を返す。
+    行名と列名 (Mean, StdDev, 5%, 50%, 95%) は CmdStan の summary に合わせる。
+    チェーンが複数あれば N_Eff と R_hat も加える。
+    """
+    frames = []
+    for name, values in draws.items():
+        n_chains, n_draws = values.shape[:2]
+        flat = values.reshape(n_chains * n_draws, -1)
+        frame = pd.DataFrame({
+            'Mean': flat.mean(axis=0),
+            'StdDev': flat.std(axis=0, ddof=1) if len(flat) > 1 else np.zeros(flat.shape[1]),
+        }, index=element_names(name, values.shape[2:]))
+        quantiles = np.quantile(flat, SUMMARY_QUANTILES, axis=0)
+        for q, column in zip(SUMMARY_QUANTILES, quantiles):
+            frame[f'{q:.0%}'] = column
+        if n_chains > 1:
+            by_element = values.reshape(n_chains, n_draws, -1)
+            frame['N_Eff'] = [az.ess(by_element[:, :, i]) for i in range(by_element.shape[2])]
+            frame['R_hat'] = [az.rhat(by_element[:, :, i]) for i in range(by_element.shape[2])]
+        frames.append(frame)
+    return pd.concat(frames)
+
+
+def to_inference_data(draws: dict[str, np.ndarray], predictor_names: list[str]) -> az.InferenceData:
+    """beta の次元に説明変数名を付けた InferenceData を作る (az.from_cmdstanpy と同じ座標)"""
+    return az.from_dict(
+        posterior=draws,
+        coords={'predictor': predictor_names},
+        dims={'beta': ['predictor']},
+    )
+
+
+# --- CmdStan の出力 CSV を少しずつ読み、要約と保存を行う ---
+
+# 一度に要約・保存するドローの数
+STREAM_CHUNK_SIZE = 200
+# 分位点を求めるヒストグラムのビンの数
+HISTOGRAM_BINS = 2048
+# ヒストグラムの中心と尺度を決めるまでに貯めるドローの数
+HISTOGRAM_WARMUP = 100
+# ヒストグラムが覆う asinh((x - 中心) / 尺度) の範囲 (±この値。尺度の約 1500 倍までのドローを数える)
+HISTOGRAM_SPAN = 8.0
+# チェーンごとに持つバッチ平均の数の上限 (偶数。溜まったら隣り合う2つずつまとめてバッチを倍の長さにする)
+MAX_BATCHES = 32
+# CmdStan の実行中に出力 CSV を読みに行く間隔 (秒)
+POLL_SECONDS = 1.0
+
+
+class HistogramQuantiles:
+    """
+    列ごとのヒストグラムによる分位点の逐次推定。
+    最初の HISTOGRAM_WARMUP ドローの中央値と四分位範囲で列を標準化し、asinh で変換した値を等幅のビンで数える。
+    中心付近のビンは細かく、裾のビンは粗くなるので、裾の重い分布でも範囲を広げ直す必要がない。
+    分位点はビンの中で線形に補間するので、np.quantile との差は分位点のあるビンの幅 (x の単位) 程度に収まる
+    (ビン幅は 尺度 x cosh(u) x 2 x HISTOGRAM_SPAN / bins。正規分布の 5%, 95% 点では標準偏差の 1% 程度)。
+    メモリは (列数 x ビン数) でドロー数によらない。HISTOGRAM_WARMUP ドロー未満のときは受け取ったドローの分位点を返す。
+    """
+
+    def __init__(self, n_columns: int, bins: int = HISTOGRAM_BINS, quantiles: tuple[float, ...] = SUMMARY_QUANTILES):
+        self.n_columns = n_columns
+        self.bins = bins
+        self.quantiles = quantiles
+        self.first = []
+        self.counts = None
+
+    def update(self, values: np.ndarray) -> None:
+        if self.counts is None:
+            self.first.append(values)
+            if sum(len(part) for part in self.first) < HISTOGRAM_WARMUP:
+                return
+            values = np.concatenate(self.first)
+            self.first = []
+            self.center = np.median(values, axis=0)
+            scale = np.subtract(*np.quantile(values, [0.75, 0.25], axis=0))
+            self.scale = np.where(scale > 0, scale, np.maximum(np.abs(self.center), 1.0))
+            self.counts = np.zeros((self.n_columns, self.bins))
+
+        u = np.arcsinh((values - self.center) / self.scale)
+        index = np.clip(((u + HISTOGRAM_SPAN) / (2 * HISTOGRAM_SPAN) * self.bins).astype(np.int64), 0, self.bins - 1)
+        flat = (np.arange(self.n_columns) * self.bins + index).ravel()
+        self.counts += np.bincount(flat, minlength=self.counts.size).reshape(self.counts.shape)
+
+    def edges(self, index: np.ndarray) -> np.ndarray:
+        """列ごとのビン index の下端 (x の単位)"""
+        return self.center + self.scale * np.sinh(-HISTOGRAM_SPAN + index * 2 * HISTOGRAM_SPAN / self.bins)
+
+    def result(self) -> np.ndarray:
+        """(分位点, 列) の推定値"""
+        if self.counts is None:
+            return np.quantile(np.concatenate(self.first), self.quantiles, axis=0)
+
+        cumulative = np.cumsum(self.counts, axis=1)
+        total = cumulative[:, -1]
+        rows = np.arange(self.n_columns)
+        estimates = []
+        for q in self.quantiles:
+            # np.quantile (linear) と同じ 1 始まりの順位 q (n - 1) + 1 のドローが入っているビンを探し、その中で補間する
+            rank = q * (total - 1) + 1
+            index = np.minimum((cumulative < rank[:, None]).sum(axis=1), self.bins - 1)
+            before = np.where(index > 0, cumulative[rows, np.maximum(index - 1, 0)], 0)
+            fraction = np.clip((rank - before - 0.5) / np.maximum(self.counts[rows, index], 1), 0, 1)
+            lower, upper = self.edges(index), self.edges(index + 1)
+            estimates.append(lower + fraction * (upper - lower))
+        return np.array(estimates)
+
+
+def _merge_moments(a: tuple, b: tuple) -> tuple:
+    """(ドロー数, 平均, 偏差平方和) の2組をまとめる (Chan の並列版 Welford 法)"""
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    total = n_a + n_b
+    delta = mean_b - mean_a
+    return total, mean_a + delta * n_b / total, m2_a + m2_b + delta ** 2 * n_a * n_b / total
+
+
+def _moments(values: np.ndarray) -> tuple:
+    mean = values.mean(axis=0)
+    return len(values), mean, ((values - mean) ** 2).sum(axis=0)
+
+
+class ChainBatches:
+    """
+    1チェーンのドローを同じ長さのバッチに分け、バッチごとの (ドロー数, 平均, 偏差平方和) を持つ。
+    バッチが MAX_BATCHES 個溜まったら隣り合う2つずつまとめてバッチの長さを倍にするので、
+    チェーンの長さを前もって知らなくても、バッチの数は MAX_BATCHES / 2 から MAX_BATCHES の間に保たれる。
+    最後の書きかけのバッチは split R_hat と ESS には使わない。
+    """
+
+    def __init__(self):
+        self.size = 1
+        self.batches = []
+        self.partial = None
+
+    def update(self, values: np.ndarray) -> None:
+        while len(values):
+            filled = 0 if self.partial is None else self.partial[0]
+            take = values[:self.size - filled]
+            values = values[len(take):]
+            moments = _moments(take)
+            self.partial = moments if self.partial is None else _merge_moments(self.partial, moments)
+            if self.partial[0] == self.size:
+                self.batches.append(self.partial)
+                self.partial = None
+                if len(self.batches) == MAX_BATCHES:
+                    self.batches = [_merge_moments(a, b) for a, b in zip(self.batches[::2], self.batches[1::2])]
+                    self.size *= 2
+
+
+class OnlineSummary:
+    """
+    ドローを少しずつ受け取り、列 (パラメータの要素) ごとの平均・分散 (Welford 法)、
+    ヒストグラムによる分位点、チェーンごとのバッチ平均 (split R_hat と ESS 用) を求める。
+    メモリはドロー数によらず列数に比例する。
+    """
+
+    def __init__(self, columns: list[str]):
+        self.columns = list(columns)
+        self.quantiles = HistogramQuantiles(len(columns))
+        # チェーン -> (ドロー数, 平均, 偏差平方和)
+        self.chains = {}
+        # チェーン -> ChainBatches
+        self.batches = {}
+
+    def update(self, chain: int, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        moments = _moments(values)
+        self.chains[chain] = moments if chain not in self.chains else _merge_moments(self.chains[chain], moments)
+        self.batches.setdefault(chain, ChainBatches()).update(values)
+        self.quantiles.update(values)
+
+    def summary(self) -> pd.DataFrame:
+        """Mean, StdDev, 分位点, N_Eff, R_hat の表"""
+        counts = np.array([n for n, _, _ in self.chains.values()])
+        means = np.array([mean for _, mean, _ in self.chains.values()])
+        m2s = np.array([m2 for _, _, m2 in self.chains.values()])
+
+        total = counts.sum()
+        mean = (counts[:, None] * means).sum(axis=0) / total
+        m2 = m2s.sum(axis=0) + (counts[:, None] * (means - mean) ** 2).sum(axis=0)
+        frame = pd.DataFrame({
+            'Mean': mean,
+            'StdDev': np.sqrt(m2 / max(total - 1, 1)),
+        }, index=self.columns)
+
+        for q, column in zip(SUMMARY_QUANTILES, self.quantiles.result()):
+            frame[f'{q:.0%}'] = column
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frame['N_Eff'] = batch_means_ess(list(self.batches.values()))
+            frame['R_hat'] = split_rhat(list(self.batches.values()))
+        return frame
+
+
+def batch_means_ess(chains: list[ChainBatches]) -> np.ndarray:
+    """
+    バッチ平均法による有効サンプルサイズ: ドロー数 N x チェーン内の分散 / (バッチの長さ x バッチ平均の分散)。
+    完成したバッチのドローだけを使う。自己相関を直接推定する Stan (az.ess) の ESS とは推定量が違い、
+    バッチの数 (チェーンあたり MAX_BATCHES / 2 ~ MAX_BATCHES) が少ないぶん値のばらつきも大きい。
+    """
+    n_draws, within, batch_variance, dof = 0, 0.0, 0.0, 0
+    for batches in chains:
+        if len(batches.batches) < 2:
+            continue
+        n, mean, m2 = batches.batches[0]
+        for batch in batches.batches[1:]:
+            n, mean, m2 = _merge_moments((n, mean, m2), batch)
+        batch_means = np.array([batch_mean for _, batch_mean, _ in batches.batches])
+        n_draws += n
+        within = within + m2
+        batch_variance = batch_variance + batches.size * ((batch_means - mean) ** 2).sum(axis=0)
+        dof += len(batches.batches) - 1
+    if n_draws == 0:
+        return np.nan
+    return n_draws * (within / n_draws) / (batch_variance / dof)
+
+
+def split_rhat(chains: list[ChainBatches]) -> np.ndarray:
+    """
+    split R_hat (Gelman ほか, BDA3 11.4): 各チェーンの完成したバッチを前半と後半に分けて 2 x チェーン数 本の列とみなし、
+    Gelman-Rubin の式を当てはめる (バッチの数が奇数なら真ん中のバッチを除く)。
+    Stan 2.x の fit.summary() と同じ、順位正規化をしない split R_hat。
+    """
+    halves = []
+    for batches in chains:
+        half = len(batches.batches) // 2
+        if half == 0:
+            continue
+        for part in (batches.batches[:half], batches.batches[-half:]):
+            moments = part[0]
+            for batch in part[1:]:
+                moments = _merge_moments(moments, batch)
+            halves.append(moments)
+    if len(halves) < 2:
+        return np.nan
+
+    n = min(count for count, _, _ in halves)
+    means = np.array([mean for _, mean, _ in halves])
+    within = np.mean([m2 / max(count - 1, 1) for count, _, m2 in halves], axis=0)
+    between = n * means.var(axis=0, ddof=1)
+    pooled = (n - 1) / n * within + between / n
+    return np.sqrt(pooled / within)
+
+
+def parse_cmdstan_column(column: str) -> tuple[str, tuple[int, ...]]:
+    """CmdStan の CSV の列名 'beta.3' / 'x.1.2' -> ('beta', (3,)) / ('x', (1, 2))"""
+    name, *index = column.split('.')
+    return name, tuple(int(i) for i in index)
+
+
+class CsvTail:
+    """
+    書き込み中かもしれない CmdStan の出力 CSV を、前回読んだ位置から読み進める。
+    '#' で始まる行 (設定と適応の情報) を飛ばし、最初の行を列名とする。書きかけの最後の行は次の read まで持ち越す。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+        self.rest = b''
+        self.header = None
+
+    def read(self) -> np.ndarray:
+        """前回から増えた完成した行 (ドロー x 列)"""
+        if not os.path.exists(self.path):
+            return np.empty((0, 0))
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        self.offset += len(data)
+        *lines, self.rest = (self.rest + data).split(b'\n')
+
+        rows = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith(b'#'):
+                continue
+            if self.header is None:
+                self.header = line.decode().split(',')
+            else:
+                rows.append(line.decode().split(','))
+        if not rows:
+            return np.empty((0, len(self.header or [])))
+        return np.array(rows, dtype=np.float64)
+
+
+class CmdStanCsvStream:
+    """
+    CmdStan の出力 CSV (1ファイル1チェーン) を、届いた行から chunk_size ドローずつ要約し、
+    var_names (省略時は全てのパラメータ) のドローを output_dir に NetCDF のチャンクとして保存する。
+    poll はサンプリング中に何度呼んでもよく、finish で残りを読み切って結果を返す。
+    """
+
+    def __init__(self, output_dir: str, var_names: list[str] | None = None, chunk_size: int = STREAM_CHUNK_SIZE):
+        # 前回の実行のチャンクが混ざらないように消しておく
+        os.makedirs(output_dir, exist_ok=True)
+        for file_name in os.listdir(output_dir):
+            if file_name.endswith('.nc'):
+                os.remove(os.path.join(output_dir, file_name))
+        self.output_dir = output_dir
+        self.var_names = var_names
+        self.chunk_size = chunk_size
+        self.summary = None
+        self.divergences = 0
+        # チェーン -> CsvTail, 溜めている行, 保存したチャンクの数
+        self.tails = {}
+        self.pending = {}
+        self.parts = {}
+
+    def poll(self, csv_files: list[str]) -> None:
+        for chain, csv_file in enumerate(csv_files):
+            tail = self.tails.setdefault(chain, CsvTail(csv_file))
+            rows = tail.read()
+            if len(rows) == 0:
+                continue
+            self.pending[chain] = np.concatenate([self.pending[chain], rows]) if chain in self.pending else rows
+            while len(self.pending[chain]) >= self.chunk_size:
+                self._flush(chain, self.pending[chain][:self.chunk_size])
+                self.pending[chain] = self.pending[chain][self.chunk_size:]
+
+    def finish(self, csv_files: list[str]) -> tuple[pd.DataFrame, dict]:
+        """残りの行を読み切り、(CmdStan と同じ行名の要約表, サンプラーの診断 {'divergences': ...}) を返す"""
+        self.poll(csv_files)
+        for chain, rows in self.pending.items():
+            if len(rows):
+                self._flush(chain, rows)
+        self.pending = {}
+        if self.summary is None:
+            raise ValueError("CmdStan の出力にドローが含まれていません。")
+        return self.summary.summary(), {'divergences': self.divergences}
+
+    def _flush(self, chain: int, rows: np.ndarray) -> None:
+        header = self.tails[chain].header
+        if 'divergent__' in header:
+            self.divergences += int(rows[:, header.index('divergent__')].sum())
+        positions = [i for i, col in enumerate(header)
+                     if not col.endswith('__') and (self.var_names is None or parse_cmdstan_column(col)[0] in self.var_names)]
+        columns = [header[i] for i in positions]
+        if self.summary is None:
+            self.summary = OnlineSummary([
+                name if not index else f"{name}[{','.join(map(str, index))}]"
+                for name, index in map(parse_cmdstan_column, columns)
+            ])
+        values = rows[:, positions]
+        self.summary.update(chain, values)
+        part = self.parts.get(chain, 0)
+        _write_chunk(values, columns, os.path.join(self.output_dir, f'chain{chain + 1}_{part:05d}.nc'), chain)
+        self.parts[chain] = part + 1
+
+
+def stream_cmdstan_csv(csv_files: list[str], output_dir: str, var_names: list[str] | None = None,
+                       chunk_size: int = STREAM_CHUNK_SIZE) -> tuple[pd.DataFrame, dict]:
+    """
+    書き終わった CmdStan の出力 CSV を chunk_size ドローずつ読んで要約し、ドローを output_dir に保存する。
+    (CmdStan と同じ行名の要約表, サンプラーの診断 {'divergences': ...}) を返す。
+    """
+    return CmdStanCsvStream(output_dir, var_names, chunk_size).finish(csv_files)
+
+
+def chain_csv_files(csv_dir: str) -> list[str]:
+    """
+    csv_dir にある cmdstanpy のチェーンごとの出力 CSV をチェーン順に返す。
+    ファイル名は '<モデル名>-<日時>_<チェーン>.csv' (1チェーンのときは '_<チェーン>' なし)。
+    """
+    files = []
+    for file_name in os.listdir(csv_dir):
+        if not file_name.endswith('.csv') or file_name.endswith(('-diagnostic.csv', '-profile.csv')):
+            continue
+        match = re.search(r'_(\d+)\.csv$', file_name)
+        files.append((int(match.group(1)) if match else 0, os.path.join(csv_dir, file_name)))
+    return [path for _, path in sorted(files)]
+
+
+def stream_cmdstan_run(sample, csv_dir: str, output_dir: str, var_names: list[str] | None = None,
+                       chunk_size: int = STREAM_CHUNK_SIZE, poll_seconds: float = POLL_SECONDS):
+    """
+    sample() (csv_dir に出力する model.sample の呼び出し) を別スレッドで実行し、
+    CmdStan が書き込んでいる途中の CSV を poll_seconds ごとに読んで要約・保存する。
+    サンプリングが終わった時点で要約もほぼ終わっているので、終了後に CSV 全体を読み直さない。
+    (sample() の戻り値, 要約表, サンプラーの診断) を返す。
+    """
+    # 前回の実行の CSV を読まないように消しておく
+    os.makedirs(csv_dir, exist_ok=True)
+    for file_name in os.listdir(csv_dir):
+        if file_name.endswith('.csv'):
+            os.remove(os.path.join(csv_dir, file_name))
+
+    stream = CmdStanCsvStream(output_dir, var_names, chunk_size)
+    result = {}
+
+    def target():
+        try:
+            result['fit'] = sample()
+        except BaseException as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    while thread.is_alive():
+        thread.join(poll_seconds)
+        stream.poll(chain_csv_files(csv_dir))
+    if 'error' in result:
+        raise result['error']
+    summary_df, sampler_info = stream.finish(chain_csv_files(csv_dir))
+    return result['fit'], summary_df, sampler_info
+
+
+def _write_chunk(values: np.ndarray, columns: list[str], path: str, chain: int) -> None:
+    """チャンクのドローをパラメータごとの (chain, draw, *形) の配列にして NetCDF に保存する"""
+    variables = {}
+    for name, positions in _group_columns(columns).items():
+        shape = tuple(np.max([index for _, index in positions], axis=0)) if positions[0][1] else ()
+        array = np.empty((1, len(values)) + shape)
+        for position, index in positions:
+            array[(0, slice(None)) + tuple(i - 1 for i in index)] = values[:, position]
+        dims = ['chain', 'draw'] + [f'{name}_dim_{i}' for i in range(len(shape))]
+        variables[name] = (dims, array)
+    xr.Dataset(variables, coords={'chain': [chain]}).to_netcdf(path, engine='scipy')
+
+
+def _group_columns(columns: list[str]) -> dict[str, list[tuple[int, tuple[int, ...]]]]:
+    """パラメータ名 -> [(列の位置, 添字)]"""
+    groups = {}
+    for position, column in enumerate(columns):
+        name, index = parse_cmdstan_column(column)
+        groups.setdefault(name, []).append((position, index))
+    return groups
+
+
+def load_draws(output_dir: str, var_names: list[str]) -> dict[str, np.ndarray]:
+    """CmdStanCsvStream (stream_cmdstan_run, stream_cmdstan_csv) で保存したチャンクから var_names のドローだけを読み込み、(チェーン, ドロー, ...) にまとめる"""
+    by_chain = {}
+    for file_name in sorted(os.listdir(output_dir)):
+        if not file_name.endswith('.nc'):
+            continue
+        with xr.open_dataset(os.path.join(output_dir, file_name), engine='scipy') as chunk:
+            chain = int(chunk['chain'].values[0])
+            by_chain.setdefault(chain, []).append({name: chunk[name].values[0] for name in var_names})
+
+    return {
+        name: np.stack([np.concatenate([part[name] for part in by_chain[chain]]) for chain in sorted(by_chain)])
+        for name in var_names
+    }
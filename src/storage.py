@@ -0,0 +1,142 @@
+"""
+dataset_for_bda の中間データの読み書き
+
+中間データは Parquet で保存し、カテゴリ (task_category, comments_category) とフレーズの列
+(problem, verb, obj) はカテゴリ型 (Parquet では辞書エンコード) にする。
+CSV は環境変数 BDA_EXPORT_CSV=1 のとき (または export_csv=True を指定したとき) だけ
+同じ名前の .csv として書き出す。
+読み込み時は指定したパスがなければ拡張子違いのファイル (.parquet <-> .csv) を探すので、
+以前の CSV しかない場合もそのまま読める。
+"""
+
+import os
+import re
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# 常にカテゴリ型にする列
+CATEGORICAL_COLUMNS = ['task_category', 'comments_category']
+# フレーズの列 (problem, comment1_problem, solution_verb, comment_obj など)
+PHRASE_COLUMN_PATTERN = re.compile(r'(?:^|_)(?:problem|verb|obj)$')
+# Parquet の圧縮方式
+COMPRESSION = 'zstd'
+
+
+def export_csv_enabled() -> bool:
+    """環境変数 BDA_EXPORT_CSV=1 なら Parquet と一緒に CSV も書き出す"""
+    return os.environ.get('BDA_EXPORT_CSV', '0') == '1'
+
+
+def csv_path(path: str) -> str:
+    return os.path.splitext(path)[0] + '.csv'
+
+
+def parquet_path(path: str) -> str:
+    return os.path.splitext(path)[0] + '.parquet'
+
+
+def categorical_columns(df: pd.DataFrame) -> list[str]:
+    """カテゴリ型にする列 (CATEGORICAL_COLUMNS とフレーズの列のうち、df にあるもの)"""
+    return [col for col in df.columns
+            if col in CATEGORICAL_COLUMNS or (isinstance(col, str) and PHRASE_COLUMN_PATTERN.search(col))]
+
+
+def to_categorical(df: pd.DataFrame, columns: list[str] | None = None) -> pd.DataFrame:
+    """columns (省略時は categorical_columns(df)) のうち文字列の列をカテゴリ型にしたコピーを返す"""
+    columns = categorical_columns(df) if columns is None else columns
+    df = df.copy()
+    for col in columns:
+        if df[col].dtype == object or isinstance(df[col].dtype, pd.StringDtype):
+            df[col] = df[col].astype('category')
+    return df
+
+
+def existing_path(path: str) -> str:
+    """
+    path があれば path を、なければ拡張子違いのファイル (.parquet <-> .csv) を返す。
+    どちらもなければ FileNotFoundError。
+    """
+    candidates = [path, csv_path(path) if path.endswith('.parquet') else parquet_path(path)]
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError(f"{path} (または {candidates[1]}) が見つかりません。")
+
+
+def read_table(path: str, columns: list[str] | None = None) -> pd.DataFrame:
+    """
+    path (.parquet または .csv) を読み込む。path がなければ拡張子違いのファイルを読む。
+    どちらもなければ FileNotFoundError。
+    """
+    path = existing_path(path)
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+
+def write_table(df: pd.DataFrame, path: str, categorical: list[str] | None = None,
+                export_csv: bool | None = None, encoding: str = 'utf-8') -> None:
+    """
+    df を path (.parquet) に保存する。categorical (省略時は categorical_columns(df)) の列はカテゴリ型にする。
+    export_csv (省略時は BDA_EXPORT_CSV) が真なら同じ名前の .csv も書き出す。
+    """
+    output_dir = os.path.dirname(path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    if path.endswith('.csv'):
+        df.to_csv(path, index=False, encoding=encoding)
+        return
+
+    to_categorical(df, categorical).to_parquet(path, index=False, compression=COMPRESSION)
+    if export_csv_enabled() if export_csv is None else export_csv:
+        df.to_csv(csv_path(path), index=False, encoding=encoding)
+
+
+class TableWriter:
+    """
+    DataFrame を少しずつ (チャンクごとに) 一つの Parquet ファイルに追記する。
+    列の型は最初のチャンクで決まる (全て欠損の列は文字列として扱う)。
+
+        with TableWriter(path) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    """
+
+    def __init__(self, path: str, export_csv: bool | None = None, encoding: str = 'utf-8'):
+        self.path = path
+        self.export_csv = export_csv_enabled() if export_csv is None else export_csv
+        self.encoding = encoding
+        self.schema = None
+        self.writer = None
+        self.n_chunks = 0
+
+    def write(self, df: pd.DataFrame) -> None:
+        if self.writer is None:
+            output_dir = os.path.dirname(self.path)
+            if output_dir:
+                os.makedirs(output_dir, exist_ok=True)
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            self.schema = pa.schema([
+                field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in schema
+            ])
+            self.writer = pq.ParquetWriter(self.path, self.schema, compression=COMPRESSION)
+
+        self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+        if self.export_csv:
+            df.to_csv(csv_path(self.path), mode='w' if self.n_chunks == 0 else 'a', header=self.n_chunks == 0,
+                      index=False, encoding=self.encoding)
+        self.n_chunks += 1
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self) -> 'TableWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,109 @@
+"""
+単語の正規化 (名詞の単数形, 原形) の結果を (表層形, 品詞) ごとにメモし、実行をまたいで使い回す
+
+同じ名詞 ("button", "settings" など) はタスク文やコメントに何千回も現れるので、
+inflect の singular_noun や spaCy の lemmatizer を呼ぶのは (表層形, 品詞) ごとに一度だけにする。
+spaCy の rule lemmatizer 自身も (表層形, 品詞) をキーにプロセス内でキャッシュしているので、結果は変わらない。
+メモは SQLite (MEMO_PATH) に保存し、種類 (kind) には inflect や spaCy モデルのバージョンを含めるので、
+バージョンが変わると別のメモになる。
+
+ヒット数・ミス数と、ヒットによって省けた時間 (メモした値を最初に計算したときの所要時間の合計) は
+run_report の token_norm グループに加算される。
+"""
+
+import os
+import sqlite3
+import time
+from importlib.metadata import version
+from typing import Callable
+
+import run_report
+
+# メモの保存先 (リポジトリのルートから実行することを想定)
+MEMO_PATH = '.cache/token_norm.sqlite'
+
+
+class TokenNormalizer:
+    """
+    (種類, 表層形, 品詞) -> 正規化した形 のメモ。
+    新しく計算した値は flush() を呼んだときに保存する (ワーカープロセスではシャードの処理の最後に呼ぶ)。
+    """
+
+    def __init__(self, path: str = MEMO_PATH):
+        self.path = path
+        self.memo = None
+        self.pending = []
+        self._conn = None
+        self._pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # fork したワーカープロセスでは親の接続を使わず、自分の接続を開き直す
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS token_norm ("
+                "kind TEXT NOT NULL, text TEXT NOT NULL, pos TEXT NOT NULL, value TEXT, seconds REAL NOT NULL, "
+                "PRIMARY KEY (kind, text, pos))"
+            )
+            self._pid = os.getpid()
+        return self._conn
+
+    def _load(self) -> dict:
+        if self.memo is None:
+            rows = self._connect().execute("SELECT kind, text, pos, value, seconds FROM token_norm").fetchall()
+            self.memo = {(kind, text, pos): (value, seconds) for kind, text, pos, value, seconds in rows}
+        return self.memo
+
+    def lookup(self, kind: str, text: str, pos: str, compute: Callable[[], str | None]) -> str | None:
+        """メモにあればその値を、なければ compute() を計算してメモする"""
+        memo = self._load()
+        key = (kind, text, pos)
+        if key in memo:
+            value, seconds = memo[key]
+            run_report.add('token_norm.hit')
+            run_report.add('token_norm.saved_seconds', seconds)
+            return value
+
+        start = time.perf_counter()
+        value = compute()
+        seconds = time.perf_counter() - start
+        memo[key] = (value, seconds)
+        self.pending.append((kind, text, pos, value, seconds))
+        run_report.add('token_norm.miss')
+        return value
+
+    def singular(self, text: str, pos: str, p_engine) -> str | None:
+        """inflect による単数形 (すでに単数形なら None)。singular_noun と同じく変換できなければ偽の値を返す"""
+        kind = f"singular:inflect-{version('inflect')}"
+        return self.lookup(kind, text, pos, lambda: p_engine.singular_noun(text) or None)
+
+    def lemma(self, token, lemmatizer, model_name: str) -> str:
+        """
+        トークンの原形。解析時に原形が付いていればそれを (attribute_ruler などが付けたもの)、
+        なければ lemmatizer (model_name のモデルの spaCy の Lemmatizer) で求めた原形をメモから返す。
+        """
+        if token.lemma_:
+            return token.lemma_
+        kind = f'lemma:{model_name}-{lemmatizer.mode}'
+        return self.lookup(kind, token.text, token.pos_, lambda: lemmatizer.lemmatize(token)[0])
+
+    def flush(self) -> None:
+        """まだ保存していないメモを保存する"""
+        if not self.pending:
+            return
+        conn = self._connect()
+        conn.executemany("INSERT OR IGNORE INTO token_norm VALUES (?, ?, ?, ?, ?)", self.pending)
+        conn.commit()
+        self.pending = []
+
+
+# プロセスごとに共有する TokenNormalizer (get_normalizer で作る)
+_normalizer = None
+
+
+def get_normalizer() -> TokenNormalizer:
+    global _normalizer
+    if _normalizer is None:
+        _normalizer = TokenNormalizer()
+    return _normalizer
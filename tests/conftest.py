@@ -0,0 +1,41 @@
+"""
+テスト共通の設定
+
+src のスクリプトは src (と src/stan) を import のルートにしているので、同じパスを通す。
+src/stan/1/run.py はパッケージとして import できないので load_stan_run で読み込む。
+"""
+
+import importlib.util
+import os
+import shutil
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(REPO_ROOT, 'src'), os.path.join(REPO_ROOT, 'src', 'stan')]
+
+
+def load_stan_run():
+    """src/stan/1/run.py をモジュールとして読み込む"""
+    spec = importlib.util.spec_from_file_location('stan_run', os.path.join(REPO_ROOT, 'src', 'stan', '1', 'run.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def stan_run():
+    return load_stan_run()
+
+
+@pytest.fixture
+def bundled_features(stan_run, tmp_path, monkeypatch):
+    """
+    同梱の merged_comments_with_ratings.csv の load_features の結果。
+    前処理はリポジトリのルートからの相対パス (dataset_for_bda, .cache) に書き込むので、一時ディレクトリで実行する。
+    """
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('dataset_for_bda')
+    shutil.copy(os.path.join(REPO_ROOT, 'dataset_for_bda', 'merged_comments_with_ratings.csv'), 'dataset_for_bda/merged.csv')
+    return stan_run.load_features('dataset_for_bda/merged.csv')
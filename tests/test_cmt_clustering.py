@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics import adjusted_rand_score
+
+from conftest import REPO_ROOT
+from cmt_clustering import clean_text, cluster_vectors, compare_clustering_methods
+
+EXTRACTED_CSV = os.path.join(REPO_ROOT, 'dataset_for_bda', 'comments_extracted.csv')
+
+
+class CharNgramVectorizer:
+    """
+    spaCy のベクトル付きモデルの代わりに、文字 n-gram の TF-IDF を SVD で圧縮したベクトルを使う
+    (PhraseVectorizer と同じ embed を持つ)。モデルがない環境でも同梱のフレーズで方式を比べられる。
+    """
+
+    def embed(self, phrases: list[str]) -> tuple[list[str], np.ndarray]:
+        tfidf = TfidfVectorizer(analyzer='char_wb', ngram_range=(3, 3)).fit_transform(phrases)
+        return phrases, TruncatedSVD(n_components=100, random_state=0).fit_transform(tfidf)
+
+
+def bundled_phrases() -> list[str]:
+    df = pd.read_csv(EXTRACTED_CSV)
+    columns = [col for col in df.columns if col.endswith(('_problem', '_verb', '_obj'))]
+    values = pd.unique(df[columns].stack().astype(str))
+    return sorted({clean_text(value) for value in values if value != 'unknown'} - {''})
+
+
+def test_compare_on_bundled_phrases(tmp_path):
+    phrases = bundled_phrases()
+    report = compare_clustering_methods(phrases, CharNgramVectorizer(), output_file=str(tmp_path / 'comparison.csv'))
+    report = report.set_index('method')
+
+    assert (report['n_phrases'] == len(phrases)).all()
+    assert report.loc['agglomerative', 'ari_vs_agglomerative'] == 1.0
+    # graph は近傍グラフの連結成分ごとの agglomerative なので、全体の agglomerative と一致する
+    assert report.loc['graph', 'ari_vs_agglomerative'] == 1.0
+    assert 0 < report.loc['leader', 'nmi_vs_agglomerative'] <= 1
+
+
+def test_graph_matches_agglomerative_on_random_vectors():
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(40, 20))
+    vectors = centers[rng.integers(0, 40, 800)] + 0.3 * rng.normal(size=(800, 20))
+    agglomerative = cluster_vectors(vectors, 'agglomerative')
+    graph = cluster_vectors(vectors, 'graph')
+    assert adjusted_rand_score(agglomerative, graph) == 1.0
@@ -0,0 +1,62 @@
+import os
+
+import pandas as pd
+import pytest
+
+spacy = pytest.importorskip('spacy')
+
+pytestmark = pytest.mark.skipif(not spacy.util.is_package('en_core_web_sm'),
+                                reason="spaCy の英語モデル 'en_core_web_sm' がインストールされていない")
+
+from conftest import REPO_ROOT
+
+# 同梱のコメント (cmt_normalize.py の出力) とタスク文
+BUNDLED_COMMENTS = os.path.join(REPO_ROOT, 'dataset_for_bda', 'comments_normalized_subset.csv')
+BUNDLED_TASKS = os.path.join(REPO_ROOT, 'dataset_for_bda', 'tasks_extracted_chunk_corrected.csv')
+# 以前の設定: ner だけを止め、原形は lemmatizer が付けた lemma_ を使う
+PREVIOUS_DISABLED_PIPES = ['ner']
+
+
+@pytest.fixture
+def cmt_extract(tmp_path, monkeypatch):
+    """解析のキャッシュを使わずに、一時ディレクトリ (原形のメモの保存先) で cmt_extract を読み込む"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('BDA_PARSE_CACHE', '0')
+    import cmt_extract
+    import token_norm
+    monkeypatch.setattr(token_norm, '_normalizer', None)
+    return cmt_extract
+
+
+def previous_configuration(cmt_extract, monkeypatch):
+    from parse_cache import ParseCache
+    monkeypatch.setattr(cmt_extract, 'parse_cache', ParseCache(cmt_extract.nlp, disable=PREVIOUS_DISABLED_PIPES))
+    monkeypatch.setattr(cmt_extract, 'token_lemma', lambda token: token.lemma_)
+
+
+def test_critique_columns_match_previous_configuration(cmt_extract, monkeypatch):
+    comments = pd.read_csv(BUNDLED_COMMENTS)
+    current = cmt_extract.extract_comment_columns(comments)
+    with monkeypatch.context() as m:
+        previous_configuration(cmt_extract, m)
+        previous = cmt_extract.extract_comment_columns(comments)
+
+    assert (current != 'unknown').to_numpy().any()
+    pd.testing.assert_frame_equal(current, previous)
+
+
+def test_token_lemma_matches_lemmatizer(cmt_extract):
+    """抽出に使う節とタスク文の全てのトークンで、メモから求めた原形が lemmatizer の原形と一致する"""
+    comments = pd.read_csv(BUNDLED_COMMENTS)
+    clauses = [clause for text in comments.filter(like='_text').stack()
+               for clause in (cmt_extract.split_critique(text) or ()) if clause]
+    texts = clauses + pd.read_csv(BUNDLED_TASKS, encoding='utf-8-sig')['task'].dropna().tolist()
+
+    nlp = cmt_extract.nlp
+    with_lemmatizer = nlp.pipe(texts, disable=PREVIOUS_DISABLED_PIPES)
+    without_lemmatizer = nlp.pipe(texts, disable=cmt_extract.DISABLED_PIPES)
+    mismatches = [(token.text, token.pos_, expected.lemma_, cmt_extract.token_lemma(token))
+                  for doc, expected_doc in zip(without_lemmatizer, with_lemmatizer)
+                  for token, expected in zip(doc, expected_doc)
+                  if cmt_extract.token_lemma(token) != expected.lemma_]
+    assert mismatches == []
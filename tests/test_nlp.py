@@ -0,0 +1,51 @@
+import os
+
+import pandas as pd
+import pytest
+
+spacy = pytest.importorskip('spacy')
+pytest.importorskip('inflect')
+
+import nlp
+import token_norm
+from conftest import REPO_ROOT
+
+pytestmark = pytest.mark.skipif(not spacy.util.is_package('en_core_web_sm'),
+                                reason="spaCy の英語モデル 'en_core_web_sm' がインストールされていない")
+
+# 同梱のタスク文 (nlp.py の出力の task 列)
+BUNDLED_TASKS = os.path.join(REPO_ROOT, 'dataset_for_bda', 'tasks_extracted_chunk_corrected.csv')
+
+
+def normalized(frame: pd.DataFrame) -> pd.DataFrame:
+    """欠損を None にそろえた object 型の表 (pandas が推論する文字列型の違いは比べない)"""
+    frame = frame.astype(object)
+    return frame.where(frame.notna(), None)
+
+
+@pytest.fixture
+def models(tmp_path, monkeypatch):
+    """解析のキャッシュを使わずに、一時ディレクトリで nlp.py のモデルを読み込む (単数形のメモも一時ディレクトリに書く)"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('BDA_PARSE_CACHE', '0')
+    monkeypatch.setattr(token_norm, '_normalizer', None)
+    monkeypatch.setattr(nlp, 'nlp', None)
+    monkeypatch.setattr(nlp, 'p', None)
+    nlp.load_models()
+
+
+@pytest.mark.parametrize('method', ['IDF', 'CHUNK'])
+def test_piped_extraction_matches_default(models, monkeypatch, method):
+    monkeypatch.setattr(nlp, 'SIMPLIFICATION_METHOD', method)
+    tasks = pd.read_csv(BUNDLED_TASKS, encoding='utf-8-sig')[['id', 'task']]
+    tasks.loc[len(tasks)] = [-1, None]
+
+    default = nlp.extract_tasks(tasks)
+    piped = nlp.extract_tasks_piped(tasks)
+    pd.testing.assert_frame_equal(normalized(piped[['id', 'task', 'verb', 'obj']]), normalized(default))
+
+    idf_scores = {'button': 2.0, 'event': 3.0, 'setting': 1.5}
+    pd.testing.assert_frame_equal(
+        normalized(nlp.simplify_piped_objects(piped, idf_scores=idf_scores)),
+        normalized(nlp.simplify_objects(default, idf_scores=idf_scores)),
+    )
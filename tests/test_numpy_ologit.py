@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from benchmark import simulate, to_stan_data
+from numpy_ologit import OrderedLogitModel, fit_laplace
+from posterior import summarize_draws
+
+# Stan と比べるパラメータ
+COMPARED_VARS = ['beta', 'mu_alpha', 'sigma_alpha', 'c']
+# 同じラプラス近似 (CmdStan の laplace_sample) との許容差: 平均の差は事後標準偏差の 15%、標準偏差の比は 0.8 ~ 1.25
+# (1000 ドローのモンテカルロ誤差が標準偏差の 3% 程度なので、その数倍)
+LAPLACE_MEAN_TOLERANCE = 0.15
+LAPLACE_SD_RATIO = (0.8, 1.25)
+# NUTS との許容差 (ラプラス近似は事後分布の歪みを表せないので、平均だけを beta と c で緩く比べる)
+NUTS_MEAN_TOLERANCE = 0.3
+
+
+def test_laplace_reports_clamped_eigenvalues(capsys):
+    model = OrderedLogitModel(to_stan_data(simulate(200, 3, 4, seed=1), 'dense'))
+    theta = model.find_mode().x
+    precision = -model.hessian(theta)
+    # 1 方向だけ曲率を負にしたヘッセ行列
+    eigenvalues, eigenvectors = np.linalg.eigh(precision)
+    eigenvalues[0] = -1.0
+    model.hessian = lambda theta: -(eigenvectors * eigenvalues) @ eigenvectors.T
+
+    draws, n_clamped = model.laplace_draws(theta, draws=10)
+    assert n_clamped == 1
+    assert '正定値ではありません' in capsys.readouterr().out
+    assert draws['beta'].shape == (1, 10, 3)
+
+
+def test_bundled_fit_has_positive_definite_hessian(stan_run, bundled_features):
+    stan_data = stan_run.build_stan_data(bundled_features, predictor_set='controls', design='dense')
+    _, info = fit_laplace(stan_data, draws=100)
+    assert info['converged']
+    assert info['n_clamped_eigenvalues'] == 0
+
+
+def summaries(stan_run, stan_data: dict, method: str):
+    numpy_draws, _ = fit_laplace(stan_data, draws=1000)
+    model, _, _ = stan_run.load_stan_model('dense')
+    if method == 'laplace':
+        fit = stan_run.run_approximation(model, stan_data, 'laplace')
+        stan_draws = stan_run.extract_draws(fit, COMPARED_VARS, chains=1, method='laplace')
+    else:
+        fit = model.sample(data=stan_data, seed=1234, chains=4, iter_sampling=1000, show_progress=False)
+        stan_draws = stan_run.extract_draws(fit, COMPARED_VARS, chains=4)
+    return (summarize_draws({name: numpy_draws[name] for name in COMPARED_VARS}),
+            summarize_draws(stan_draws))
+
+
+@pytest.mark.parametrize('method', ['laplace', 'nuts'])
+def test_numpy_agrees_with_stan_on_bundled_data(stan_run, bundled_features, method):
+    if not stan_run.cmdstan_available():
+        pytest.skip("CmdStan がインストールされていません")
+    stan_data = stan_run.build_stan_data(bundled_features, predictor_set='controls', design='dense')
+    numpy_summary, stan_summary = summaries(stan_run, stan_data, method)
+
+    if method == 'laplace':
+        rows = stan_summary.index
+        difference = (numpy_summary.loc[rows, 'Mean'] - stan_summary['Mean']).abs() / stan_summary['StdDev']
+        assert (difference <= LAPLACE_MEAN_TOLERANCE).all(), difference
+        ratio = numpy_summary.loc[rows, 'StdDev'] / stan_summary['StdDev']
+        assert ratio.between(*LAPLACE_SD_RATIO).all(), ratio
+    else:
+        rows = [row for row in stan_summary.index if row.startswith(('beta', 'c['))]
+        difference = (numpy_summary.loc[rows, 'Mean'] - stan_summary.loc[rows, 'Mean']).abs() / stan_summary.loc[rows, 'StdDev']
+        assert (difference <= NUTS_MEAN_TOLERANCE).all(), difference
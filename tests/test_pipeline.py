@@ -0,0 +1,49 @@
+import pytest
+
+import pipeline
+from conftest import REPO_ROOT
+
+
+@pytest.fixture
+def repo_root(monkeypatch):
+    """ステージのパスはリポジトリのルートからの相対パス"""
+    monkeypatch.chdir(REPO_ROOT)
+
+
+def test_imported_modules_follow_imports(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'lib').mkdir()
+    (tmp_path / 'script.py').write_text("import numpy\nfrom a import f\n\ndef g():\n    import b.sub\n")
+    (tmp_path / 'lib' / 'a.py').write_text("import c\n")
+    (tmp_path / 'lib' / 'b.py').write_text("")
+    (tmp_path / 'lib' / 'c.py').write_text("import a\n")
+    monkeypatch.setattr(pipeline, 'MODULE_DIRS', ['lib'])
+
+    assert pipeline.imported_modules('script.py') == ['lib/a.py', 'lib/b.py', 'lib/c.py']
+
+
+def test_stage_code_includes_imported_modules(repo_root):
+    code = {stage['name']: stage['code'] for stage in pipeline.build_stages()}
+    assert {'src/stan/posterior.py', 'src/stan/numpy_ologit.py', 'src/stan/data_cache.py',
+            'src/stan/model_cache.py', 'src/storage.py'} <= set(code['stan'])
+    assert {'src/cluster_model.py', 'src/phrase_vectors.py', 'src/storage.py'} <= set(code['cmt_clustering'])
+    assert 'src/stan/1/hierarchical_ordered_logistic_sparse.stan' in code['stan']
+
+
+@pytest.mark.parametrize('long_format', [False, True])
+def test_intermediate_inputs_are_produced_by_a_stage(repo_root, long_format):
+    stages = pipeline.build_stages(long_format=long_format)
+    if long_format:
+        stages = pipeline.exclude_long_unsupported(stages, [])
+    produced = {path for stage in stages for path in stage['outputs']}
+    # dataset_for_bda の下はパイプラインが作るファイル (元データは dataset と dataset_modified にある)
+    orphans = [(stage['name'], path) for stage in stages for path in stage['inputs']
+               if path.startswith('dataset_for_bda/') and path not in produced]
+    assert orphans == []
+
+
+def test_long_rejects_unsupported_target(repo_root):
+    stages = pipeline.build_stages(long_format=True)
+    with pytest.raises(ValueError, match='merge'):
+        pipeline.exclude_long_unsupported(stages, ['merge'])
+    assert 'merge' not in {stage['name'] for stage in pipeline.exclude_long_unsupported(stages, ['cmt_merge'])}
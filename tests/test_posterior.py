@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from posterior import (CmdStanCsvStream, HistogramQuantiles, OnlineSummary, SUMMARY_QUANTILES, chain_csv_files,
+                       load_draws, stream_cmdstan_csv, stream_cmdstan_run)
+
+# np.quantile との差の上限 (標準偏差に対する割合)。4000 ドローでの実測は最大でも 1% 程度
+QUANTILE_TOLERANCE = 0.02
+# 真の ESS との比の許容範囲。バッチ平均の数が少ないので、4 チェーン x 1000 ドローでの比の標準偏差は 14% 程度あり、
+# 200 通りの乱数の 0.5% ~ 99.5% 点は 0.73 ~ 1.41 だった
+ESS_RATIO = (0.6, 1.5)
+
+
+def ar1(rng, phi: float, n_draws: int, n_columns: int, mean: float = 0.0) -> np.ndarray:
+    noise = rng.normal(size=(n_draws, n_columns))
+    values = np.zeros_like(noise)
+    for t in range(1, n_draws):
+        values[t] = phi * values[t - 1] + noise[t]
+    return values + mean
+
+
+@pytest.mark.parametrize('distribution', ['normal', 'gamma', 't3', 'lognormal'])
+def test_histogram_quantiles_match_numpy(distribution):
+    rng = np.random.default_rng(0)
+    values = {
+        'normal': lambda: rng.normal(3, 2, (4000, 50)),
+        'gamma': lambda: rng.gamma(2, 1, (4000, 50)),
+        't3': lambda: rng.standard_t(3, (4000, 50)),
+        'lognormal': lambda: rng.lognormal(0, 0.5, (4000, 50)),
+    }[distribution]()
+    quantiles = HistogramQuantiles(values.shape[1])
+    for start in range(0, len(values), 200):
+        quantiles.update(values[start:start + 200])
+
+    error = np.abs(quantiles.result() - np.quantile(values, SUMMARY_QUANTILES, axis=0))
+    assert (error / values.std(axis=0)).max() < QUANTILE_TOLERANCE
+
+
+def test_online_summary_ess_and_split_rhat():
+    rng = np.random.default_rng(1)
+    mixed = OnlineSummary(['independent', 'ar1'])
+    for chain in range(4):
+        values = np.column_stack([rng.normal(size=1000), ar1(rng, 0.5, 1000, 1)[:, 0]])
+        for start in range(0, 1000, 200):
+            mixed.update(chain, values[start:start + 200])
+    summary = mixed.summary()
+
+    # AR(1) の ESS は N (1 - phi) / (1 + phi)
+    assert ESS_RATIO[0] < summary.loc['independent', 'N_Eff'] / 4000 < ESS_RATIO[1]
+    assert ESS_RATIO[0] < summary.loc['ar1', 'N_Eff'] / (4000 / 3) < ESS_RATIO[1]
+    assert (summary['R_hat'] < 1.01).all()
+
+    # チェーンの後半だけずれていると、チェーン間の R_hat では見えなくても split R_hat で見える
+    drifting = OnlineSummary(['x'])
+    for chain in range(4):
+        drifting.update(chain, np.concatenate([rng.normal(size=(500, 1)), rng.normal(1.0, 1.0, (500, 1))]))
+    assert drifting.summary().loc['x', 'R_hat'] > 1.1
+
+
+def write_cmdstan_csv(path: str, values: np.ndarray, divergent: np.ndarray, step=None) -> None:
+    """CmdStan と同じ形式 ('#' のコメント行, 列名, ドロー) の CSV を書く。step があれば1行ごとに呼ぶ"""
+    with open(path, 'w') as f:
+        f.write('# model = test\n')
+        f.write('lp__,divergent__,mu_alpha,beta.1,beta.2\n')
+        f.write('# Adaptation terminated\n')
+        for row, flag in zip(values, divergent):
+            f.write(','.join(['0', str(int(flag))] + [repr(float(v)) for v in row]) + '\n')
+            f.flush()
+            if step is not None:
+                step()
+        f.write('#  Elapsed Time: 1 seconds\n')
+
+
+def test_stream_reads_csv_while_it_is_written(tmp_path):
+    rng = np.random.default_rng(2)
+    csv_dir = tmp_path / 'cmdstan'
+    csv_dir.mkdir()
+    draws = [rng.normal(size=(450, 3)) for _ in range(2)]
+    divergent = [rng.random(450) < 0.02 for _ in range(2)]
+
+    # 書き込みの途中 (行の途中を含む) で何度も読みに行く
+    stream = CmdStanCsvStream(str(tmp_path / 'posterior'), var_names=['mu_alpha', 'beta'], chunk_size=100)
+    polls = []
+    lock = threading.Lock()
+
+    def step():
+        with lock:
+            if rng.random() < 0.05:
+                stream.poll(chain_csv_files(str(csv_dir)))
+                polls.append(sum(len(rows) for rows in stream.pending.values()))
+
+    for chain in range(2):
+        write_cmdstan_csv(os.path.join(csv_dir, f'model-20240101000000_{chain + 1}.csv'), draws[chain], divergent[chain], step)
+    summary, info = stream.finish(chain_csv_files(str(csv_dir)))
+    assert polls
+
+    # 書き終わってから一度に読んだ結果と同じになる
+    expected, expected_info = stream_cmdstan_csv(chain_csv_files(str(csv_dir)), str(tmp_path / 'posterior_full'),
+                                                 var_names=['mu_alpha', 'beta'], chunk_size=100)
+    assert list(summary.index) == ['mu_alpha', 'beta[1]', 'beta[2]']
+    np.testing.assert_allclose(summary.to_numpy(), expected.to_numpy())
+    assert info['divergences'] == expected_info['divergences'] == sum(int(flags.sum()) for flags in divergent)
+
+    saved = load_draws(str(tmp_path / 'posterior'), ['mu_alpha', 'beta'])
+    np.testing.assert_array_equal(saved['mu_alpha'], np.stack([values[:, 0] for values in draws]))
+    np.testing.assert_array_equal(saved['beta'], np.stack([values[:, 1:] for values in draws]))
+    np.testing.assert_allclose(summary['Mean'], np.concatenate(draws).mean(axis=0))
+
+
+def test_stream_cmdstan_run_summarizes_during_sampling(tmp_path):
+    rng = np.random.default_rng(3)
+    csv_dir = tmp_path / 'cmdstan'
+    csv_dir.mkdir()
+    # 前回の実行の CSV は読まない
+    (csv_dir / 'model-20230101000000_1.csv').write_text('lp__,divergent__,mu_alpha,beta.1,beta.2\n0,1,9,9,9\n')
+    draws = rng.normal(size=(300, 3))
+
+    def sample():
+        for chain in range(2):
+            write_cmdstan_csv(os.path.join(csv_dir, f'model-20240101000000_{chain + 1}.csv'), draws, np.zeros(300),
+                              step=lambda: time.sleep(0.0005))
+        return 'fit'
+
+    fit, summary, info = stream_cmdstan_run(sample, str(csv_dir), str(tmp_path / 'posterior'), chunk_size=50,
+                                            poll_seconds=0.01)
+    assert fit == 'fit'
+    assert info['divergences'] == 0
+    np.testing.assert_allclose(summary['Mean'], draws.mean(axis=0))
+    assert load_draws(str(tmp_path / 'posterior'), ['beta'])['beta'].shape == (2, 300, 2)
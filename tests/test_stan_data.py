@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from conftest import REPO_ROOT
+from numpy_ologit import OrderedLogitModel
+
+MERGED_CSV = os.path.join(REPO_ROOT, 'dataset_for_bda', 'merged_comments_with_ratings.csv')
+
+
+def test_missing_category_keeps_task_id_within_J(stan_run, bundled_features):
+    """コード表にあって入力にない task_category があっても task_id <= J になる"""
+    # 全データで一度コードを振ってから、コード 0 のカテゴリを除いた入力を前処理する
+    full = bundled_features
+    df = pd.read_csv(MERGED_CSV)
+    first = df['task_category'].dropna().iloc[0]
+    df[df['task_category'] != first].to_csv('dataset_for_bda/subset.csv', index=False)
+    subset = stan_run.load_features('dataset_for_bda/subset.csv')
+
+    assert subset['n_task_categories'] == full['n_task_categories']
+    for design in ['sparse', 'dense']:
+        stan_data = stan_run.build_stan_data(subset, predictor_set='controls', design=design)
+        assert stan_data['task_id'].min() >= 2
+        assert stan_data['task_id'].max() <= stan_data['J']
+        assert len(np.unique(stan_data['task_id'])) < stan_data['J']
+
+        model = OrderedLogitModel(stan_data)
+        log_density, gradient = model.log_density(model.initial_point())
+        assert np.isfinite(log_density) and np.all(np.isfinite(gradient))
+
+    # キャッシュから読んだ場合も同じ J になる
+    cached = stan_run.load_features('dataset_for_bda/subset.csv')
+    assert cached['n_task_categories'] == subset['n_task_categories']
@@ -1,113 +1,298 @@
 import pandas as pd
+import argparse
+import json
 import os
 import re
 import ast
-from sklearn.feature_extraction.text import TfidfVectorizer
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
 import numpy as np
 
 # --- 1. 定数定義: ファイルパスとディレクトリを設定 ---
 INPUT_CSV_PATH = 'dataset_modified/uicrit_id_comments.csv'
 OUTPUT_DIR = 'dataset_modified/'
+# TF-IDF 行列は疎行列 (CSR) のまま、以下の3つのファイルに保存する
+# (行列, 列 = 語彙のリスト, 行 = 元のデータの 'comments' 以外の列)
+OUTPUT_MATRIX_PATH = os.path.join(OUTPUT_DIR, 'uicrit_tfidf_matrix.npz')
+OUTPUT_VOCABULARY_PATH = os.path.join(OUTPUT_DIR, 'uicrit_tfidf_vocabulary.json')
+OUTPUT_IDS_PATH = os.path.join(OUTPUT_DIR, 'uicrit_tfidf_ids.parquet')
+# --long を指定したときのロングフォーマット (id, term, weight) の出力 (値が0でない要素だけ)
+OUTPUT_LONG_PATH = os.path.join(OUTPUT_DIR, 'uicrit_tfidf_long.parquet')
+# --dense-csv を指定したときの、語彙ごとの列 (tfidf_*) に展開した CSV の出力 (以前の形式)
 OUTPUT_CSV_PATH = os.path.join(OUTPUT_DIR, 'uicrit_public_with_tfidf.csv')
+# 行を識別する列
+ID_COLUMN = 'id'
+# True ならクリーニング後のコメントを1行ずつ表示する (--verbose)。大きなコーパスでは出力が膨大になるので既定は False
+VERBOSE = False
+
+# --stream のとき: CSV を CHUNK_SIZE 行ずつ読み、語彙の代わりに単語のハッシュ (N_FEATURES 列) を使う
+CHUNK_SIZE = 10_000
+N_FEATURES = 2 ** 20
+# --stream の出力 (チャンクごとの part-*.npz (行列) と part-*.parquet (各行の id))
+OUTPUT_STREAM_DIR = os.path.join(OUTPUT_DIR, 'uicrit_tfidf_stream')
+# --stream で計算した IDF の保存先 (--idf で別のデータに使い回せる)
+OUTPUT_IDF_PATH = os.path.join(OUTPUT_STREAM_DIR, 'idf.npz')
+
+# TF-IDF で除外する単語 (英語の一般的な単語と、データセットに特有の単語)
+STOPWORDS = [
+    "i", "me", "my", "myself", "we", "our", "ours", "ourselves",
+    "you", "your", "yours", "yourself", "yourselves",
+    "he", "him", "his", "himself", "she", "her", "hers", "herself",
+    "it", "its", "itself", "they", "them", "theirs", "theirs", "themselves",
+    "what", "which", "who", "whom", "this", "that", "these", "those",
+    "am", "is", "are", "was", "were", "be", "been", "being",
+    "have", "has", "had", "having", "do", "does", "did", "doing",
+    "a", "an", "the", "and", "but", "if", "or", "because", "as", "until", "while",
+    "of", "at", "by", "for", "with", "about", "against", "between", "into", "through", "during",
+    "before", "after", "above", "below", "to", "from", "up", "down",
+    "in", "out", "on", "off", "over", "under",
+    "again", "further", "then", "once", "here", "there", "when", "where", "why", "how",
+    "all", "any", "both", "each", "few", "more", "most", "other", "some", "such",
+    "no", "nor", "not", "only", "own",
+    "same", "so", "than", "too", "very",
+    # dataset specific stopwords
+    "The", "the", "expected", "standard", "To", "fix", "current", "design", "LLM", "Comment",
+    "1", "2", "3", "4", "5", "6", "7", "8", "9", "10",
+]
 
 # --- 2. クリーニング関数 ---
-def clean_and_parse_comments(comment_str: str) -> list[str]:
+def clean_and_parse_comments(comment_str: str) -> str:
     """
-    不正な形式のリスト文字列をクリーニングし、文字列のPythonリストにパースします。
+    不正な形式のリスト文字列をクリーニングし、コメントをスペースで結合した文字列にします。
     `""...""` のような不正な引用符の問題を修正します。
     """
-    # 文字列でない、またはリスト形式でない場合は空のリストを返す
+    # 文字列でない、またはリスト形式でない場合は空文字列を返す (TfidfVectorizer は文字列しか受け付けない)
     if not isinstance(comment_str, str) or not comment_str.startswith('[') or not comment_str.endswith(']'):
-        return []
+        return ''
     
     my_list = ast.literal_eval(comment_str)
     # 2. リストの要素をスペースで結合
     result = ' '.join(my_list)
     pattern = r"Bounding Box:\s*\[(?:\s*-?\d+(?:\.\d+)?\s*,?){4}\]"
     result = re.sub(pattern, "", result).strip()
-    print(f"クリーニング後のコメント: {result}")
+    if VERBOSE:
+        print(f"クリーニング後のコメント: {result}")
     return result
 
-# --- 3. メイン処理ロジック ---
-def process_csv_and_add_tfidf(input_path, output_path):
-    """
-    CSVを読み込み、'comments'列をクリーニングし、TF-IDFを計算して新しい列として追加し、
-    結果を保存します。
-    """
-    print(f"ファイルを読み込んでいます: {input_path}...")
-    try:
-        df = pd.read_csv(input_path)
-    except FileNotFoundError:
-        print(f"エラー: 入力ファイルが見つかりません {input_path}")
-        return
 
+# --- 3. TF-IDF の計算と保存 ---
+def compute_tfidf(df: pd.DataFrame) -> tuple[sparse.csr_matrix, np.ndarray]:
+    """'comments'列をクリーニングし、TF-IDF 行列 (CSR, 行 = df の行) と語彙 (列の単語) を返す"""
     print("'comments'列をクリーニングしています...")
     # クリーニング関数を 'comments' 列の各行に適用
-    df['comments_cleaned'] = df['comments'].apply(clean_and_parse_comments)
-
-    # print("TF-IDF処理のためにクリーニングされたコメントを結合しています...")
-    # # TF-IDF計算のため、コメントのリストを一つの文字列に結合
-    # df['comments_full_text'] = df['comments_cleaned'].apply(lambda comments: ' '.join(comments))
-
-    # クリーニング後に空になった行を空文字列で埋める
-    # df['comments_full_text'].fillna('', inplace=True)
+    comments_cleaned = df['comments'].apply(clean_and_parse_comments)
 
     print("TF-IDFベクトルを計算しています...")
     # TF-IDF Vectorizerを初期化
-    # stop_words='english': 英語の一般的な単語（ストップワード）を除外
+    # stop_words: 英語の一般的な単語（ストップワード）とデータセットに特有の単語を除外
     # max_features: 使用する単語数を制限（メモリ使用量を抑えるため）
-    stopwords = [
-        "i", "me", "my", "myself", "we", "our", "ours", "ourselves",
-        "you", "your", "yours", "yourself", "yourselves",
-        "he", "him", "his", "himself", "she", "her", "hers", "herself",
-        "it", "its", "itself", "they", "them", "theirs", "theirs", "themselves",
-        "what", "which", "who", "whom", "this", "that", "these", "those",
-        "am", "is", "are", "was", "were", "be", "been", "being",
-        "have", "has", "had", "having", "do", "does", "did", "doing",
-        "a", "an", "the", "and", "but", "if", "or", "because", "as", "until", "while",
-        "of", "at", "by", "for", "with", "about", "against", "between", "into", "through", "during",
-        "before", "after", "above", "below", "to", "from", "up", "down",
-        "in", "out", "on", "off", "over", "under",
-        "again", "further", "then", "once", "here", "there", "when", "where", "why", "how",
-        "all", "any", "both", "each", "few", "more", "most", "other", "some", "such",
-        "no", "nor", "not", "only", "own",
-        "same", "so", "than", "too", "very",
-        # dataset specific stopwords
-        "The", "the", "expected", "standard", "To", "fix", "current", "design", "LLM", "Comment",
-        "1", "2", "3", "4", "5", "6", "7", "8", "9", "10",
-       
-        
-    ]
-    vectorizer = TfidfVectorizer(stop_words=stopwords, max_features=5000)
+    vectorizer = TfidfVectorizer(stop_words=STOPWORDS, max_features=5000)
 
     # テキストデータにVectorizerを適合させ、TF-IDFベクトルに変換
-    tfidf_matrix = vectorizer.fit_transform(df['comments_cleaned'])
+    tfidf_matrix = vectorizer.fit_transform(comments_cleaned).tocsr()
+    return tfidf_matrix, vectorizer.get_feature_names_out()
+
+def save_tfidf(tfidf_matrix: sparse.csr_matrix, vocabulary, ids: pd.DataFrame,
+               matrix_path: str = OUTPUT_MATRIX_PATH, vocabulary_path: str = OUTPUT_VOCABULARY_PATH,
+               ids_path: str = OUTPUT_IDS_PATH) -> None:
+    """TF-IDF 行列を .npz に、語彙を JSON に、各行の id (元のデータの 'comments' 以外の列) を Parquet に保存する"""
+    for path in (matrix_path, vocabulary_path, ids_path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    sparse.save_npz(matrix_path, tfidf_matrix)
+    with open(vocabulary_path, 'w', encoding='utf-8') as f:
+        json.dump(list(vocabulary), f, ensure_ascii=False)
+    ids.to_parquet(ids_path, index=False)
 
-    feature_names = vectorizer.get_feature_names_out()
+def load_tfidf(matrix_path: str = OUTPUT_MATRIX_PATH, vocabulary_path: str = OUTPUT_VOCABULARY_PATH,
+               ids_path: str = OUTPUT_IDS_PATH) -> tuple[sparse.csr_matrix, np.ndarray, pd.DataFrame]:
+    """
+    save_tfidf で保存した (TF-IDF 行列 (CSR), 語彙, 各行の id) を読み込む。行列は疎行列のまま返す。
+
+        tfidf_matrix, vocabulary, ids = load_tfidf()
+        column = tfidf_matrix[:, np.searchsorted(vocabulary, 'button')]
+    """
+    tfidf_matrix = sparse.load_npz(matrix_path).tocsr()
+    with open(vocabulary_path, encoding='utf-8') as f:
+        vocabulary = np.array(json.load(f), dtype=object)
+    ids = pd.read_parquet(ids_path)
+    return tfidf_matrix, vocabulary, ids
+
+def to_long(tfidf_matrix: sparse.csr_matrix, vocabulary, ids: pd.DataFrame) -> pd.DataFrame:
+    """値が0でない要素だけを (id, term, weight) の行にしたロングフォーマットの DataFrame を返す"""
+    coo = tfidf_matrix.tocoo()
+    row_ids = ids[ID_COLUMN].to_numpy() if ID_COLUMN in ids.columns else np.arange(tfidf_matrix.shape[0])
+    return pd.DataFrame({
+        ID_COLUMN: row_ids[coo.row],
+        'term': pd.Categorical.from_codes(coo.col, categories=list(vocabulary)),
+        'weight': coo.data,
+    })
+
+def to_dense(tfidf_matrix: sparse.csr_matrix, vocabulary, ids: pd.DataFrame) -> pd.DataFrame:
+    """以前の形式 (ids の列と、語彙ごとの tfidf_* 列) の DataFrame を返す。語彙が多いと非常に大きくなる"""
     # 疎行列を密な配列に変換し、語彙を列名としてDataFrameを作成
-    df_tfidf = pd.DataFrame(tfidf_matrix.toarray(), columns=feature_names)
-    
+    df_tfidf = pd.DataFrame(tfidf_matrix.toarray(), columns=vocabulary, index=ids.index)
     # TF-IDFの列だと分かりやすいように、列名の先頭にプレフィックスを追加
     df_tfidf = df_tfidf.add_prefix('tfidf_')
+    return pd.concat([ids, df_tfidf], axis=1)
+
+# --- 4. ストリーミング (--stream): 語彙を持たず、チャンクごとに計算する ---
+def hashing_vectorizer(n_features: int = N_FEATURES) -> HashingVectorizer:
+    """単語の出現回数をハッシュの列に数える (TfidfVectorizer と同じ前処理・ストップワード)"""
+    return HashingVectorizer(stop_words=STOPWORDS, n_features=n_features, alternate_sign=False, norm=None)
+
+def read_chunks(input_path: str, chunk_size: int = CHUNK_SIZE):
+    """CSV を chunk_size 行ずつ読み、(各行の id, 単語の出現回数の行列 (CSR)) を返すジェネレータ"""
+    vectorizer = hashing_vectorizer()
+    for chunk in pd.read_csv(input_path, chunksize=chunk_size):
+        counts = vectorizer.transform(chunk['comments'].apply(clean_and_parse_comments))
+        yield chunk.drop(columns=['comments']).reset_index(drop=True), counts
+
+def fit_idf(input_path: str, chunk_size: int = CHUNK_SIZE) -> tuple[np.ndarray, int]:
+    """
+    1回目の読み込み: チャンクごとに文書頻度 (各列の単語を含む行の数) を足し合わせ、
+    TfidfVectorizer の既定 (smooth_idf=True) と同じ IDF と行数を返す。
+    """
+    document_frequency = np.zeros(N_FEATURES, dtype=np.int64)
+    n_docs = 0
+    for _, counts in read_chunks(input_path, chunk_size):
+        # CSR の各行の列番号は重複しないので、列番号を数えればその単語を含む行の数になる
+        document_frequency += np.bincount(counts.indices, minlength=N_FEATURES)
+        n_docs += counts.shape[0]
+    idf = np.log((1 + n_docs) / (1 + document_frequency)) + 1
+    return idf, n_docs
+
+def save_idf(idf: np.ndarray, n_docs: int, path: str = OUTPUT_IDF_PATH) -> None:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    np.savez(path, idf=idf, n_docs=n_docs)
 
-    print("元のDataFrameとTF-IDFのDataFrameを結合しています...")
-    # 元のDataFrameから、処理に使用した中間列と元の'comments'列を削除
-    df_original = df.drop(columns=['comments', 'comments_cleaned'])
+def load_idf(path: str) -> tuple[np.ndarray, int]:
+    """save_idf で保存した (IDF, 行数) を読み込む。列数が N_FEATURES と違えば ValueError"""
+    with np.load(path) as saved:
+        idf, n_docs = saved['idf'], int(saved['n_docs'])
+    if len(idf) != N_FEATURES:
+        raise ValueError(f"{path} の IDF の列数 ({len(idf)}) が N_FEATURES ({N_FEATURES}) と違います。")
+    return idf, n_docs
 
-    # 元のデータとTF-IDFデータを列方向に結合
-    df_final = pd.concat([df_original, df_tfidf], axis=1)
+def transform_chunks(input_path: str, idf: np.ndarray, output_dir: str = OUTPUT_STREAM_DIR,
+                     chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    2回目の読み込み: チャンクごとに出現回数に IDF を掛けて行ごとに L2 正規化し、
+    output_dir/part-{番号}.npz (行列) と part-{番号}.parquet (各行の id) に保存する。保存した part の数を返す。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # 以前の実行の part が残っていると混ざるので、先に消す
+    for name in os.listdir(output_dir):
+        if name.startswith('part-'):
+            os.remove(os.path.join(output_dir, name))
+
+    idf_diagonal = sparse.diags(idf, format='csr')
+    n_parts = 0
+    for part, (ids, counts) in enumerate(read_chunks(input_path, chunk_size)):
+        tfidf_matrix = normalize(counts @ idf_diagonal, norm='l2').tocsr()
+        sparse.save_npz(os.path.join(output_dir, f'part-{part:05d}.npz'), tfidf_matrix)
+        ids.to_parquet(os.path.join(output_dir, f'part-{part:05d}.parquet'), index=False)
+        n_parts += 1
+    return n_parts
+
+def iter_tfidf_parts(output_dir: str = OUTPUT_STREAM_DIR):
+    """transform_chunks で保存した (TF-IDF 行列 (CSR), 各行の id) を part の順に返すジェネレータ"""
+    names = sorted(name for name in os.listdir(output_dir) if name.startswith('part-') and name.endswith('.npz'))
+    for name in names:
+        base = os.path.join(output_dir, os.path.splitext(name)[0])
+        yield sparse.load_npz(base + '.npz').tocsr(), pd.read_parquet(base + '.parquet')
 
-    print(f"変更後のデータを保存しています: {output_path}...")
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    df_final.to_csv(output_path, index=False, encoding='utf-8')
+def process_csv_streaming(input_path: str, idf_path: str | None = None, output_dir: str = OUTPUT_STREAM_DIR,
+                          chunk_size: int = CHUNK_SIZE):
+    """
+    CSV をチャンクごとに読んで TF-IDF を計算する (メモリに載るのは1チャンクと IDF だけ)。
+    idf_path を指定するとその IDF (参照コーパスで計算したもの) を使い、1回目の読み込みを省く。
+    指定しなければ1回目の読み込みで IDF を計算して OUTPUT_IDF_PATH に保存する。
+    """
+    if not os.path.exists(input_path):
+        print(f"エラー: 入力ファイルが見つかりません {input_path}")
+        return
+
+    if idf_path:
+        print(f"IDFを読み込んでいます: {idf_path}...")
+        try:
+            idf, n_docs = load_idf(idf_path)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"エラー: IDFを読み込めません: {e}")
+            return
+    else:
+        print(f"文書頻度を数えています ({chunk_size} 行ずつ): {input_path}...")
+        idf, n_docs = fit_idf(input_path, chunk_size)
+        save_idf(idf, n_docs)
+        print(f"IDFを保存しました: {OUTPUT_IDF_PATH}")
+
+    print(f"TF-IDFベクトルを計算しています ({n_docs} 行のコーパスの IDF)...")
+    n_parts = transform_chunks(input_path, idf, output_dir, chunk_size)
     print("--- 全ての処理が完了しました ---")
-    
+    print(f"\n{n_parts} 個の part を保存しました: {output_dir}")
+
+# --- 5. メイン処理ロジック ---
+def process_csv_and_add_tfidf(input_path, long_path: str | None = None, dense_csv_path: str | None = None):
+    """
+    CSVを読み込み、'comments'列をクリーニングし、TF-IDFを計算して疎行列のまま保存します
+    (OUTPUT_MATRIX_PATH, OUTPUT_VOCABULARY_PATH, OUTPUT_IDS_PATH)。
+    long_path を指定するとロングフォーマットの Parquet を、dense_csv_path を指定すると
+    語彙ごとの列に展開した CSV も書き出します。
+    """
+    print(f"ファイルを読み込んでいます: {input_path}...")
+    try:
+        df = pd.read_csv(input_path)
+    except FileNotFoundError:
+        print(f"エラー: 入力ファイルが見つかりません {input_path}")
+        return
+
+    tfidf_matrix, vocabulary = compute_tfidf(df)
+    # 元のDataFrameから、元の'comments'列を削除したものを各行の id とする
+    ids = df.drop(columns=['comments'])
+
+    print(f"TF-IDF行列を保存しています: {OUTPUT_MATRIX_PATH}...")
+    save_tfidf(tfidf_matrix, vocabulary, ids)
+    if long_path:
+        print(f"ロングフォーマットのTF-IDFを保存しています: {long_path}...")
+        to_long(tfidf_matrix, vocabulary, ids).to_parquet(long_path, index=False)
+    if dense_csv_path:
+        print(f"語彙ごとの列に展開したTF-IDFを保存しています: {dense_csv_path}...")
+        os.makedirs(os.path.dirname(dense_csv_path) or '.', exist_ok=True)
+        to_dense(tfidf_matrix, vocabulary, ids).to_csv(dense_csv_path, index=False, encoding='utf-8')
+    print("--- 全ての処理が完了しました ---")
+
     # 結果の確認
-    print(f"\n処理後のDataFrameの形状 (行, 列): {df_final.shape}")
-    # 表示する列が多すぎるため、最初の15列のみを表示
-    print(f"\n処理後のDataFrameの先頭5行（一部の列）:\n{df_final.iloc[:, :15].head()}")
-    print(f"\n出力ファイル '{output_path}' にTF-IDFベクトルが展開された列が追加されました。")
+    n_rows, n_terms = tfidf_matrix.shape
+    density = tfidf_matrix.nnz / max(n_rows * n_terms, 1)
+    print(f"\nTF-IDF行列の形状 (行, 語彙): {tfidf_matrix.shape}, 0でない要素: {tfidf_matrix.nnz} ({density:.2%})")
 
-# --- 4. スクリプトの実行 ---
+# --- 6. スクリプトの実行 ---
 if __name__ == "__main__":
-    process_csv_and_add_tfidf(INPUT_CSV_PATH, OUTPUT_CSV_PATH)
+    parser = argparse.ArgumentParser(description="コメントの TF-IDF を計算し、疎行列のまま保存する")
+    parser.add_argument('--input', default=INPUT_CSV_PATH, help=f"入力 CSV (既定: {INPUT_CSV_PATH})")
+    parser.add_argument('--long', action='store_true',
+                        help=f"ロングフォーマット (id, term, weight) の Parquet も書き出す ({OUTPUT_LONG_PATH})")
+    parser.add_argument('--dense-csv', action='store_true',
+                        help=f"語彙ごとの列 (tfidf_*) に展開した CSV も書き出す ({OUTPUT_CSV_PATH}, 大きくなるので注意)")
+    parser.add_argument('--stream', action='store_true',
+                        help=f"CSV をチャンクごとに読み、HashingVectorizer で計算して {OUTPUT_STREAM_DIR} に part ごとに保存する")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help=f"--stream で一度に読む行数 (既定: {CHUNK_SIZE})")
+    parser.add_argument('--idf', default=None,
+                        help=f"--stream で使う、保存済みの IDF (既定: 入力から計算して {OUTPUT_IDF_PATH} に保存)")
+    parser.add_argument('--verbose', action='store_true', help="クリーニング後のコメントを1行ずつ表示する")
+    args = parser.parse_args()
+    VERBOSE = args.verbose
+
+    if args.stream:
+        if args.long or args.dense_csv:
+            parser.error("--long と --dense-csv は --stream と一緒には使えません (語彙がないため)")
+        process_csv_streaming(args.input, idf_path=args.idf, chunk_size=args.chunk_size)
+    elif args.idf:
+        parser.error("--idf は --stream と一緒に指定してください")
+    else:
+        process_csv_and_add_tfidf(
+            args.input,
+            long_path=OUTPUT_LONG_PATH if args.long else None,
+            dense_csv_path=OUTPUT_CSV_PATH if args.dense_csv else None,
+        )